@@ -178,6 +178,20 @@ use_random_mixing = True
 # alpha = 'polymod'
 alpha = None
 
+# If True (independent transmission model only), colonization attempts for all strains are
+# drawn, and their rates and probabilities (including omega and sigma) computed, together in
+# one vectorized step using host state at the start of the colonization event, rather than
+# strain by strain and host by host. Much faster, especially with age-based mixing, at the
+# cost of ignoring the effect of colonizations within an event on each other.
+vectorize_colonizations = False
+
+# If True (independent transmission model only), colonization happens in continuous time:
+# single colonization attempts are scheduled on the event queue at exponentially
+# distributed times, drawn from per-source-age, per-strain propensities kept in a sum tree,
+# instead of every colonization_event_timestep for all strains. Cost then scales with the
+# number of colonizations, which helps most when many strains are rare.
+continuous_time_transmission = False
+
 
 ### OUTPUT PARAMETERS ###
 
@@ -187,6 +201,37 @@ db_filename = 'output_db.sqlite'
 # Whether to overwrite database if already present
 overwrite_db = False
 
+# SQLite journal mode for the output database.
+# Output rows are buffered and written in one transaction per output step.
+# 'OFF' is fastest, but a crash during a write can leave the database unusable;
+# 'WAL' is nearly as fast and crash-safe, but should not be used on network file systems;
+# 'DELETE' is the SQLite default.
+db_journal_mode = 'OFF'
+
+# If True, output rows are built and written to the database by a separate process,
+# so the simulation only pays for copying the output counts at each output step.
+use_background_writer = False
+
+# Output backend for the count tables (counts_by_*, summary, age_distribution):
+# 'sqlite': rows in the output database
+# 'columnar': dense arrays, one per output time, appended to binary files in
+# columnar_output_dirname (see src/columnaroutput.py), which are much smaller and can be
+# memory-mapped; parameters and other tables are still written to the database
+# 'both': both of the above
+output_format = 'sqlite'
+
+# Schema for the per-strain SQLite tables (counts_by_ageclass_treatment_strain and
+# counts_by_age_treatment_strain):
+# 'long': one row per (t, age class, in_treatment, serotype_id, resistant)
+# 'wide': one row per (t, age class, in_treatment), whose n_colonized and n_colonizations
+# columns are BLOBs containing .npy-format arrays indexed by [serotype_id, resistant]
+# (see src/npybuffer.py); 2 * n_serotypes times fewer rows
+strain_table_schema = 'long'
+
+# Directory for columnar output, relative to the directory containing db_filename.
+# If None, the database filename without extension, followed by _columns.
+columnar_output_dirname = None
+
 # How often to write output to the database.
 output_timestep = t_year
 
@@ -211,6 +256,23 @@ random_seed = None
 # but will run slower than a calendar queue with appropriately sized buckets.
 use_calendar_queue = True
 
+# Event queue implementation; overrides use_calendar_queue if uncommented.
+# 'calendar': calendar queue with linked-list buckets (same as use_calendar_queue = True)
+# 'array_calendar': calendar queue whose buckets are flat arrays, sorted when first
+# reached; uses much less memory per pending event than 'calendar'
+# 'ladder': like 'array_calendar', but only events in a window near the current time
+# are kept in fine-grained buckets; far-future events are kept in sparse coarse buckets,
+# so distant events (e.g., output at t = 0 during burnin) don't inflate the calendar
+# 'heap': indexed priority heap (same as use_calendar_queue = False)
+# event_queue_type = 'array_calendar'
+
+# If None, each host has its own birthday event on the event queue every year.
+# If a number, hosts are instead aged in batches by a single aging event every
+# aging_timestep, which ages all hosts whose birthday has passed since the previous one.
+# Ages then lag true ages by less than aging_timestep, in exchange for removing
+# one queue event per host per year. Must divide t_year evenly, e.g., 1.0 for daily aging.
+aging_timestep = None
+
 # The minimum time discretization used for a calendar queue.
 # The actual bucket width is adaptively set to
 # min(queue_min_bucket_width, 2 * [average interval between events]).
@@ -1,9 +1,30 @@
 #!/usr/bin/env python
 
+'''Gathers the output databases of all jobs under a directory into a single database.
+
+Job databases are read in batches by a pool of processes, each of which copies a batch of
+jobs into a staging database in a temporary directory, prepending a source-ID column to
+every table. The main process merges each staging database into the output database in a
+single transaction and records each job database in a sources table. Indexes on the
+source-ID column (and t, where present) are built once, after all rows have been inserted.
+
+A manifest table records the size, modification time and checksum of each gathered job
+database. With --update, an existing output database is brought up to date with the job
+databases under the root directory: new ones are added, ones whose contents have changed
+have their rows replaced (keeping their source ID), and unchanged ones are skipped.
+Job databases are recorded and identified by absolute path, so the root directory may be
+given as a different path to the same directory.
+'''
+
 import os
 import sys
+import shutil
 import sqlite3
+import hashlib
 import argparse
+import tempfile
+import collections
+import multiprocessing
 
 def main():
     parser = argparse.ArgumentParser()
@@ -11,6 +32,15 @@ def main():
     parser.add_argument('out_filename', metavar = '<output-database-filename>')
     parser.add_argument('--source-id', metavar = '<source-id-column-name>', default = 'job_id')
     parser.add_argument('--source-table', metavar = '<source-table-name>', default = 'sources')
+    parser.add_argument('--manifest-table', metavar = '<manifest-table-name>', default = 'manifest')
+    parser.add_argument('--processes', metavar = '<n-processes>', type = int, default = 1,
+        help = 'number of processes reading job databases')
+    parser.add_argument('--batch-size', metavar = '<n-jobs>', type = int, default = 20,
+        help = 'with more than one process, number of jobs per staging database and per transaction')
+    parser.add_argument('--tmp-dir', metavar = '<directory>', default = None,
+        help = 'directory for staging databases (default: system temporary directory)')
+    parser.add_argument('--update', action = 'store_true',
+        help = 'add new and re-gather changed jobs in an existing output database')
 
     args = parser.parse_args()
 
@@ -19,43 +49,240 @@ def main():
 
     source_id_name = args.source_id
     source_table_name = args.source_table
+    manifest_table_name = args.manifest_table
 
     if not os.path.exists(root_dir):
         sys.stdout.write('{} does not exist; aborting.\n'.format(root_dir))
         sys.exit(1)
 
-    if os.path.exists(out_filename):
+    if os.path.exists(out_filename) and not args.update:
         sys.stdout.write('{} already exists; aborting.\n'.format(out_filename))
         sys.exit(1)
 
-    source_id = 1
-    with sqlite3.connect(out_filename) as db:
-        db.execute('CREATE TABLE {} ({} INTEGER, filename TEXT);'.format(source_table_name, source_id_name))
-        for dirpath, dirnames, filenames in os.walk(root_dir):
-            dirnames.sort()
-            for filename in filenames:
-                if filename.endswith('.sqlite'):
-                    process_file(db, os.path.join(dirpath, filename), source_table_name, source_id_name, source_id)
-                    source_id += 1
+    # (Created before connecting so that workers don't inherit an open database)
+    pool = multiprocessing.Pool(args.processes) if args.processes > 1 else None
+
+    # Transactions are managed explicitly so that each batch is merged atomically
+    db = sqlite3.connect(out_filename, isolation_level = None)
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('CREATE TABLE IF NOT EXISTS {} ({} INTEGER, filename TEXT);'.format(source_table_name, source_id_name))
+    db.execute('CREATE TABLE IF NOT EXISTS {} ({} INTEGER, filename TEXT, size INTEGER, mtime REAL, checksum TEXT);'.format(
+        manifest_table_name, source_id_name
+    ))
+
+    new_sources, changed_sources = find_changed_sources(
+        db, root_dir, out_filename, source_table_name, manifest_table_name, source_id_name, pool
+    )
+    replaced_source_ids = set(source[0] for source in changed_sources)
+    sources = sorted(new_sources + changed_sources)
+    sys.stderr.write('Gathering {} new and {} changed job databases.\n'.format(
+        len(new_sources), len(changed_sources)
+    ))
+
+    if pool is None:
+        # Job databases are merged directly, in one transaction each
+        for source in sources:
+            sys.stderr.write('{}\n'.format(source[1]))
+            merge_database(
+                db, source[1], [source], replaced_source_ids,
+                source_table_name, manifest_table_name, source_id_name, source[0]
+            )
+    else:
+        batches = [sources[i:i + args.batch_size] for i in range(0, len(sources), args.batch_size)]
+        staging_dir = tempfile.mkdtemp(prefix = 'gather-', dir = args.tmp_dir)
+        try:
+            for batch, staging_filename in iter_staged_batches(batches, staging_dir, source_id_name, pool, args.processes):
+                merge_database(
+                    db, staging_filename, batch, replaced_source_ids,
+                    source_table_name, manifest_table_name, source_id_name
+                )
+                os.remove(staging_filename)
+        finally:
+            shutil.rmtree(staging_dir)
+        pool.close()
+        pool.join()
+
+    create_indexes(db, [source_table_name, manifest_table_name], source_id_name)
+    db.close()
+
+def find_job_databases(root_dir):
+    '''Returns the filenames of all .sqlite files under root_dir, in directory order.'''
+    in_filenames = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.sqlite'):
+                in_filenames.append(os.path.join(dirpath, filename))
+    return in_filenames
+
+def find_changed_sources(db, root_dir, out_filename, source_table_name, manifest_table_name, source_id_name, pool):
+    '''Compares job databases under root_dir against the manifest.
+
+    Returns lists of new and changed sources, each (source_id, absolute path, size, mtime, checksum).
+    Checksums are only computed for job databases whose size or modification time differ
+    from the manifest; ones whose checksum matches have only their manifest entry updated.
+    '''
+    gathered = dict(
+        (os.path.abspath(filename), source_id) for source_id, filename in
+        db.execute('SELECT {}, filename FROM {}'.format(source_id_name, source_table_name))
+    )
+    manifest = dict(
+        (row[0], row[1:]) for row in
+        db.execute('SELECT {}, size, mtime, checksum FROM {}'.format(source_id_name, manifest_table_name))
+    )
+    next_source_id = db.execute('SELECT MAX({}) FROM {}'.format(source_id_name, source_table_name)).next()[0]
+    next_source_id = 1 if next_source_id is None else next_source_id + 1
+
+    candidates = []
+    found_filenames = set()
+    for in_filename in find_job_databases(os.path.abspath(root_dir)):
+        if in_filename == os.path.abspath(out_filename):
+            continue
+        found_filenames.add(in_filename)
+        stat = os.stat(in_filename)
+        if in_filename in gathered:
+            source_id = gathered[in_filename]
+            if source_id in manifest and manifest[source_id][:2] == (stat.st_size, stat.st_mtime):
+                continue
+        else:
+            source_id = next_source_id
+            next_source_id += 1
+        candidates.append((source_id, in_filename, stat.st_size, stat.st_mtime))
+
+    for in_filename in sorted(set(gathered.keys()) - found_filenames):
+        sys.stderr.write('Warning: {} no longer exists; keeping its rows.\n'.format(in_filename))
 
-def process_file(db, in_filename, source_table_name, source_id_name, source_id):
-    sys.stderr.write('{}\n'.format(in_filename))
+    if pool is None:
+        checksums = [get_checksum(candidate[1]) for candidate in candidates]
+    else:
+        checksums = pool.map(get_checksum, [candidate[1] for candidate in candidates])
 
+    new_sources = []
+    changed_sources = []
+    for candidate, checksum in zip(candidates, checksums):
+        source = candidate + (checksum,)
+        source_id, in_filename = source[:2]
+        if in_filename not in gathered:
+            new_sources.append(source)
+        elif source_id in manifest and manifest[source_id][2] == checksum:
+            # Touched but unchanged
+            db.execute('UPDATE {} SET size = ?, mtime = ? WHERE {} = ?'.format(
+                manifest_table_name, source_id_name
+            ), [source[2], source[3], source_id])
+        else:
+            changed_sources.append(source)
+    return new_sources, changed_sources
+
+def get_checksum(filename):
+    '''Returns the SHA-1 hex digest of a file's contents.'''
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(1 << 20)
+            if len(data) == 0:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+def iter_staged_batches(batches, staging_dir, source_id_name, pool, n_processes):
+    '''Yields (batch, staging filename) for each batch of sources, in order.
+
+    Up to 2 * n_processes batches are staged ahead by the pool while earlier ones are being
+    merged, which bounds temporary disk use.
+    '''
+    pending = collections.deque()
+    for batch_index, batch in enumerate(batches):
+        staging_filename = os.path.join(staging_dir, 'batch-{}.sqlite'.format(batch_index))
+        source_ids_filenames = [source[:2] for source in batch]
+        pending.append((batch, pool.apply_async(stage_batch, [source_ids_filenames, staging_filename, source_id_name])))
+        if len(pending) == 2 * n_processes:
+            batch, result = pending.popleft()
+            yield batch, result.get()
+    while len(pending) > 0:
+        batch, result = pending.popleft()
+        yield batch, result.get()
+
+def stage_batch(batch, staging_filename, source_id_name):
+    '''Copies every table of each job database in a batch into one staging database,
+    with the job's source ID prepended, and returns the staging filename.'''
+    staging_db = sqlite3.connect(staging_filename)
+    staging_db.execute('PRAGMA synchronous = OFF')
+    staging_db.execute('PRAGMA journal_mode = OFF')
+    for source_id, in_filename in batch:
+        sys.stderr.write('{}\n'.format(in_filename))
+        staging_db.execute('ATTACH ? AS indb;', [in_filename])
+        copy_tables(staging_db, 'indb', source_id_name, source_id)
+        staging_db.commit()
+        staging_db.execute('DETACH indb;')
+    staging_db.close()
+    return staging_filename
+
+def merge_database(db, in_filename, sources, replaced_source_ids,
+        source_table_name, manifest_table_name, source_id_name, source_id = None):
+    '''Inserts all rows of a job or staging database, and their sources and manifest rows,
+    in one transaction, first deleting all rows of any sources being replaced.
+
+    For a job database, source_id is prepended to every row; staging databases already
+    contain the source-ID column.
+    '''
     db.execute('ATTACH ? AS indb;', [in_filename])
-    db.execute('INSERT INTO {} VALUES (?, ?);'.format(source_table_name), [source_id, in_filename])
+    db.execute('BEGIN')
+    delete_sources(db, [source[0] for source in sources if source[0] in replaced_source_ids], source_id_name)
+    copy_tables(db, 'indb', source_id_name, source_id)
+    db.executemany('INSERT INTO {} VALUES (?, ?);'.format(source_table_name), [source[:2] for source in sources])
+    db.executemany('INSERT INTO {} VALUES (?, ?, ?, ?, ?);'.format(manifest_table_name), sources)
+    db.execute('COMMIT')
+    db.execute('DETACH indb;')
 
-    table_names = [name for name, in db.execute("SELECT name FROM indb.sqlite_master WHERE type='table';")]
+def delete_sources(db, source_ids, source_id_name):
+    '''Deletes all rows for the given source IDs from every table with a source-ID column.'''
+    if len(source_ids) == 0:
+        return
+    table_names = [name for name, in db.execute("SELECT name FROM sqlite_master WHERE type='table';")]
     for table_name in table_names:
-        col_names = [entry[0] for entry in db.execute('SELECT * FROM indb.{}'.format(table_name)).description]
+        col_names = [row[1] for row in db.execute('PRAGMA table_info({})'.format(table_name))]
         if source_id_name in col_names:
-            sys.stderr.write('{} column already exists; aborting.\n'.format(source_id_name))
-            sys.exit(1)
-        try:
-            db.execute('CREATE TABLE {0} AS SELECT ? AS {1}, * FROM indb.{0}'.format(table_name, source_id_name), [source_id])
-        except:
-            db.execute('INSERT INTO {0} SELECT ? AS {1}, * FROM indb.{0}'.format(table_name, source_id_name), [source_id])
+            db.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+                table_name, source_id_name, ', '.join(['?'] * len(source_ids))
+            ), source_ids)
 
-    db.execute('DETACH indb;')
+def copy_tables(db, schema_name, source_id_name, source_id = None):
+    '''Appends every table in attached database schema_name to the main database,
+    creating tables as needed, with source_id prepended if it is not None.'''
+    table_names = [
+        name for name, in db.execute("SELECT name FROM {}.sqlite_master WHERE type='table';".format(schema_name))
+    ]
+    for table_name in table_names:
+        columns = [(row[1], row[2]) for row in db.execute('PRAGMA {}.table_info({})'.format(schema_name, table_name))]
+        col_names = [name for name, col_type in columns]
+        select_names = list(col_names)
+        params = []
+        if source_id is not None:
+            if source_id_name in col_names:
+                raise Exception('{} column already exists in {}.{}'.format(source_id_name, schema_name, table_name))
+            columns = [(source_id_name, 'INTEGER')] + columns
+            col_names = [source_id_name] + col_names
+            select_names = ['?'] + select_names
+            params = [source_id]
+
+        db.execute('CREATE TABLE IF NOT EXISTS main.{} ({})'.format(
+            table_name, ', '.join('{} {}'.format(name, col_type).strip() for name, col_type in columns)
+        ))
+        db.execute('INSERT INTO main.{} ({}) SELECT {} FROM {}.{}'.format(
+            table_name, ', '.join(col_names), ', '.join(select_names), schema_name, table_name
+        ), params)
+
+def create_indexes(db, excluded_table_names, source_id_name):
+    '''Indexes every gathered table by source ID (and t, if present).'''
+    table_names = [
+        name for name, in db.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        if name not in excluded_table_names
+    ]
+    for table_name in table_names:
+        col_names = [row[1] for row in db.execute('PRAGMA table_info({})'.format(table_name))]
+        index_cols = [source_id_name, 't'] if 't' in col_names else [source_id_name]
+        sys.stderr.write('Indexing {}\n'.format(table_name))
+        db.execute('CREATE INDEX IF NOT EXISTS {0}_index ON {0} ({1})'.format(table_name, ', '.join(index_cols)))
 
 if __name__ == '__main__':
     main()
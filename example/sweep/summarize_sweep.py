@@ -1,8 +1,31 @@
 #!/usr/bin/env python
 
+'''Adds summary tables (summary_overall, summary_by_serotype, summary_by_ageclass,
+summary_by_serotype_ageclass) to an output database.
+
+Each job is summarized in a single pass over its output times (t >= start of the last
+YEARS years), in time order, accumulating all averages at once in NumPy.
+Counts are read from the count tables (with either strain table schema) or, if the
+database has none, from each job's columnar output.
+
+For a gathered sweep database (with a sources table, from gather.py), jobs can be
+summarized by several processes in parallel (--processes).
+Alternatively, each run's own output database can be summarized as soon as the run
+finishes; gather.py then merges the per-run summary tables, adding job_id.
+'''
+
 import os
 import sys
 import sqlite3
+import json
+import argparse
+import itertools
+import multiprocessing
+import numpy
+from collections import OrderedDict
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+# Source directory, for reading columnar output: $PYRESISTANCE (as in run_job.sh) if set
+sys.path.append(os.environ.get('PYRESISTANCE', os.path.join(SCRIPT_DIR, '..', '..', 'src')))
 
 YEARS = 50
 N_SEROTYPES = 25
@@ -11,545 +34,331 @@ N_AGECLASSES = 3
 N_HOSTS = 100000
 
 def main():
-    db_filename = sys.argv[1]
-    
-    with sqlite3.connect(db_filename) as db:
-        create_indexes(db)
-        summarize(db)
+    parser = argparse.ArgumentParser(
+        description='Adds summary tables to a gathered sweep database or a single run\'s output database.'
+    )
+    parser.add_argument('db_filename', metavar='<database-filename>')
+    parser.add_argument(
+        '--processes', metavar='<n-processes>', type=int, default=1,
+        help='Number of processes summarizing jobs in parallel.'
+    )
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db_filename) as db:
+        if has_table(db, 'counts_by_ageclass_treatment_strain'):
+            create_indexes(db)
+
+        if has_table(db, 'sources'):
+            job_ids = [job_id for job_id, in db.execute('SELECT job_id FROM sources ORDER BY job_id')]
+            job_columns = JOB_COLUMNS
+        else:
+            job_ids = [None]
+            job_columns = JOB_COLUMNS[1:] if has_table(db, 'jobs') else []
+
+        start_time = get_end_time(db, args.db_filename, job_ids) - T_YEAR * (YEARS - 1)
+        print('summarizing {0} jobs from t = {1}'.format(len(job_ids), start_time))
+
+        tasks = [(args.db_filename, job_id, start_time) for job_id in job_ids]
+        if args.processes > 1:
+            pool = multiprocessing.Pool(args.processes)
+            job_summaries = pool.map(summarize_job_task, tasks)
+            pool.close()
+            pool.join()
+        else:
+            job_summaries = map(summarize_job_task, tasks)
+
+        write_job_summaries(db, job_columns, job_summaries)
+
+def has_table(db, table_name):
+    return db.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", [table_name]
+    ).next()[0] > 0
 
 def create_indexes(db):
-    db.execute('''
-        CREATE INDEX IF NOT EXISTS counts_by_ageclass_treatment_index ON counts_by_ageclass_treatment
-        (job_id, t, ageclass, in_treatment)
-    ''')
-    db.execute('''
-        CREATE INDEX IF NOT EXISTS counts_by_ageclass_treatment_n_colonizations_index ON counts_by_ageclass_treatment_n_colonizations
-        (job_id, t, ageclass, in_treatment, n_colonizations)
-    ''')
-    db.execute('''
-        CREATE INDEX IF NOT EXISTS counts_by_ageclass_treatment_strain_index ON counts_by_ageclass_treatment_strain
-        (job_id, t, ageclass, in_treatment, serotype_id, resistant)
-    ''')
-
-def summarize(db):
-    print('summarize()')
-    
-    start_year = db.execute('SELECT MAX(t) FROM summary').next()[0] - T_YEAR * (YEARS - 1)
-    summarize_overall(db, start_year)
-    summarize_by_serotype(db, start_year)
-    summarize_by_ageclass(db, start_year)
-    summarize_by_serotype_ageclass(db, start_year)
-
-def summarize_overall(db, start_year):
-    print('summarize_overall()')
-    
-    summarize_frac_resistant_overall(db, start_year)
-    summarize_prevalence_overall(db, start_year)
-    
-    db.execute('DROP TABLE IF EXISTS summary_overall')
-    db.execute('''
-        CREATE TABLE summary_overall AS
-        SELECT
-            jobs.job_id,
-            jobs.cost,
-            jobs.treatment_multiplier,
-            jobs.gamma_treated_ratio_resistant_to_sensitive,
-            tmp_frac_res_avg.frac_res AS frac_resistant,
-            tmp_prev_avg.prev AS prevalence
-        FROM
-            jobs, tmp_frac_res_avg, tmp_prev_avg
-        WHERE
-            jobs.job_id = tmp_frac_res_avg.job_id AND jobs.job_id = tmp_prev_avg.job_id
-    ''')
-    
-
-def summarize_frac_resistant_overall(db, start_year):
-    print('summarize_frac_resistant_overall()')
-    
-    # Number of colonizations over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_n_col AS
-        SELECT
-            job_id, t,
-            SUM(n_colonizations) AS n_col
-        FROM
-            counts_by_ageclass_treatment_strain
-        WHERE
-            t >= ?
-        GROUP BY job_id, t
-    ''', [start_year])
-    
-    # Number of resistant colonizations over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_n_col_res AS
-        SELECT
-            job_id, t,
-            SUM(n_colonizations) AS n_col_res
-        FROM
-            counts_by_ageclass_treatment_strain
-        WHERE
-            t >= ? AND resistant = 1
-        GROUP BY job_id, t
-    ''', [start_year])
-    
-    # Fraction resistant over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_frac_res AS
-        SELECT
-            tmp_n_col.job_id AS job_id, tmp_n_col.t AS t,
-            tmp_n_col_res.n_col_res * 1.0 / tmp_n_col.n_col AS frac_res
-        FROM
-            tmp_n_col, tmp_n_col_res
-        WHERE
-            tmp_n_col.job_id = tmp_n_col_res.job_id AND tmp_n_col.t = tmp_n_col_res.t
-        GROUP BY tmp_n_col.job_id, tmp_n_col.t
-    ''')
-    
-    # Average fraction resistant over last YEARS years
-    db.execute('''
-        CREATE TEMP TABLE tmp_frac_res_avg AS
-        SELECT job_id, AVG(frac_res) AS frac_res FROM tmp_frac_res GROUP BY job_id
-    ''')
-
-def summarize_prevalence_overall(db, start_year):
-    print('summarize_prevalence_overall()')
-    
-    # Prevalence over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_prev AS
-        SELECT
-            job_id, t, SUM(n_hosts) * 1.0 / ? AS prev
-        FROM
-            counts_by_ageclass_treatment_n_colonizations
-        WHERE
-            t >= ? AND n_colonizations >= 1
-        GROUP BY job_id, t
-    ''', [N_HOSTS, start_year])
-    
-    # Average prevalence over last YEARS years
-    db.execute('''
-        CREATE TEMP TABLE tmp_prev_avg AS
-        SELECT job_id, AVG(prev) AS prev FROM tmp_prev GROUP BY job_id
-    ''')
-
-def summarize_by_serotype(db, start_year):
-    print('summarize_by_serotype()')
-    
-    summarize_frac_resistant_by_serotype(db, start_year)
-    summarize_prevalence_by_serotype(db, start_year)
-    
-    db.execute('DROP TABLE IF EXISTS summary_by_serotype')
-    db.execute('''
-        CREATE TABLE summary_by_serotype AS
-        SELECT
-            jobs.job_id,
-            jobs.cost,
-            jobs.treatment_multiplier,
-            jobs.gamma_treated_ratio_resistant_to_sensitive,
-            tmp_frac_res_sero_avg.serotype_id AS serotype_id,
-            tmp_frac_res_sero_avg.frac_res AS frac_resistant,
-            tmp_prev_sero_avg.prev AS prevalence
-        FROM
-            jobs, tmp_frac_res_sero_avg, tmp_prev_sero_avg
-        WHERE
-            jobs.job_id = tmp_frac_res_sero_avg.job_id AND jobs.job_id = tmp_prev_sero_avg.job_id
-            AND tmp_frac_res_sero_avg.serotype_id = tmp_prev_sero_avg.serotype_id
-    ''')
-
-def summarize_frac_resistant_by_serotype(db, start_year):
-    print('summarize_frac_resistant_by_serotype()')
-    
-    # Number of colonizations over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_n_col_sero AS
-        SELECT
-            job_id, t, serotype_id,
-            SUM(n_colonizations) AS n_col
-        FROM
-            counts_by_ageclass_treatment_strain
-        WHERE
-            t >= ?
-        GROUP BY job_id, t, serotype_id
-    ''', [start_year])
-    
-    # Number of resistant colonizations over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_n_col_res_sero AS
-        SELECT
-            job_id, t, serotype_id,
-            SUM(n_colonizations) AS n_col_res
-        FROM
-            counts_by_ageclass_treatment_strain
-        WHERE
-            t >= ? AND resistant = 1
-        GROUP BY job_id, t, serotype_id
-    ''', [start_year])
-    
-    # Fraction resistant over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_frac_res_sero AS
-        SELECT
-            tmp_n_col_sero.job_id AS job_id, tmp_n_col_sero.t AS t,
-            tmp_n_col_sero.serotype_id AS serotype_id,
-            tmp_n_col_res_sero.n_col_res * 1.0 / tmp_n_col_sero.n_col AS frac_res
-        FROM
-            tmp_n_col_sero, tmp_n_col_res_sero
-        WHERE
-            tmp_n_col_sero.job_id = tmp_n_col_res_sero.job_id
-            AND tmp_n_col_sero.t = tmp_n_col_res_sero.t
-            AND tmp_n_col_sero.serotype_id = tmp_n_col_res_sero.serotype_id
-        GROUP BY tmp_n_col_sero.job_id, tmp_n_col_sero.t, tmp_n_col_sero.serotype_id
-    ''')
-    
-    # Average fraction resistant over last YEARS years
-    db.execute('''
-        CREATE TEMP TABLE tmp_frac_res_sero_avg AS
-        SELECT job_id, serotype_id, AVG(frac_res) AS frac_res FROM tmp_frac_res_sero
-        GROUP BY job_id, serotype_id
-    ''')
-
-def summarize_prevalence_by_serotype(db, start_year):
-    print('summarize_prevalence_by_serotype()')
-    
-    # Prevalence over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_prev_sero AS
-        SELECT
-            job_id, t, serotype_id, SUM(n_colonized) * 1.0 / ? AS prev
-        FROM
-            counts_by_ageclass_treatment_strain
-        WHERE
-            t >= ?
-        GROUP BY job_id, t, serotype_id
-    ''', [N_HOSTS, start_year])
-    
-    # Average prevalence over last YEARS years
-    db.execute('''
-        CREATE TEMP TABLE tmp_prev_sero_avg AS
-        SELECT job_id, serotype_id, AVG(prev) AS prev FROM tmp_prev_sero
-        GROUP BY job_id, serotype_id
-    ''')
-
-def summarize_by_ageclass(db, start_year):
-    print('summarize_prevalence_by_serotype')
-    
-    summarize_frac_resistant_by_ageclass(db, start_year)
-    summarize_prevalence_by_ageclass(db, start_year)
-    summarize_prevalence_by_ageclass_resistant(db, start_year)
-    
-    db.execute('DROP TABLE IF EXISTS summary_by_ageclass')
-    db.execute('''
-        CREATE TABLE summary_by_ageclass AS
-        SELECT
-            jobs.job_id,
-            jobs.cost,
-            jobs.treatment_multiplier,
-            jobs.gamma_treated_ratio_resistant_to_sensitive,
-            tmp_frac_res_age_avg.ageclass AS ageclass,
-            tmp_frac_res_age_avg.frac_res AS frac_resistant,
-            tmp_prev_age_avg.prev AS prevalence,
-            tmp_prev_sens_res_age_avg.prev_sens AS prev_sens,
-            tmp_prev_sens_res_age_avg.prev_res AS prev_res
-        FROM
-            jobs, tmp_frac_res_age_avg, tmp_prev_age_avg, tmp_prev_sens_res_age_avg
-        WHERE
-            jobs.job_id = tmp_frac_res_age_avg.job_id AND jobs.job_id = tmp_prev_age_avg.job_id
-            AND jobs.job_id = tmp_prev_sens_res_age_avg.job_id
-            AND tmp_frac_res_age_avg.ageclass = tmp_prev_age_avg.ageclass
-            AND tmp_prev_sens_res_age_avg.ageclass = tmp_prev_age_avg.ageclass
-    ''')
-
-def create_tmp_n_col_age(db, start_year):
-    # Number of colonizations over time by ageclass
-    db.execute('''
-        CREATE TEMP TABLE IF NOT EXISTS tmp_n_col_age AS
-        SELECT
-            job_id, t, ageclass,
-            SUM(n_colonizations) AS n_col
-        FROM
-            counts_by_ageclass_treatment_strain
-        WHERE
-            t >= ?
-        GROUP BY job_id, t, ageclass
-    ''', [start_year])
-
-def create_tmp_n_col_age_total(db, start_year):
-    # Number of colonizations total over last 50 years by ageclass
-    db.execute('''
-        CREATE TEMP TABLE IF NOT EXISTS tmp_n_col_age_total AS
-        SELECT
-            job_id, ageclass,
-            SUM(n_colonizations) AS n_col
-        FROM
-            tmp_n_col_age
-        GROUP BY job_id, ageclass
-    ''', [start_year])
-
-def summarize_frac_resistant_by_ageclass(db, start_year):
-    print('summarize_frac_resistant_by_ageclass')
-    
-    create_tmp_n_col_age(db, start_year)
-    
-    # Number of resistant colonizations over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_n_col_res_age AS
-        SELECT
-            job_id, t, ageclass,
-            SUM(n_colonizations) AS n_col_res
-        FROM
-            counts_by_ageclass_treatment_strain
-        WHERE
-            t >= ? AND resistant = 1
-        GROUP BY job_id, t, ageclass
-    ''', [start_year])
-    
-    # Fraction resistant over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_frac_res_age AS
-        SELECT
-            tmp_n_col_age.job_id AS job_id, tmp_n_col_age.t AS t,
-            tmp_n_col_age.ageclass AS ageclass,
-            tmp_n_col_res_age.n_col_res * 1.0 / tmp_n_col_age.n_col AS frac_res
-        FROM
-            tmp_n_col_age, tmp_n_col_res_age
-        WHERE
-            tmp_n_col_age.job_id = tmp_n_col_res_age.job_id
-            AND tmp_n_col_age.t = tmp_n_col_res_age.t
-            AND tmp_n_col_age.ageclass = tmp_n_col_res_age.ageclass
-        GROUP BY tmp_n_col_age.job_id, tmp_n_col_age.t, tmp_n_col_age.ageclass
-    ''')
-    
-    # Average fraction resistant over last YEARS years
-    db.execute('''
-        CREATE TEMP TABLE tmp_frac_res_age_avg AS
-        SELECT job_id, ageclass, AVG(frac_res) AS frac_res FROM tmp_frac_res_age
-        GROUP BY job_id, ageclass
-    ''')
-
-def summarize_prevalence_by_ageclass(db, start_year):
-    print('summarize_prevalence_by_ageclass')
-    
-    # Prevalence over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_prev_age AS
-        SELECT
-            job_id, t, ageclass, SUM(n_colonized) * 1.0 / SUM(n_hosts) AS prev
-        FROM
-            counts_by_ageclass_treatment
-        WHERE
-            t >= ?
-        GROUP BY job_id, t, ageclass
-    ''', [start_year])
-    
-    # Average prevalence over last YEARS years
-    db.execute('''
-        CREATE TEMP TABLE tmp_prev_age_avg AS
-        SELECT job_id, ageclass, AVG(prev) AS prev FROM tmp_prev_age
-        GROUP BY job_id, ageclass
-    ''')
-
-def summarize_prevalence_by_ageclass_resistant(db, start_year):
-    print('summarize_prevalence_by_ageclass_resistant')
-    
-    # No. hosts, no. colonized and no. colonized by sensitive and resistant over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_n_age AS
-        SELECT
-            job_id, t, ageclass,
-            SUM(n_hosts) AS n_hosts,
-            SUM(n_colonized) AS n_colonized,
-            SUM(n_colonized_by_sensitive_and_resistant) as n_colonized_sandr
-        FROM
-            counts_by_ageclass_treatment
-        WHERE
-            t >= ?
-        GROUP BY job_id, t, ageclass
-    ''', [start_year])
-    
-    # Estimate of prevalence of sensitive & resistant strains over time
-    # [n_colonized - n_colonized_sandr] * frac_res + n_colonized_sandr
-    db.execute('''
-        CREATE TEMP TABLE tmp_prev_sens_res_age AS
-        SELECT
-            tmp_n_age.job_id AS job_id,
-            tmp_n_age.t AS t,
-            tmp_n_age.ageclass AS ageclass,
-            ((n_colonized - n_colonized_sandr) * (1.0 - frac_res) + n_colonized_sandr) / n_hosts AS prev_sens,
-            ((n_colonized - n_colonized_sandr) * frac_res + n_colonized_sandr) / n_hosts AS prev_res
-        FROM
-            tmp_n_age, tmp_frac_res_age
-        WHERE
-            tmp_n_age.job_id = tmp_frac_res_age.job_id
-            AND tmp_n_age.t = tmp_frac_res_age.t
-            AND tmp_n_age.ageclass = tmp_frac_res_age.ageclass
-    ''')
-    
-    
-    # Average prevalence over last YEARS years
-    db.execute('''
-        CREATE TEMP TABLE tmp_prev_sens_res_age_avg AS
-        SELECT
-            job_id, ageclass,
-            AVG(prev_sens) AS prev_sens,
-            AVG(prev_res) AS prev_res
-        FROM tmp_prev_sens_res_age
-        GROUP BY job_id, ageclass
-    ''')
-
-def summarize_by_serotype_ageclass(db, start_year):
-    print('summarize_by_serotype_ageclass()')
-    
-    create_tmp_frac_res_sero_age_avg(db, start_year)
-    create_tmp_n_col_sero_age_total(db, start_year)
-    create_tmp_freq_sero_age_avg(db, start_year)
-    
-    db.execute('DROP TABLE IF EXISTS summary_by_serotype_ageclass')
-    db.execute('''
-        CREATE TABLE summary_by_serotype_ageclass AS
-        SELECT
-            jobs.job_id AS job_id,
-            jobs.cost AS cost,
-            jobs.treatment_multiplier AS treatment_multiplier,
-            jobs.gamma_treated_ratio_resistant_to_sensitive,
-            tmp_frac_res_sero_age_avg.serotype_id AS serotype_id,
-            tmp_frac_res_sero_age_avg.ageclass AS ageclass,
-            tmp_frac_res_sero_age_avg.frac_res AS frac_resistant,
-            tmp_freq_sero_age_avg.freq AS freq_avg,
-            tmp_n_col_sero_age_total.n_col AS n_colonizations_total
-        FROM
-            jobs, tmp_frac_res_sero_age_avg, tmp_n_col_sero_age_total, tmp_freq_sero_age_avg
-        WHERE
-            jobs.job_id = tmp_frac_res_sero_age_avg.job_id AND
-            jobs.job_id = tmp_n_col_sero_age_total.job_id AND
-            jobs.job_id = tmp_freq_sero_age_avg.job_id AND
-            
-            tmp_frac_res_sero_age_avg.serotype_id = tmp_n_col_sero_age_total.serotype_id AND
-            tmp_frac_res_sero_age_avg.serotype_id = tmp_freq_sero_age_avg.serotype_id AND
-            
-            tmp_frac_res_sero_age_avg.ageclass = tmp_n_col_sero_age_total.ageclass AND
-            tmp_frac_res_sero_age_avg.ageclass = tmp_freq_sero_age_avg.ageclass
-            
-    ''')
-
-def create_tmp_frac_res_sero_age_avg(db, start_year):
-    print('create_tmp_frac_res_sero_age_avg()')
-    
-    create_tmp_n_col_sero_age(db, start_year)
-    create_tmp_n_col_res_sero_age(db, start_year)
-    
-    # Fraction resistant over time
-    db.execute('''
-        CREATE TEMP TABLE tmp_frac_res_sero_age AS
-        SELECT
-            tmp_n_col_sero_age.job_id AS job_id, tmp_n_col_sero_age.t AS t,
-            tmp_n_col_sero_age.serotype_id AS serotype_id,
-            tmp_n_col_sero_age.ageclass AS ageclass,
-            tmp_n_col_res_sero_age.n_col_res * 1.0 / tmp_n_col_sero_age.n_col AS frac_res
-        FROM
-            tmp_n_col_sero_age, tmp_n_col_res_sero_age
-        WHERE
-            tmp_n_col_sero_age.job_id = tmp_n_col_res_sero_age.job_id
-            AND tmp_n_col_sero_age.t = tmp_n_col_res_sero_age.t
-            AND tmp_n_col_sero_age.serotype_id = tmp_n_col_res_sero_age.serotype_id
-            AND tmp_n_col_sero_age.ageclass = tmp_n_col_res_sero_age.ageclass
-        GROUP BY tmp_n_col_sero_age.job_id, tmp_n_col_sero_age.t, tmp_n_col_sero_age.serotype_id, tmp_n_col_sero_age.ageclass
-    ''')
-    
-    # Average fraction resistant over last YEARS years
-    db.execute('''
-        CREATE TEMP TABLE tmp_frac_res_sero_age_avg AS
-        SELECT job_id, serotype_id, ageclass, AVG(frac_res) AS frac_res FROM tmp_frac_res_sero_age
-        GROUP BY job_id, serotype_id, ageclass
-    ''')
-
-def create_tmp_n_col_sero_age_total(db, start_year):
-    print('create_tmp_n_col_sero_age_total()')
-    
-    create_tmp_n_col_sero_age(db, start_year)
-    
-    # Number of colonizations total over last 50 years by ageclass
-    db.execute('''
-        CREATE TEMP TABLE IF NOT EXISTS tmp_n_col_sero_age_total AS
-        SELECT
-            job_id, serotype_id, ageclass,
-            SUM(n_col) AS n_col
-        FROM
-            tmp_n_col_sero_age
-        GROUP BY job_id, serotype_id, ageclass
-    ''')
-
-def create_tmp_freq_sero_age_avg(db, start_year):
-    print('create_tmp_freq_sero_age_avg()')
-    
-    create_tmp_freq_sero_age(db, start_year)
-    
-    # Average frequency over last 50 years by serotype, ageclass
-    db.execute('''
-        CREATE TEMP TABLE IF NOT EXISTS tmp_freq_sero_age_avg AS
-        SELECT
-            job_id, serotype_id, ageclass,
-            AVG(freq) AS freq
-        FROM
-            tmp_freq_sero_age
-        GROUP BY job_id, serotype_id, ageclass
-    ''')
-    
-    c = db.execute('SELECT * FROM tmp_freq_sero_age_avg')
-    print c.description
-    for row in db.execute('SELECT * FROM tmp_freq_sero_age_avg'):
-        print row
-
-def create_tmp_freq_sero_age(db, start_year):
-    print('create_tmp_freq_sero_age()')
-    
-    create_tmp_n_col_age(db, start_year)
-    
-    db.execute('''
-        CREATE TEMP TABLE IF NOT EXISTS tmp_freq_sero_age AS
-        SELECT
-            tmp_n_col_age.job_id AS job_id,
-            tmp_n_col_age.t AS t,
-            serotype_id AS serotype_id,
-            tmp_n_col_age.ageclass AS ageclass,
-            SUM(counts_by_ageclass_treatment_strain.n_colonizations) * 1.0 / tmp_n_col_age.n_col AS freq
-        FROM
-            counts_by_ageclass_treatment_strain, tmp_n_col_age
-        WHERE
-            counts_by_ageclass_treatment_strain.t >= ? AND
-            counts_by_ageclass_treatment_strain.job_id = tmp_n_col_age.job_id AND
-            counts_by_ageclass_treatment_strain.ageclass = tmp_n_col_age.ageclass AND
-            counts_by_ageclass_treatment_strain.t = tmp_n_col_age.t
-        GROUP BY tmp_n_col_age.job_id, tmp_n_col_age.t, serotype_id, tmp_n_col_age.ageclass
-    ''', [start_year])
-
-
-def create_tmp_n_col_sero_age(db, start_year):
-    # Number of colonizations over time
-    db.execute('''
-        CREATE TEMP TABLE IF NOT EXISTS tmp_n_col_sero_age AS
-        SELECT
-            job_id, t, serotype_id, ageclass,
-            SUM(n_colonizations) AS n_col
-        FROM
-            counts_by_ageclass_treatment_strain
-        WHERE
-            t >= ?
-        GROUP BY job_id, t, serotype_id, ageclass
-    ''', [start_year])
-
-def create_tmp_n_col_res_sero_age(db, start_year):
-    # Number of resistant colonizations over time
-    db.execute('''
-        CREATE TEMP TABLE IF NOT EXISTS tmp_n_col_res_sero_age AS
-        SELECT
-            job_id, t, serotype_id, ageclass,
-            SUM(n_colonizations) AS n_col_res
-        FROM
-            counts_by_ageclass_treatment_strain
-        WHERE
-            t >= ? AND resistant = 1
-        GROUP BY job_id, t, serotype_id, ageclass
-    ''', [start_year])
+    '''Creates indexes so that each job's rows can be read in time order.'''
+    job_id_column = 'job_id, ' if has_table(db, 'sources') else ''
+    for table_name in (
+        'counts_by_ageclass_treatment',
+        'counts_by_ageclass_treatment_n_colonizations',
+        'counts_by_ageclass_treatment_strain'
+    ):
+        db.execute('CREATE INDEX IF NOT EXISTS {0}_index ON {0} ({1}t)'.format(table_name, job_id_column))
+    db.commit()
+
+def get_end_time(db, db_filename, job_ids):
+    '''Returns the final output time over all jobs.'''
+    if has_table(db, 'summary'):
+        return db.execute('SELECT MAX(t) FROM summary').next()[0]
+    return max(
+        get_columnar_reader(db, db_filename, job_id).times[-1]
+        for job_id in job_ids
+    )
+
+
+### READING COUNTS ###
+
+def iter_job_counts(db, db_filename, job_id, start_time):
+    '''Yields the counts needed for summaries at each output time t >= start_time, in time order.
+
+    Counts are dictionaries mapping each name in SUMMARY_COLUMNS to an array indexed by
+    [ageclass, in_treatment, ...], as in columnar output.
+    '''
+    if not has_table(db, 'counts_by_ageclass_treatment_strain'):
+        reader = get_columnar_reader(db, db_filename, job_id)
+        arrays = dict(
+            (name, reader.get('counts_by_ageclass_treatment{0}'.format(name))) for name in SUMMARY_COLUMNS
+        )
+        for i, t in enumerate(reader.times):
+            if t >= start_time:
+                yield dict((name, array[i]) for name, array in arrays.iteritems())
+        return
+
+    # Rows from all three tables are read together, one output time at a time
+    treatment_rows = iter_rows_by_t(db, 'counts_by_ageclass_treatment', job_id, start_time,
+        'ageclass, in_treatment, n_hosts, n_colonized, n_colonized_by_sensitive_and_resistant'
+    )
+    n_colonizations_rows = iter_rows_by_t(db, 'counts_by_ageclass_treatment_n_colonizations', job_id, start_time,
+        'ageclass, in_treatment, n_colonizations, n_hosts'
+    )
+    if is_wide_strain_table(db, 'counts_by_ageclass_treatment_strain'):
+        strain_rows = iter_rows_by_t(db, 'counts_by_ageclass_treatment_strain', job_id, start_time,
+            'ageclass, in_treatment, n_colonized, n_colonizations'
+        )
+        make_strain_arrays = make_strain_arrays_wide
+    else:
+        strain_rows = iter_rows_by_t(db, 'counts_by_ageclass_treatment_strain', job_id, start_time,
+            'ageclass, in_treatment, serotype_id, resistant, n_colonized, n_colonizations'
+        )
+        make_strain_arrays = make_strain_arrays_long
+
+    for (t, rows), (t_n_col, n_col_rows), (t_strain, s_rows) in itertools.izip(treatment_rows, n_colonizations_rows, strain_rows):
+        assert t == t_n_col and t == t_strain
+
+        counts = {}
+        rows = numpy.array(rows, dtype=int)
+        for i, name in enumerate(('.n_hosts', '.n_colonized', '.n_colonized_by_sensitive_and_resistant')):
+            counts[name] = make_dense(rows[:,:2], rows[:,2+i])
+
+        n_col_rows = numpy.array(n_col_rows, dtype=int)
+        counts['_n_colonizations.n_hosts'] = make_dense(n_col_rows[:,:3], n_col_rows[:,3])
+
+        counts['_strain.n_colonized'], counts['_strain.n_colonizations'] = make_strain_arrays(s_rows)
+        yield counts
+
+def iter_rows_by_t(db, table_name, job_id, start_time, column_names):
+    '''Yields (t, rows) for each output time, reading the job's rows once in time order.'''
+    cursor = db.execute(
+        'SELECT t, {0} FROM {1} WHERE {2} t >= ? ORDER BY t'.format(
+            column_names, table_name, 'job_id = ? AND' if job_id is not None else ''
+        ),
+        [job_id, start_time] if job_id is not None else [start_time]
+    )
+    for t, rows in itertools.groupby(cursor, lambda row: row[0]):
+        yield t, [row[1:] for row in rows]
+
+def make_dense(keys, values):
+    array = numpy.zeros(tuple(keys.max(axis=0) + 1), dtype=int)
+    array[tuple(keys.T)] = values
+    return array
+
+def make_strain_arrays_long(rows):
+    rows = numpy.array(rows, dtype=int)
+    return make_dense(rows[:,:4], rows[:,4]), make_dense(rows[:,:4], rows[:,5])
+
+def make_strain_arrays_wide(rows):
+    import npybuffer
+    n_ageclasses = max(row[0] for row in rows) + 1
+    n_colonized = None
+    n_colonizations = None
+    for ageclass, in_treatment, n_colonized_blob, n_colonizations_blob in rows:
+        n_colonized_i = npybuffer.npy_buffer_to_ndarray(n_colonized_blob)
+        if n_colonized is None:
+            n_colonized = numpy.zeros((n_ageclasses, 2) + n_colonized_i.shape, dtype=int)
+            n_colonizations = numpy.zeros((n_ageclasses, 2) + n_colonized_i.shape, dtype=int)
+        n_colonized[ageclass, int(in_treatment)] = n_colonized_i
+        n_colonizations[ageclass, int(in_treatment)] = npybuffer.npy_buffer_to_ndarray(n_colonizations_blob)
+    return n_colonized, n_colonizations
+
+def is_wide_strain_table(db, table_name):
+    '''True for a strain table written with strain_table_schema = 'wide' (no serotype_id column).'''
+    return 'serotype_id' not in [row[1] for row in db.execute('PRAGMA table_info({0})'.format(table_name))]
+
+def get_columnar_reader(db, db_filename, job_id):
+    '''Opens a job's columnar output, located from its database filename and parameters.'''
+    from columnaroutput import ColumnarReader, get_columnar_output_path
+
+    if job_id is None:
+        filename = db_filename
+        p = json.loads(db.execute('SELECT parameters FROM parameters').next()[0])
+    else:
+        filename = db.execute('SELECT filename FROM sources WHERE job_id = ?', [job_id]).next()[0]
+        p = json.loads(db.execute('SELECT parameters FROM parameters WHERE job_id = ?', [job_id]).next()[0])
+    return ColumnarReader(get_columnar_output_path(filename, p.get('columnar_output_dirname')))
+
+
+### SUMMARIES ###
+
+# Columns needed for summaries, named by table suffix and column, after counts_by_ageclass_treatment
+SUMMARY_COLUMNS = [
+    '.n_hosts', '.n_colonized', '.n_colonized_by_sensitive_and_resistant',
+    '_strain.n_colonized', '_strain.n_colonizations',
+    '_n_colonizations.n_hosts'
+]
+
+# Summary table columns after the job columns, in the order of JobSummary.get_rows()
+SUMMARY_TABLES = OrderedDict([
+    ('summary_overall', ['frac_resistant', 'prevalence']),
+    ('summary_by_serotype', ['serotype_id', 'frac_resistant', 'prevalence']),
+    ('summary_by_ageclass', ['ageclass', 'frac_resistant', 'prevalence', 'prev_sens', 'prev_res']),
+    ('summary_by_serotype_ageclass', ['serotype_id', 'ageclass', 'frac_resistant', 'freq_avg', 'n_colonizations_total'])
+])
+JOB_COLUMNS = ['job_id', 'cost', 'treatment_multiplier', 'gamma_treated_ratio_resistant_to_sensitive']
+
+def summarize_job_task(args):
+    '''Summarizes one job using its own database connection; returns (job_id, rows by table).'''
+    db_filename, job_id, start_time = args
+    sys.stderr.write('job {0}\n'.format(job_id))
+
+    db = sqlite3.connect(db_filename)
+    summary = JobSummary()
+    for counts in iter_job_counts(db, db_filename, job_id, start_time):
+        summary.add(counts)
+    db.close()
+
+    return job_id, summary.get_rows()
+
+class Mean(object):
+    '''Running elementwise mean that skips undefined (non-finite) values, like SQL AVG skips NULL.'''
+    def __init__(self):
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, x):
+        valid = numpy.isfinite(x)
+        self.sum = self.sum + numpy.where(valid, x, 0.0)
+        self.count = self.count + valid
+
+    def get(self, *index):
+        count = numpy.asarray(self.count)[index]
+        if count == 0:
+            return None
+        return float(numpy.asarray(self.sum)[index] / count)
+
+class JobSummary(object):
+    '''Averages over output times of all summary quantities for one job.
+
+    Quantities at each time are computed from counts summed over treatment status.
+    Fractions are undefined (and skipped) when their denominator is zero, as in SQL.
+    '''
+    def __init__(self):
+        self.n_times = 0
+        self.names = [
+            'frac_res', 'prev', 'frac_res_sero', 'prev_sero',
+            'frac_res_age', 'prev_age', 'prev_sens_age', 'prev_res_age',
+            'frac_res_sero_age', 'freq_sero_age'
+        ]
+        self.means = dict((name, Mean()) for name in self.names)
+        self.n_col_total = 0
+
+    def add(self, counts):
+        def get(name):
+            # Sums over in_treatment (axis 1)
+            return numpy.array(counts[name], dtype=float).sum(axis=1)
+
+        n_hosts = get('.n_hosts') # [ageclass]
+        n_colonized = get('.n_colonized')
+        n_colonized_sandr = get('.n_colonized_by_sensitive_and_resistant')
+        n_colonized_strain = get('_strain.n_colonized') # [ageclass, serotype_id, resistant]
+        n_col = get('_strain.n_colonizations')
+        n_hosts_by_n_col = get('_n_colonizations.n_hosts') # [ageclass, n_colonizations]
+
+        values = {}
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # Overall; prevalence is undefined when no host is colonized
+            values['frac_res'] = n_col[:,:,1].sum() / n_col.sum()
+            n_hosts_colonized = n_hosts_by_n_col[:,1:].sum()
+            values['prev'] = n_hosts_colonized / N_HOSTS if n_hosts_colonized > 0 else numpy.nan
+
+            # By serotype
+            n_col_sero = n_col.sum(axis=0) # [serotype_id, resistant]
+            values['frac_res_sero'] = n_col_sero[:,1] / n_col_sero.sum(axis=1)
+            values['prev_sero'] = n_colonized_strain.sum(axis=2).sum(axis=0) / N_HOSTS
+
+            # By age class
+            n_col_age = n_col.sum(axis=1) # [ageclass, resistant]
+            frac_res_age = n_col_age[:,1] / n_col_age.sum(axis=1)
+            values['frac_res_age'] = frac_res_age
+            values['prev_age'] = n_colonized / n_hosts
+            values['prev_sens_age'] = ((n_colonized - n_colonized_sandr) * (1.0 - frac_res_age) + n_colonized_sandr) / n_hosts
+            values['prev_res_age'] = ((n_colonized - n_colonized_sandr) * frac_res_age + n_colonized_sandr) / n_hosts
+
+            # By serotype and age class: [ageclass, serotype_id]
+            values['frac_res_sero_age'] = n_col[:,:,1] / n_col.sum(axis=2)
+            values['freq_sero_age'] = n_col.sum(axis=2) / n_col_age.sum(axis=1)[:,numpy.newaxis]
+
+        for name in self.names:
+            self.means[name].add(values[name])
+        self.n_col_total = self.n_col_total + n_col.sum(axis=2)
+        self.n_times += 1
+
+    def get_rows(self):
+        '''Returns a dictionary mapping summary table names to rows (without job columns).'''
+        if self.n_times == 0:
+            return dict((table_name, []) for table_name in SUMMARY_TABLES)
+
+        m = self.means
+        n_ageclasses, n_serotypes = self.n_col_total.shape
+        rows = {}
+
+        # (A job with no prevalence at any time has no overall summary)
+        rows['summary_overall'] = [] if m['prev'].get() is None else [(m['frac_res'].get(), m['prev'].get())]
+        rows['summary_by_serotype'] = [
+            (serotype_id, m['frac_res_sero'].get(serotype_id), m['prev_sero'].get(serotype_id))
+            for serotype_id in range(n_serotypes)
+        ]
+        rows['summary_by_ageclass'] = [
+            (
+                ageclass, m['frac_res_age'].get(ageclass), m['prev_age'].get(ageclass),
+                m['prev_sens_age'].get(ageclass), m['prev_res_age'].get(ageclass)
+            )
+            for ageclass in range(n_ageclasses)
+        ]
+        rows['summary_by_serotype_ageclass'] = [
+            (
+                serotype_id, ageclass,
+                m['frac_res_sero_age'].get(ageclass, serotype_id),
+                m['freq_sero_age'].get(ageclass, serotype_id),
+                int(self.n_col_total[ageclass, serotype_id])
+            )
+            for serotype_id in range(n_serotypes) for ageclass in range(n_ageclasses)
+        ]
+        return rows
+
+def write_job_summaries(db, job_columns, job_summaries):
+    '''Writes summary tables from a list of (job_id, rows by table) pairs.
+
+    Each row is prefixed with the job's job_columns values from the jobs table.
+    '''
+    if len(job_columns) > 0:
+        job_values = [row for row in db.execute('SELECT {0} FROM jobs'.format(', '.join(job_columns)))]
+        if 'job_id' in job_columns:
+            job_values = dict((row[0], row) for row in job_values)
+        else:
+            job_values = {None: job_values[0]}
+    else:
+        job_values = {None: ()}
+
+    for table_name, columns in SUMMARY_TABLES.iteritems():
+        db.execute('DROP TABLE IF EXISTS {0}'.format(table_name))
+        db.execute('CREATE TABLE {0} ({1})'.format(table_name, ', '.join(job_columns + columns)))
+        for job_id, rows in job_summaries:
+            if job_id not in job_values:
+                continue
+            db.executemany(
+                'INSERT INTO {0} VALUES ({1})'.format(table_name, ','.join(['?'] * (len(job_columns) + len(columns)))),
+                [job_values[job_id] + row for row in rows[table_name]]
+            )
+    db.commit()
 
 if __name__ == '__main__':
     main()
@@ -12,14 +12,14 @@ def main():
         sys.exit(1)
     prefix = sys.argv[1]
     
-    if not os.path.exists(os.path.join(SCRIPT_DIR, 'runr_db.sqlite')):
-        subprocess.Popen('runr init', cwd = SCRIPT_DIR, shell = True).wait()
+    jobqueue_filename = os.path.join(SCRIPT_DIR, 'pyresistance', 'src', 'jobqueue.py')
     
-    if not os.path.exists(os.path.join(SCRIPT_DIR, 'runr_output')):
-        os.makedirs(os.path.join(SCRIPT_DIR, 'runr_output'))
+    if not os.path.exists(os.path.join(SCRIPT_DIR, 'jobqueue_output')):
+        os.makedirs(os.path.join(SCRIPT_DIR, 'jobqueue_output'))
     
+    # Jobs already in the queue are not added again
     subprocess.Popen(
-        'runr add run_job.sh jobs/{}*/*/*'.format(prefix),
+        '{} add job_queue.sqlite run_job.py jobs/{}*/*/*'.format(jobqueue_filename, prefix),
         cwd = SCRIPT_DIR,
         shell = True
     ).wait()
@@ -27,7 +27,7 @@ def main():
     env = dict(os.environ)
     env['PYRESISTANCE'] = os.path.join(SCRIPT_DIR, 'pyresistance')
     subprocess.Popen(
-        'sbatch runr_go.sbatch',
+        'sbatch jobqueue_go.sbatch',
         cwd = SCRIPT_DIR,
         env = env,
         shell = True
@@ -0,0 +1,326 @@
+#!/usr/bin/env pypy
+
+import random
+import itertools
+from bisect import bisect_right
+
+TOL = 1e-10
+
+class ArrayBucket(object):
+    '''A calendar bucket stored as parallel lists of times, sequence numbers, and objects.
+
+    Entries are appended unsorted; the bucket is sorted once, when it first becomes
+    the current bucket, after which new entries are inserted in place.
+    Entries are never removed individually: an entry is live only if its sequence number
+    matches the queue's current sequence number for its object.
+    '''
+    def __init__(self):
+        self.ts = []
+        self.seqs = []
+        self.objs = []
+        self.pos = 0
+        self.is_sorted = False
+
+    def append(self, obj, t, seq):
+        if self.is_sorted:
+            # Sequence numbers only increase, so bisect_right on t keeps (t, seq) order
+            k = bisect_right(self.ts, t, self.pos)
+            self.ts.insert(k, t)
+            self.seqs.insert(k, seq)
+            self.objs.insert(k, obj)
+        else:
+            self.ts.append(t)
+            self.seqs.append(seq)
+            self.objs.append(obj)
+
+    def sort(self):
+        # Entries were appended in sequence order, so a stable sort on t
+        # is also sorted by (t, seq).
+        ts = self.ts
+        order = sorted(xrange(self.pos, len(ts)), key=ts.__getitem__)
+        self.ts = [ts[k] for k in order]
+        self.seqs = [self.seqs[k] for k in order]
+        self.objs = [self.objs[k] for k in order]
+        self.pos = 0
+        self.is_sorted = True
+
+    def skip_stale(self, obj_seq):
+        '''Advances past stale entries; returns True if a live entry remains.'''
+        if not self.is_sorted:
+            self.sort()
+        ts = self.ts
+        seqs = self.seqs
+        objs = self.objs
+        n = len(ts)
+        pos = self.pos
+        while pos < n:
+            if obj_seq.get(objs[pos]) == seqs[pos]:
+                self.pos = pos
+                return True
+            pos += 1
+        self.pos = pos
+        return False
+
+    def pop(self):
+        pos = self.pos
+        self.pos = pos + 1
+        return self.objs[pos], self.ts[pos]
+
+    def peek(self):
+        return self.objs[self.pos], self.ts[self.pos]
+
+    def n_entries(self):
+        return len(self.ts) - self.pos
+
+    def verify(self, t_min, t_max, obj_seq, obj_time):
+        n_live = 0
+        for k in xrange(self.pos, len(self.ts)):
+            obj = self.objs[k]
+            if obj_seq.get(obj) == self.seqs[k]:
+                n_live += 1
+                assert self.ts[k] >= t_min
+                assert self.ts[k] < t_max
+                assert obj_time[obj] == self.ts[k]
+            if self.is_sorted and k > self.pos:
+                assert self.ts[k] > self.ts[k-1] or self.ts[k] == self.ts[k-1] and self.seqs[k] > self.seqs[k-1]
+        return n_live
+
+    def __repr__(self):
+        return str(zip(self.ts[self.pos:], self.seqs[self.pos:], self.objs[self.pos:]))
+
+class ArrayCalendarQueue(object):
+    '''Calendar queue with array-backed buckets and lazy deletion.
+
+    Same interface as CalendarQueue. Instead of one linked-list node per event,
+    each bucket holds parallel lists of (time, sequence number, object), and the
+    queue keeps one dictionary entry per pending object mapping it to the sequence
+    number of its live entry. Updates and removals just replace or drop that mapping;
+    the superseded bucket entry is discarded when its bucket is reached.
+    '''
+    def __init__(self, t_min=0.0, bucket_width=1.0, min_bucket_width=1e-4, n_events_rescale=1000000):
+        assert bucket_width > min_bucket_width
+
+        self.t_min = t_min
+        self.t = t_min
+        self.bucket_width = bucket_width
+        self.min_bucket_width = min_bucket_width
+        self.n_events_rescale = n_events_rescale
+        self.dt_sum = 0.0
+        self.n_events = 0
+        self.cur_step = 0
+        self.cal = []
+        self.obj_seq = {}
+        self.obj_time = {}
+        self.counter = itertools.count()
+        self.size = 0
+
+    def get_time(self, obj):
+        return self.obj_time[obj]
+
+    def add(self, obj, t):
+        rescaled = False
+        if ((self.n_events + 1) % self.n_events_rescale) == 0:
+            rescaled = self.rescale()
+        if not rescaled and self.cur_step > (len(self.cal) // 2):
+            self.resize()
+
+        assert obj is not None
+        assert obj not in self.obj_seq
+
+        self.insert(obj, t)
+        self.size += 1
+
+    def insert(self, obj, t):
+        assert t >= self.t_min
+
+        step = int((t - self.t_min) / self.bucket_width)
+        assert step >= self.cur_step
+
+        seq = self.counter.next()
+        self.obj_seq[obj] = seq
+        self.obj_time[obj] = t
+        self.get_bucket(step).append(obj, t, seq)
+
+    def get_bucket(self, step):
+        cal = self.cal
+        if step >= len(cal):
+            cal.extend([None] * (step + 1 - len(cal)))
+
+        bucket = cal[step]
+        if bucket is None:
+            bucket = ArrayBucket()
+            cal[step] = bucket
+        return bucket
+
+    def remove_if_present(self, obj):
+        if obj in self.obj_seq:
+            self.remove(obj)
+
+    def remove(self, obj):
+        del self.obj_seq[obj]
+        del self.obj_time[obj]
+        self.size -= 1
+
+    def contains(self, obj):
+        return obj in self.obj_seq
+
+    def __contains__(self, obj):
+        return obj in self.obj_seq
+
+    def update(self, obj, t):
+        assert obj in self.obj_seq
+        self.insert(obj, t)
+
+    def add_or_update(self, obj, t):
+        if obj in self.obj_seq:
+            self.insert(obj, t)
+        else:
+            self.add(obj, t)
+
+    def get_step(self, t):
+        return int((t - self.t_min) / self.bucket_width)
+
+    def advance(self):
+        '''Moves cur_step forward to the first bucket with a live entry.'''
+        cal = self.cal
+        obj_seq = self.obj_seq
+        while True:
+            bucket = cal[self.cur_step]
+            if bucket is not None:
+                if bucket.skip_stale(obj_seq):
+                    return bucket
+                cal[self.cur_step] = None
+            self.cur_step += 1
+
+    def peek(self):
+        if self.size == 0:
+            return None, None
+        return self.advance().peek()
+
+    def pop(self):
+        if self.size == 0:
+            return None
+
+        obj, t = self.advance().pop()
+        assert t >= self.t
+        self.size -= 1
+        self.dt_sum += t - self.t
+        self.n_events += 1
+        self.t = t
+        del self.obj_seq[obj]
+        del self.obj_time[obj]
+
+        return obj, t
+
+    def max_step_size(self):
+        max_size = 0
+        for step in xrange(self.cur_step, len(self.cal)):
+            if self.cal[step] is not None:
+                step_size = self.cal[step].n_entries()
+                if step_size > max_size:
+                    max_size = step_size
+        return max_size
+
+    def get_bucket_stats(self):
+        '''Returns occupancy statistics for buckets from the current step onward:
+        (number of buckets, number of non-empty buckets, maximum bucket size, mean non-empty bucket size).
+        Bucket sizes include stale entries that have not yet been discarded.
+        '''
+        n_buckets = len(self.cal) - self.cur_step
+        n_occupied = 0
+        n_entries = 0
+        max_size = 0
+        for step in xrange(self.cur_step, len(self.cal)):
+            bucket = self.cal[step]
+            if bucket is not None:
+                step_size = bucket.n_entries()
+                if step_size > 0:
+                    n_occupied += 1
+                    n_entries += step_size
+                    if step_size > max_size:
+                        max_size = step_size
+        mean_size = n_entries / float(n_occupied) if n_occupied > 0 else 0.0
+        return n_buckets, n_occupied, max_size, mean_size
+
+    def get_dt_mean(self):
+        if self.n_events == 0:
+            return None
+        return self.dt_sum / self.n_events
+
+    def resize(self):
+        if self.cur_step == 0:
+            return False
+
+        self.cal = self.cal[self.cur_step:]
+        self.t_min = self.t_min + self.bucket_width * self.cur_step
+        self.cur_step = 0
+        return True
+
+    def rescale(self):
+        target_bucket_width = max(self.get_dt_mean() * 2.0, self.min_bucket_width)
+
+        self.dt_sum = 0.0
+        self.n_events = 0
+
+        if target_bucket_width > 0.5 * self.bucket_width and target_bucket_width < 2.0 * self.bucket_width:
+            return False
+
+        # Re-insert live entries in sequence order, which preserves tie-breaking order
+        # and drops all stale entries.
+        entries = sorted(self.obj_seq.iteritems(), key=lambda x: x[1])
+        obj_time = self.obj_time
+
+        self.bucket_width = target_bucket_width
+        self.t_min = self.t
+        self.cur_step = 0
+        self.cal = []
+        self.obj_seq = {}
+        self.obj_time = {}
+        self.counter = itertools.count()
+
+        for obj, seq in entries:
+            self.insert(obj, obj_time[obj])
+        del entries
+
+        return True
+
+    def verify(self):
+        size = 0
+        for i, bucket in enumerate(self.cal):
+            if i < self.cur_step:
+                assert bucket is None
+            elif bucket is not None:
+                t_min = self.t_min + self.bucket_width * i - TOL
+                t_max = self.t_min + self.bucket_width * (i + 1) + TOL
+                size += bucket.verify(t_min, t_max, self.obj_seq, self.obj_time)
+        assert self.size == size
+        assert self.size == len(self.obj_seq)
+        assert self.size == len(self.obj_time)
+
+if __name__ == '__main__':
+    cq = ArrayCalendarQueue()
+
+    t = 0.0
+    present = set()
+    for i in xrange(100000):
+        if cq.size == 0 or random.random() < 0.25:
+            cq.add(i, t + random.uniform(0.0, 40.0))
+            present.add(i)
+        elif random.random() < 0.5:
+            for j in present:
+                tnew = t + random.uniform(0.0, 40.0)
+                print 'updating', j, tnew
+                cq.update(j, tnew)
+                break
+        elif random.random() < 0.5:
+            for j in present:
+                print 'removing', j
+                cq.remove(j)
+                present.remove(j)
+                break
+        else:
+            obj, t = cq.pop()
+            print 'popped', obj, t
+            present.remove(obj)
+    print cq.size
+    cq.verify()
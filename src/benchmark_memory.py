@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+'''Measures peak memory usage (as reported by get_memusage) of a model run.
+
+Each run happens in a separate process, so peak resident set sizes are independent.
+With --compare-rev, the same configuration is also run using the source code from
+a git revision (e.g., one before a memory optimization), for a before/after comparison.
+
+Example:
+    src/benchmark_memory.py experiments/base_parameters.py --burnin-years 20 --years 5 --compare-rev HEAD~1
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import shutil
+import subprocess
+import imp
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+REPO_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, '..'))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure peak memory usage of pneumo resistance model runs.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        'params_filename', metavar='<parameters-file>', nargs='?',
+        default=os.path.join(REPO_DIR, 'experiments', 'base_parameters.py'),
+        help='Python module file containing parameters as variables.'
+    )
+    parser.add_argument('--n-hosts', type=int, default=None, help='Override n_hosts.')
+    parser.add_argument('--burnin-years', type=float, default=None, help='Override demographic_burnin_time, in years.')
+    parser.add_argument('--years', type=float, default=None, help='Override t_end, in years.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed, shared by all runs.')
+    parser.add_argument('--compare-rev', metavar='<git-rev>', default=None,
+        help='Also run using the source code at this git revision.'
+    )
+    parser.add_argument('--child', metavar='<src-dir>', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    overrides = {'random_seed': args.seed}
+    if args.n_hosts is not None:
+        overrides['n_hosts'] = args.n_hosts
+    if args.burnin_years is not None:
+        overrides['demographic_burnin_years'] = args.burnin_years
+    if args.years is not None:
+        overrides['t_end_years'] = args.years
+
+    if args.child is not None:
+        result = run_model(args.child, os.path.abspath(args.params_filename), overrides)
+        sys.stdout.write('{0}\n'.format(json.dumps(result)))
+        return
+
+    results = [('working tree', run_child(SCRIPT_DIR, args, overrides))]
+    if args.compare_rev is not None:
+        rev_dir = tempfile.mkdtemp()
+        try:
+            export_revision(args.compare_rev, rev_dir)
+            results.append((args.compare_rev, run_child(os.path.join(rev_dir, 'src'), args, overrides)))
+        finally:
+            shutil.rmtree(rev_dir)
+
+    sys.stdout.write('{0:<20} {1:>16} {2:>14} {3:>12}\n'.format('source', 'peak RSS (KB)', 'wall time (s)', 'events'))
+    for name, result in results:
+        sys.stdout.write('{0:<20} {1:>16} {2:>14.1f} {3:>12}\n'.format(
+            name, result['peak_memusage'], result['walltime'], result['event_count']
+        ))
+    if len(results) == 2:
+        sys.stdout.write('peak RSS ratio (working tree / {0}): {1:.3f}\n'.format(
+            args.compare_rev, float(results[0][1]['peak_memusage']) / results[1][1]['peak_memusage']
+        ))
+
+def export_revision(rev, dst_dir):
+    '''Extracts the source and parameter files at a git revision into dst_dir.'''
+    archive = subprocess.Popen(['git', 'archive', rev, 'src', 'parameters'], stdout=subprocess.PIPE, cwd=REPO_DIR)
+    subprocess.check_call(['tar', '-x', '-C', dst_dir], stdin=archive.stdout)
+    archive.stdout.close()
+    assert archive.wait() == 0, 'git archive failed for revision {0}'.format(rev)
+
+def run_child(src_dir, args, overrides):
+    '''Runs the model in a new process using the model code in src_dir, and returns its result dictionary.'''
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', src_dir, args.params_filename, '--seed', str(args.seed)]
+    if args.n_hosts is not None:
+        cmd += ['--n-hosts', str(args.n_hosts)]
+    if args.burnin_years is not None:
+        cmd += ['--burnin-years', str(args.burnin_years)]
+    if args.years is not None:
+        cmd += ['--years', str(args.years)]
+    output = subprocess.check_output(cmd)
+    return json.loads(output.strip().split('\n')[-1])
+
+def run_model(src_dir, params_filename, overrides):
+    sys.path.insert(0, src_dir)
+    import pyresistance
+
+    p = imp.load_source('benchmark_parameters', params_filename)
+    p.random_seed = overrides['random_seed']
+    if 'n_hosts' in overrides:
+        p.n_hosts = overrides['n_hosts']
+    if 'demographic_burnin_years' in overrides:
+        p.demographic_burnin_time = overrides['demographic_burnin_years'] * p.t_year
+    if 't_end_years' in overrides:
+        p.t_end = overrides['t_end_years'] * p.t_year
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        p.db_filename = os.path.join(tmp_dir, 'output_db.sqlite')
+        p.overwrite_db = True
+        p.checkpoint_start = None
+
+        start_time = time.time()
+        model = pyresistance.Model(p, False)
+        model.run()
+        walltime = time.time() - start_time
+        model.db.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return {
+        'peak_memusage': pyresistance.get_memusage(),
+        'walltime': walltime,
+        'event_count': model.event_count
+    }
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,9 @@ import gc
 TOL = 1e-10
 
 class StepList(object):
+    # Fixed attributes, no per-instance __dict__: there can be millions of these
+    __slots__ = ('first', 'last', 'size')
+    
     def __init__(self):
         self.first = None
         self.last = None
@@ -41,14 +44,6 @@ class StepList(object):
         node.next = next
         self.size += 1
     
-    def find_node(self, obj):
-        cur = self.first
-        while cur:
-            if cur.obj == obj:
-                return cur
-            cur = cur.next
-        return None
-    
     def find_insertion_point(self, node):
         cur = self.last
         while cur:
@@ -59,28 +54,18 @@ class StepList(object):
             return cur, cur.next
         return None, self.first
     
-    def add(self, obj, t, i):
-        node = Node(obj, t, i)
+    def add(self, node):
         prev, next = self.find_insertion_point(node)
         self.insert(node, prev, next)
     
-    def get_time(self, obj):
-        cur = self.first
-        while cur:
-            if cur.obj == obj:
-                return cur.t
-            cur = cur.next
-    
-    def update(self, obj, t, i):
-        node = self.find_node(obj)
+    def update(self, node, t, i):
         self.unlink(node)
         node.t = t
         node.i = i
         prev, next = self.find_insertion_point(node)
         self.insert(node, prev, next)
     
-    def remove(self, obj):
-        node = self.find_node(obj)
+    def remove(self, node):
         self.unlink(node)
     
     def pop(self):
@@ -117,10 +102,14 @@ class StepList(object):
         return str(list_rep)
 
 class Node(object):
-    def __init__(self, obj, t, i):
+    # Fixed attributes, no per-instance __dict__: one node exists per pending event
+    __slots__ = ('t', 'i', 'obj', 'step', 'next', 'prev')
+    
+    def __init__(self, obj, t, i, step):
         self.t = t
         self.i = i
         self.obj = obj
+        self.step = step
         self.next = None
         self.prev = None
 
@@ -138,14 +127,13 @@ class CalendarQueue(object):
         self.n_events = 0
         self.cur_step = 0
         self.cal = []
-        self.obj_step_dict = {}
+        self.obj_node_dict = {}
         self.obj_step_offset = 0
         self.counter = itertools.count()
         self.size = 0
     
     def get_time(self, obj):
-        step = self.obj_step_dict[obj] - self.obj_step_offset
-        return self.cal[step].get_time(obj)
+        return self.obj_node_dict[obj].t
     
     def add(self, obj, t):
         rescaled = False
@@ -155,15 +143,17 @@ class CalendarQueue(object):
             self.resize()
         
         assert obj is not None
-        assert obj not in self.obj_step_dict
+        assert obj not in self.obj_node_dict
         
         assert t >= self.t_min
         
         step = int((t - self.t_min) / self.bucket_width)
         assert step >= self.cur_step
         
-        self.obj_step_dict[obj] = step + self.obj_step_offset
-        self.get_step_list(step).add(obj, t, self.counter.next())
+        # Nodes store step + obj_step_offset, so resize() only needs to change the offset
+        node = Node(obj, t, self.counter.next(), step + self.obj_step_offset)
+        self.obj_node_dict[obj] = node
+        self.get_step_list(step).add(node)
         
         self.size += 1
     
@@ -182,33 +172,35 @@ class CalendarQueue(object):
         return None
     
     def remove_if_present(self, obj):
-        if obj in self.obj_step_dict:
+        if obj in self.obj_node_dict:
             self.remove(obj)
     
     def remove(self, obj):
-        step = self.obj_step_dict.pop(obj) - self.obj_step_offset
-        self.cal[step].remove(obj)
+        node = self.obj_node_dict.pop(obj)
+        self.cal[node.step - self.obj_step_offset].remove(node)
         self.size -= 1
     
     def contains(self, obj):
-        return obj in self.obj_step_dict
+        return obj in self.obj_node_dict
     
     def __contains__(self, obj):
-        return obj in self.obj_step_dict
+        return obj in self.obj_node_dict
     
     def update(self, obj, t):
-        assert obj in self.obj_step_dict
-        old_step = self.obj_step_dict[obj] - self.obj_step_offset
+        node = self.obj_node_dict[obj]
+        old_step = node.step - self.obj_step_offset
         new_step = self.get_step(t)
         if old_step == new_step:
-            self.cal[old_step].update(obj, t, self.counter.next())
+            self.cal[old_step].update(node, t, self.counter.next())
         else:
-            self.cal[old_step].remove(obj)
-            self.get_step_list(new_step).add(obj, t, self.counter.next())
-            self.obj_step_dict[obj] = new_step + self.obj_step_offset
+            self.cal[old_step].remove(node)
+            node.t = t
+            node.i = self.counter.next()
+            node.step = new_step + self.obj_step_offset
+            self.get_step_list(new_step).add(node)
     
     def add_or_update(self, obj, t):
-        if obj in self.obj_step_dict:
+        if obj in self.obj_node_dict:
             self.update(obj, t)
         else:
             self.add(obj, t)
@@ -247,7 +239,7 @@ class CalendarQueue(object):
                 self.dt_sum += t - self.t
                 self.n_events += 1
                 self.t = t
-                del self.obj_step_dict[obj]
+                del self.obj_node_dict[obj]
                 
                 return obj, t
     
@@ -260,6 +252,22 @@ class CalendarQueue(object):
                     max_size = step_size
         return max_size
     
+    def get_bucket_stats(self):
+        '''Returns occupancy statistics for buckets from the current step onward:
+        (number of buckets, number of non-empty buckets, maximum bucket size, mean non-empty bucket size).
+        '''
+        n_buckets = len(self.cal) - self.cur_step
+        n_occupied = 0
+        max_size = 0
+        for step in xrange(self.cur_step, len(self.cal)):
+            step_list = self.cal[step]
+            if step_list is not None and step_list.size > 0:
+                n_occupied += 1
+                if step_list.size > max_size:
+                    max_size = step_list.size
+        mean_size = self.size / float(n_occupied) if n_occupied > 0 else 0.0
+        return n_buckets, n_occupied, max_size, mean_size
+    
     def get_dt_mean(self):
         if self.n_events == 0:
             return None
@@ -289,7 +297,7 @@ class CalendarQueue(object):
         self.t_min = self.t
         self.cur_step = 0
         self.cal = []
-        self.obj_step_dict = {}
+        self.obj_node_dict = {}
         self.obj_step_offset = 0
         self.counter = itertools.count()
         self.size = 0
@@ -318,7 +326,14 @@ class CalendarQueue(object):
                     t_max = self.t_min + self.bucket_width * (i + 1) + TOL
                     size += step_list.size
                     step_list.verify(t_min, t_max)
+                    
+                    cur = step_list.first
+                    while cur:
+                        assert self.obj_node_dict[cur.obj] is cur
+                        assert cur.step - self.obj_step_offset == i
+                        cur = cur.next
         assert self.size == size
+        assert self.size == len(self.obj_node_dict)
 
 if __name__ == '__main__':
     cq = CalendarQueue()
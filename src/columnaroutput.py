@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+'''Columnar binary output: dense count arrays, one per output time, appended to flat files.
+
+A columnar output directory contains one raw binary file per array name
+(e.g., counts_by_ageclass_treatment_strain.n_colonizations.bin), holding the array for each
+output time in order, plus meta.json, which records each array's dtype and per-time shape
+and the number of complete output times.
+The files can be memory-mapped directly as arrays indexed by [time index, ...].
+
+Arrays whose per-time shape varies (the n_colonizations histograms) are stored ragged:
+meta.json records only their rank, and each output time's shape is appended as a row of
+int32 values to <name>.shapes.bin. The reader pads them to a common shape.
+'''
+
+import os
+import json
+import numpy
+
+META_FILENAME = 'meta.json'
+FORMAT_VERSION = 2
+SHAPE_DTYPE = numpy.dtype('<i4')
+
+def get_columnar_output_path(db_filename, dirname=None):
+    '''Returns the columnar output directory for a run whose SQLite output is db_filename.
+
+    A relative dirname is relative to the directory containing db_filename; the default is
+    the database filename without extension, followed by _columns.
+    '''
+    if dirname is None:
+        dirname = os.path.splitext(os.path.basename(db_filename))[0] + '_columns'
+    return os.path.join(os.path.dirname(db_filename), dirname)
+
+def get_data_filename(dirname, name):
+    return os.path.join(dirname, '{0}.bin'.format(name))
+
+def get_shapes_filename(dirname, name):
+    return os.path.join(dirname, '{0}.shapes.bin'.format(name))
+
+class ColumnarWriter(object):
+    '''Appends arrays for each output time to the files in a columnar output directory.
+
+    Each array name must be appended exactly once per output time. Data is only visible
+    to readers after flush(), which rewrites meta.json atomically, so an interrupted run
+    leaves a readable directory containing every flushed output time.
+    '''
+    def __init__(self, dirname):
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        assert not os.path.exists(os.path.join(dirname, META_FILENAME)), \
+            '{0} already contains columnar output'.format(dirname)
+
+        self.dirname = dirname
+        self.columns = {}
+        self.files = {}
+        self.shape_files = {}
+        self.n_times = 0
+        self.n_appended = {}
+        self.write_meta()
+
+    def append(self, name, array, dtype=None, ragged=False):
+        '''Appends the array for the next output time; ragged arrays may change shape over time.'''
+        if dtype is None:
+            dtype = numpy.asarray(array).dtype
+        # (tostring() writes C order regardless of memory layout)
+        array = numpy.asarray(array, dtype=dtype)
+
+        column = self.columns.get(name)
+        if column is None:
+            assert self.n_appended.get(name, 0) == self.n_times, \
+                '{0} must be appended at every output time'.format(name)
+            column = {'dtype': array.dtype.str}
+            if ragged:
+                column['rank'] = array.ndim
+                self.shape_files[name] = open(get_shapes_filename(self.dirname, name), 'wb')
+            else:
+                column['shape'] = list(array.shape)
+            self.columns[name] = column
+            self.files[name] = open(get_data_filename(self.dirname, name), 'wb')
+        else:
+            assert array.dtype.str == column['dtype'], 'Invalid dtype for {0}'.format(name)
+            if ragged:
+                assert array.ndim == column['rank'], 'Invalid rank for {0}'.format(name)
+            else:
+                assert list(array.shape) == column['shape'], 'Invalid shape for {0}'.format(name)
+        assert self.n_appended.get(name, 0) == self.n_times, '{0} appended twice'.format(name)
+
+        if ragged:
+            self.shape_files[name].write(numpy.array(array.shape, dtype=SHAPE_DTYPE).tostring())
+        self.files[name].write(array.tostring())
+        self.n_appended[name] = self.n_times + 1
+
+    def flush(self):
+        '''Completes the current output time and makes it visible to readers.'''
+        for name in self.columns.iterkeys():
+            assert self.n_appended[name] == self.n_times + 1, '{0} missing for output time'.format(name)
+            self.files[name].flush()
+        for f in self.shape_files.itervalues():
+            f.flush()
+        self.n_times += 1
+        self.write_meta()
+
+    def write_meta(self):
+        meta = {
+            'version': FORMAT_VERSION,
+            'n_times': self.n_times,
+            'columns': self.columns
+        }
+        meta_filename = os.path.join(self.dirname, META_FILENAME)
+        tmp_filename = meta_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_filename, meta_filename)
+
+    def close(self):
+        for f in self.files.itervalues():
+            f.close()
+        for f in self.shape_files.itervalues():
+            f.close()
+        self.files = {}
+        self.shape_files = {}
+
+class ColumnarReader(object):
+    '''Reads a columnar output directory; get() returns arrays indexed by [time index, ...].
+
+    Arrays with a fixed shape are read-only memory maps of the data files.
+    '''
+    def __init__(self, dirname):
+        with open(os.path.join(dirname, META_FILENAME)) as f:
+            meta = json.load(f)
+        assert meta['version'] == FORMAT_VERSION, 'Unsupported columnar output version {0}'.format(meta['version'])
+
+        self.dirname = dirname
+        self.n_times = meta['n_times']
+        self.columns = meta['columns']
+
+    def names(self):
+        return sorted(self.columns.keys())
+
+    def has(self, name):
+        return name in self.columns
+
+    def get(self, name):
+        column = self.columns[name]
+        dtype = numpy.dtype(str(column['dtype']))
+        if 'rank' in column:
+            return self.get_ragged(name, dtype, self.get_shapes(name, column['rank']))
+
+        shape = (self.n_times,) + tuple(column['shape'])
+        if numpy.prod(shape) == 0:
+            return numpy.zeros(shape, dtype=dtype)
+        return numpy.memmap(get_data_filename(self.dirname, name), dtype=dtype, mode='r', shape=shape)
+
+    def get_shapes(self, name, rank):
+        '''Returns the per-time shapes of a ragged array as a [time index, dimension] array.'''
+        shapes = numpy.fromfile(
+            get_shapes_filename(self.dirname, name), dtype=SHAPE_DTYPE, count=self.n_times * rank
+        )
+        return shapes.reshape((self.n_times, rank)).astype(int)
+
+    def get_ragged(self, name, dtype, shapes):
+        '''Loads a ragged array, padding each output time's array with zeros to the largest shape.'''
+        if len(shapes) == 0:
+            return numpy.zeros((0,), dtype=dtype)
+
+        max_shape = tuple(numpy.max(numpy.array(shapes, dtype=int), axis=0))
+        sizes = [int(numpy.prod(shape)) for shape in shapes]
+        flat = numpy.fromfile(get_data_filename(self.dirname, name), dtype=dtype, count=sum(sizes))
+
+        padded = numpy.zeros((len(shapes),) + max_shape, dtype=dtype)
+        offset = 0
+        for i, (shape, size) in enumerate(zip(shapes, sizes)):
+            padded[(i,) + tuple(slice(0, n) for n in shape)] = flat[offset:offset+size].reshape(shape)
+            offset += size
+        return padded
+
+    @property
+    def times(self):
+        return self.get('t')
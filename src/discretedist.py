@@ -3,10 +3,20 @@
 import numpy
 
 class DiscreteDistribution(object):
-    def __init__(self, rng, pdf, bin_size=None):
+    '''Draws integers 0, ..., len(pdf) - 1 with probabilities proportional to pdf.
+
+    By default, draws use a table of equal-width bins with rejection; if use_alias_table
+    is True, an AliasTable is used instead, which never rejects.
+    '''
+    def __init__(self, rng, pdf, bin_size=None, use_alias_table=False):
         self.rng = rng
         self.pdf = numpy.array(pdf)
         
+        if use_alias_table:
+            self.alias_table = AliasTable(self.pdf)
+            return
+        self.alias_table = None
+        
         if bin_size is None:
             bin_size = self.pdf.min()
         bin_size = float(bin_size)
@@ -23,6 +33,8 @@ class DiscreteDistribution(object):
             table_index += bins_per_index[i]
     
     def next_discrete(self):
+        if self.alias_table is not None:
+            return self.alias_table.draw(self.rng)
         while True:
             value = self.table[self.rng.random_integers(0, self.table.shape[0] - 1)]
             if self.rng.rand() < self.p_accept[value]:
@@ -30,3 +42,42 @@ class DiscreteDistribution(object):
     
     def next_continuous(self):
         return self.next_discrete() + self.rng.rand()
+
+class AliasTable(object):
+    '''Walker's alias method: draws integers 0, ..., len(weights) - 1 with probabilities
+    proportional to weights in constant time, using one uniform index and one coin flip.
+
+    Weights need not be normalized; zero weights are never drawn. Built in linear time
+    (Vose's algorithm).
+    '''
+    def __init__(self, weights):
+        weights = numpy.array(weights, dtype=float)
+        n = weights.shape[0]
+        total = weights.sum()
+        assert n > 0 and total > 0.0 and numpy.all(weights >= 0.0), 'Invalid alias table weights'
+        
+        # Each column i holds index i with probability prob[i], and alias[i] otherwise
+        self.n = n
+        self.prob = [1.0] * n
+        self.alias = range(n)
+        
+        scaled = (weights * (n / total)).tolist()
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while len(small) > 0 and len(large) > 0:
+            i = small.pop()
+            j = large.pop()
+            self.prob[i] = scaled[i]
+            self.alias[i] = j
+            scaled[j] = (scaled[j] + scaled[i]) - 1.0
+            if scaled[j] < 1.0:
+                small.append(j)
+            else:
+                large.append(j)
+        # Anything left over is full up to rounding error (prob and alias already i)
+    
+    def draw(self, rng):
+        i = rng.randint(self.n)
+        if rng.rand() < self.prob[i]:
+            return i
+        return self.alias[i]
@@ -10,139 +10,160 @@ def get_parent(i):
     return ((i + 1) // 2) - 1
 
 class HeapQueue(object):
+    '''Indexed binary heap ordered by (priority, insertion count).
+
+    Entries are stored in three parallel lists (priorities, counts, objects) rather than
+    as tuples, and sifting is iterative: the entry being sifted is held aside while
+    parents/children are shifted into the hole, so each moved entry costs one
+    index update and no tuples are allocated.
+    '''
     def __init__(self):
-        self.heap = []
+        self.priorities = []
+        self.counts = []
+        self.objs = []
         self.index = {}
         self.counter = itertools.count()
-    
+
     @property
     def size(self):
-        return len(self.heap)
-    
+        return len(self.objs)
+
     @property
     def next_priority(self):
-        return self.heap[0][0]
-    
+        return self.priorities[0]
+
     def get_time(self, obj):
-        loc = self.index[obj]
-        return self.heap[loc][0]
-    
+        return self.priorities[self.index[obj]]
+
     def add(self, obj, priority):
         assert obj not in self.index
-        
-        count = self.counter.next()
-        loc = len(self.heap)
-        self.index[obj] = loc
-        self.heap.append((priority, count, obj))
-        self.heapify_up(loc)
-    
+
+        self.priorities.append(priority)
+        self.counts.append(0)
+        self.objs.append(obj)
+        self.sift_up(len(self.objs) - 1, priority, self.counter.next(), obj)
+
     def add_or_update(self, obj, priority):
         if obj in self.index:
             self.update(obj, priority)
         else:
             self.add(obj, priority)
-    
+
     def remove(self, obj):
         loc = self.index[obj]
         self.remove_at_index(loc)
-    
+
     def remove_if_present(self, obj):
         if obj in self.index:
             self.remove(obj)
-    
+
     def contains(self, obj):
         return obj in self.index
-    
+
     def __contains__(self, obj):
         return obj in self.index
-    
+
     def update(self, obj, priority):
         loc = self.index[obj]
-        self.heap[loc] = (priority, self.counter.next(), obj)
-        if not self.heapify_down(loc):
-            self.heapify_up(loc)
-    
+        self.place(loc, priority, self.counter.next(), obj)
+
     def peek(self):
-        priority, count, obj = self.heap[0]
-        return obj, priority
-    
+        return self.objs[0], self.priorities[0]
+
     def pop(self):
-        priority, count, obj = self.heap[0]
+        obj = self.objs[0]
+        priority = self.priorities[0]
         self.remove_at_index(0)
         return obj, priority
-    
+
     def remove_at_index(self, loc):
-        entry = self.heap[loc]
-        last_loc = len(self.heap) - 1
-        if loc < last_loc:
-            self.swap(loc, last_loc)
-            del self.index[entry[2]]
-            del self.heap[-1]
-            if not self.heapify_down(loc):
-                self.heapify_up(loc)
-        else:
-            del self.index[entry[2]]
-            del self.heap[-1]
-        
-    
-    def swap(self, i1, i2):
-        entry1 = self.heap[i1]
-        entry2 = self.heap[i2]
-        
-        self.heap[i1] = entry2
-        self.index[entry2[2]] = i1
-        
-        self.heap[i2] = entry1
-        self.index[entry1[2]] = i2
-    
-    def heapify_down(self, loc):
-        size = len(self.heap)
-        swapped = False
-        left = get_left(loc)
-        if left < size:
-            right = get_right(loc)
-            if self.heap[left][:2] < self.heap[loc][:2]:
-                if right < size:
-                    if self.heap[left][:2] < self.heap[right][:2]:
-                        self.swap(loc, left)
-                        self.heapify_down(left)
-                        swapped = True
-                    else:
-                        self.swap(loc, right)
-                        self.heapify_down(right)
-                        swapped = True
-                else:
-                    self.swap(loc, left)
-                    self.heapify_down(left)
-                    swapped = True
-            elif right < size and self.heap[right][:2] < self.heap[loc][:2]:
-                self.swap(loc, right)
-                self.heapify_down(right)
-                swapped = True
-        return swapped
-    
-    def heapify_up(self, loc):
-        parent = get_parent(loc)
-        if parent >= 0 and self.heap[loc][:2] < self.heap[parent][:2]:
-            self.swap(parent, loc)
-            self.heapify_up(parent)
-            return True
-        return False
-    
-    def verify(self):
-        heap = self.heap
-        size = len(heap)
-        for i in range(len(heap)):
-            left = get_left(i)
-            if left < size:
-                if heap[i][:2] > heap[left][:2]:
-                    print i, left, 'screwed up', heap[i][:2], heap[left][:2]
-                assert heap[i][:2] < heap[left][:2]
-            
-            right = get_right(i)
+        del self.index[self.objs[loc]]
+
+        last_priority = self.priorities.pop()
+        last_count = self.counts.pop()
+        last_obj = self.objs.pop()
+        if loc < len(self.objs):
+            self.place(loc, last_priority, last_count, last_obj)
+
+    def place(self, loc, priority, count, obj):
+        '''Puts an entry into the hole at loc, sifting up or down as needed.'''
+        if loc > 0:
+            parent = (loc - 1) >> 1
+            parent_priority = self.priorities[parent]
+            if priority < parent_priority or priority == parent_priority and count < self.counts[parent]:
+                self.sift_up(loc, priority, count, obj)
+                return
+        self.sift_down(loc, priority, count, obj)
+
+    def sift_up(self, loc, priority, count, obj):
+        priorities = self.priorities
+        counts = self.counts
+        objs = self.objs
+        index = self.index
+
+        while loc > 0:
+            parent = (loc - 1) >> 1
+            parent_priority = priorities[parent]
+            if priority < parent_priority or priority == parent_priority and count < counts[parent]:
+                parent_obj = objs[parent]
+                priorities[loc] = parent_priority
+                counts[loc] = counts[parent]
+                objs[loc] = parent_obj
+                index[parent_obj] = loc
+                loc = parent
+            else:
+                break
+
+        priorities[loc] = priority
+        counts[loc] = count
+        objs[loc] = obj
+        index[obj] = loc
+
+    def sift_down(self, loc, priority, count, obj):
+        priorities = self.priorities
+        counts = self.counts
+        objs = self.objs
+        index = self.index
+        size = len(objs)
+
+        while True:
+            child = 2 * loc + 1
+            if child >= size:
+                break
+            right = child + 1
             if right < size:
-                if heap[i][:2] > heap[right][:2]:
-                    print i, right, 'screwed up', heap[i][:2], heap[right][:2]
-                assert heap[i][:2] < heap[right][:2]
-            
-            assert self.index[heap[i][2]] == i
+                right_priority = priorities[right]
+                child_priority = priorities[child]
+                if right_priority < child_priority or right_priority == child_priority and counts[right] < counts[child]:
+                    child = right
+            child_priority = priorities[child]
+            if child_priority < priority or child_priority == priority and counts[child] < count:
+                child_obj = objs[child]
+                priorities[loc] = child_priority
+                counts[loc] = counts[child]
+                objs[loc] = child_obj
+                index[child_obj] = loc
+                loc = child
+            else:
+                break
+
+        priorities[loc] = priority
+        counts[loc] = count
+        objs[loc] = obj
+        index[obj] = loc
+
+    def verify(self):
+        priorities = self.priorities
+        counts = self.counts
+        size = len(self.objs)
+        assert len(priorities) == size
+        assert len(counts) == size
+        assert len(self.index) == size
+        for i in range(size):
+            for child in (get_left(i), get_right(i)):
+                if child < size:
+                    if (priorities[i], counts[i]) > (priorities[child], counts[child]):
+                        print i, child, 'screwed up', (priorities[i], counts[i]), (priorities[child], counts[child])
+                    assert (priorities[i], counts[i]) < (priorities[child], counts[child])
+
+            assert self.index[self.objs[i]] == i
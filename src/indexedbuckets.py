@@ -0,0 +1,59 @@
+#!/usr/bin/env pypy
+
+class IndexedBuckets(object):
+    '''A partition of the integers 0, ..., n_items - 1 into numbered buckets.
+
+    Each bucket is a list of items; a shared positions list records where each item sits
+    in its bucket, so items can be inserted, removed (by swapping the last item into the
+    hole), and drawn uniformly at random in constant time.
+    Order within a bucket is not preserved by removal.
+    '''
+    def __init__(self, n_buckets, n_items):
+        self.buckets = [[] for i in range(n_buckets)]
+        self.item_bucket = [-1] * n_items
+        self.positions = [-1] * n_items
+
+    def add(self, bucket_id, item):
+        assert self.item_bucket[item] == -1
+        bucket = self.buckets[bucket_id]
+        self.item_bucket[item] = bucket_id
+        self.positions[item] = len(bucket)
+        bucket.append(item)
+
+    def remove(self, bucket_id, item):
+        assert self.item_bucket[item] == bucket_id
+        bucket = self.buckets[bucket_id]
+        pos = self.positions[item]
+        last_item = bucket.pop()
+        if last_item != item:
+            bucket[pos] = last_item
+            self.positions[last_item] = pos
+        self.item_bucket[item] = -1
+        self.positions[item] = -1
+
+    def move(self, from_bucket_id, to_bucket_id, item):
+        self.remove(from_bucket_id, item)
+        self.add(to_bucket_id, item)
+
+    def size(self, bucket_id):
+        return len(self.buckets[bucket_id])
+
+    def choice(self, bucket_id, rng):
+        '''Draws an item uniformly from a bucket using rng.randint (numpy RandomState).'''
+        bucket = self.buckets[bucket_id]
+        return bucket[rng.randint(len(bucket))]
+
+    def __getitem__(self, bucket_id):
+        return self.buckets[bucket_id]
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def verify(self):
+        n_items = 0
+        for bucket_id, bucket in enumerate(self.buckets):
+            for pos, item in enumerate(bucket):
+                assert self.item_bucket[item] == bucket_id
+                assert self.positions[item] == pos
+            n_items += len(bucket)
+        assert n_items == sum(1 for bucket_id in self.item_bucket if bucket_id != -1)
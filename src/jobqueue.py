@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+'''Shared on-disk job queue with leases, for running jobs with any number of workers.
+
+The queue is an SQLite database with one row per job: a working directory and a command
+to run there. Each worker process, on any node, repeatedly claims the next waiting job,
+which leases the job to it for lease_duration seconds, and runs its command, renewing the
+lease every heartbeat_interval seconds until the command exits. A job whose lease expires
+(because its worker was killed or its node lost) is returned to the queue the next time any
+worker claims a job, and is marked failed after max_attempts attempts. A job whose command
+exits with nonzero status is marked failed; `retry` returns failed jobs to the queue.
+
+Jobs may be added with a dictionary of numeric features (e.g., parameter values) that
+determine their runtime. After each job finishes, its worker fits a log-linear model of
+wall time to the features of finished jobs (and of jobs in a history table, imported
+from earlier queues), and sets the priority of each waiting job to its predicted
+log wall time, so that the longest jobs are claimed first and the sweep ends with short
+jobs rather than long ones.
+
+Instead of running a command in a subprocess, a worker may be given a function that runs jobs
+inside the worker process (see run_chunk.py), saving interpreter startup for each job. Such
+a job can't be terminated if its lease is lost, so its result is then discarded.
+
+Leases compare wall-clock times across nodes, so lease_duration should be much longer than
+heartbeat_interval plus any clock skew between nodes. The queue must be on a file system
+where SQLite locking works.
+
+    jobqueue.py add <queue-db> <command> <working-dir> [<working-dir> ...]
+    jobqueue.py go <queue-db> [<n-processes>] [--clean <filename> ...]
+    jobqueue.py status <queue-db>
+    jobqueue.py retry <queue-db>
+'''
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import socket
+import sqlite3
+import argparse
+import functools
+import threading
+import subprocess
+import multiprocessing
+import numpy
+from time import strftime, gmtime
+
+LEASE_DURATION = 600.0
+HEARTBEAT_INTERVAL = 60.0
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 1.0
+MIN_RUNTIME_SAMPLES = 5
+
+def get_time_str():
+    return strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
+
+def get_worker_id():
+    return '{0}-{1}'.format(socket.gethostname(), os.getpid())
+
+class JobQueue(object):
+    '''Connection to a job queue database; each process must use its own.'''
+    def __init__(self, filename, timeout=600.0):
+        # Transactions are managed explicitly; claims take the write lock immediately
+        self.filename = filename
+        self.timeout = timeout
+        self.db = sqlite3.connect(filename, timeout=timeout, isolation_level=None)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY,
+            working_dir TEXT UNIQUE,
+            command TEXT,
+            status TEXT,
+            worker_id TEXT,
+            lease_expiration REAL,
+            n_attempts INTEGER,
+            t_start REAL,
+            t_end REAL,
+            returncode INTEGER,
+            features TEXT,
+            priority REAL,
+            event_count INTEGER
+        )''')
+        self.db.execute('CREATE TABLE IF NOT EXISTS history (features TEXT, walltime REAL, event_count INTEGER)')
+
+    def add_job(self, working_dir, command, job_id=None, features=None):
+        '''Adds a waiting job unless one with the same working directory is already queued.
+
+        features is an optional dictionary of numeric features used to predict runtime.
+        Returns True if the job was added.
+        '''
+        cursor = self.db.execute(
+            '''INSERT OR IGNORE INTO jobs (job_id, working_dir, command, status, n_attempts, features)
+            VALUES (?, ?, ?, 'waiting', 0, ?)''',
+            [job_id, os.path.abspath(working_dir), json.dumps(command),
+                None if features is None else json.dumps(features)]
+        )
+        return cursor.rowcount == 1
+
+    def add_history(self, filename):
+        '''Imports the features, wall times and event counts of finished jobs in another queue,
+        for predicting runtimes before any jobs in this queue have finished.
+
+        Returns the number of jobs imported.
+        '''
+        old_db = sqlite3.connect(filename)
+        rows = old_db.execute(
+            '''SELECT features, t_end - t_start, event_count FROM jobs
+            WHERE status = 'done' AND features IS NOT NULL'''
+        ).fetchall()
+        old_db.close()
+        self.db.executemany('INSERT INTO history VALUES (?, ?, ?)', rows)
+        return len(rows)
+
+    def claim(self, worker_id, lease_duration=LEASE_DURATION, max_attempts=MAX_ATTEMPTS):
+        '''Leases the next waiting job to worker_id, first returning jobs with expired leases
+        to the queue.
+
+        Returns (job_id, working_dir, command), or None if no jobs are waiting.
+        '''
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute(
+                '''UPDATE jobs SET
+                    status = CASE WHEN n_attempts >= ? THEN 'failed' ELSE 'waiting' END,
+                    worker_id = NULL, lease_expiration = NULL
+                WHERE status = 'running' AND lease_expiration < ?''',
+                [max_attempts, now]
+            )
+            row = self.db.execute(
+                '''SELECT job_id, working_dir, command FROM jobs WHERE status = 'waiting'
+                ORDER BY priority DESC, job_id LIMIT 1'''
+            ).fetchone()
+            if row is not None:
+                self.db.execute(
+                    '''UPDATE jobs SET
+                        status = 'running', worker_id = ?, lease_expiration = ?,
+                        n_attempts = n_attempts + 1, t_start = ?, t_end = NULL, returncode = NULL
+                    WHERE job_id = ?''',
+                    [worker_id, now + lease_duration, now, row[0]]
+                )
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def heartbeat(self, job_id, worker_id, lease_duration=LEASE_DURATION):
+        '''Renews a lease; returns False if the job is no longer leased to worker_id.'''
+        cursor = self.db.execute(
+            '''UPDATE jobs SET lease_expiration = ?
+            WHERE job_id = ? AND worker_id = ? AND status = 'running' ''',
+            [time.time() + lease_duration, job_id, worker_id]
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id, worker_id, returncode, event_count=None):
+        '''Marks a job done (returncode 0) or failed (nonzero or None, if the command could not be run).
+
+        Returns False if the job is no longer leased to worker_id.
+        '''
+        cursor = self.db.execute(
+            '''UPDATE jobs SET
+                status = ?, worker_id = NULL, lease_expiration = NULL, t_end = ?, returncode = ?,
+                event_count = ?
+            WHERE job_id = ? AND worker_id = ? AND status = 'running' ''',
+            ['done' if returncode == 0 else 'failed', time.time(), returncode, event_count, job_id, worker_id]
+        )
+        return cursor.rowcount == 1
+
+    def update_priorities(self):
+        '''Fits a runtime model to finished jobs and sets waiting jobs' priorities to their
+        predicted log wall times.
+
+        Returns False, leaving priorities unchanged, if there are too few finished jobs.
+        '''
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            samples = self.db.execute(
+                '''SELECT features, t_end - t_start FROM jobs WHERE status = 'done' AND features IS NOT NULL
+                UNION ALL SELECT features, walltime FROM history'''
+            ).fetchall()
+            waiting = self.db.execute(
+                "SELECT job_id, features FROM jobs WHERE status = 'waiting' AND features IS NOT NULL"
+            ).fetchall()
+            updated = len(samples) >= MIN_RUNTIME_SAMPLES and len(waiting) > 0
+            if updated:
+                model = RuntimeModel(
+                    [json.loads(features) for features, walltime in samples],
+                    [walltime for features, walltime in samples]
+                )
+                self.db.executemany(
+                    'UPDATE jobs SET priority = ? WHERE job_id = ?',
+                    [(model.predict_log_walltime(json.loads(features)), job_id) for job_id, features in waiting]
+                )
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        return updated
+
+    def retry_failed(self):
+        '''Returns all failed jobs to the queue; returns the number of jobs.'''
+        return self.db.execute(
+            "UPDATE jobs SET status = 'waiting', n_attempts = 0 WHERE status = 'failed'"
+        ).rowcount
+
+    def get_status_counts(self):
+        return dict(self.db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+
+    def close(self):
+        self.db.close()
+
+class RuntimeModel(object):
+    '''Least-squares fit of log wall time to a linear function of features.
+
+    Features are standardized, and ignored if they don't vary; those missing from a job are
+    taken to be 0. Where the fit is underdetermined, the minimum-norm solution is used.
+    '''
+    def __init__(self, features_list, walltimes):
+        self.names = sorted(set(name for features in features_list for name in features))
+        x = self.get_matrix(features_list)
+        self.mean = x.mean(axis=0)
+        self.sd = x.std(axis=0)
+        # Features that don't vary carry no information; scaling them by infinity zeroes them
+        # (including any rounding error in the mean)
+        self.sd[self.sd <= 1e-9 * numpy.maximum(1.0, numpy.abs(self.mean))] = numpy.inf
+
+        x = numpy.column_stack([numpy.ones(len(features_list)), (x - self.mean) / self.sd])
+        y = numpy.log(numpy.maximum(numpy.array(walltimes, dtype=float), 1e-3))
+        self.coefficients = numpy.linalg.lstsq(x, y, rcond=-1)[0]
+
+    def get_matrix(self, features_list):
+        return numpy.array(
+            [[float(features.get(name, 0.0)) for name in self.names] for features in features_list],
+            dtype=float
+        ).reshape((len(features_list), len(self.names)))
+
+    def predict_log_walltime(self, features):
+        x = (self.get_matrix([features])[0] - self.mean) / self.sd
+        return float(self.coefficients[0] + numpy.dot(self.coefficients[1:], x))
+
+def work(queue_filename, prepare=None, get_event_count=None, run_function=None,
+        lease_duration=LEASE_DURATION, heartbeat_interval=HEARTBEAT_INTERVAL, max_attempts=MAX_ATTEMPTS):
+    '''Runs jobs from the queue until none are waiting.
+
+    If provided, prepare(working_dir) is called before each attempt at a job, e.g., to remove
+    output left by an earlier attempt, and get_event_count(working_dir) after a job succeeds,
+    to record the number of events it simulated. If run_function is provided, each job is run
+    in this process by calling run_function(working_dir, command), which returns an exit status,
+    instead of running its command in a subprocess.
+    '''
+    queue = JobQueue(queue_filename)
+    worker_id = get_worker_id()
+
+    while True:
+        job = queue.claim(worker_id, lease_duration, max_attempts)
+        if job is None:
+            break
+        job_id, working_dir, command = job
+
+        sys.stderr.write('{0}\n'.format(get_time_str()))
+        sys.stderr.write('Job {0} starting in {1}\n'.format(job_id, working_dir))
+
+        try:
+            if prepare is not None:
+                prepare(working_dir)
+            if run_function is None:
+                returncode = run_job(queue, job, worker_id, lease_duration, heartbeat_interval)
+            else:
+                returncode = run_job_in_process(queue, job, worker_id, run_function, lease_duration, heartbeat_interval)
+        except Exception as e:
+            sys.stderr.write('Job {0} could not be run: {1}\n'.format(job_id, e))
+            queue.finish(job_id, worker_id, None)
+            continue
+
+        event_count = None
+        if returncode == 0 and get_event_count is not None:
+            try:
+                event_count = get_event_count(working_dir)
+            except Exception as e:
+                sys.stderr.write('Job {0} event count could not be read: {1}\n'.format(job_id, e))
+
+        sys.stderr.write('{0}\n'.format(get_time_str()))
+        if returncode is None:
+            sys.stderr.write('Job {0} lease expired; abandoned\n'.format(job_id))
+        elif not queue.finish(job_id, worker_id, returncode, event_count):
+            sys.stderr.write('Job {0} lease expired before completion\n'.format(job_id))
+        elif returncode != 0:
+            sys.stderr.write('Job {0} failed with code {1}\n'.format(job_id, returncode))
+        else:
+            sys.stderr.write('Job {0} done\n'.format(job_id))
+            queue.update_priorities()
+
+    queue.close()
+
+def run_job(queue, job, worker_id, lease_duration, heartbeat_interval):
+    '''Runs a job's command in its working directory, renewing its lease while it runs.
+
+    Returns the command's exit status, or None if the lease was lost, in which case the
+    command is terminated.
+    '''
+    job_id, working_dir, command = job
+
+    with open(os.path.join(working_dir, 'stdout.txt'), 'w') as stdout:
+        with open(os.path.join(working_dir, 'stderr.txt'), 'w') as stderr:
+            proc = subprocess.Popen(command, stdout=stdout, stderr=stderr, cwd=working_dir)
+
+            t_heartbeat = time.time()
+            while proc.poll() is None:
+                time.sleep(min(POLL_INTERVAL, heartbeat_interval))
+                if time.time() - t_heartbeat >= heartbeat_interval:
+                    if not queue.heartbeat(job_id, worker_id, lease_duration):
+                        proc.terminate()
+                        proc.wait()
+                        return None
+                    t_heartbeat = time.time()
+
+    return proc.returncode
+
+def run_job_in_process(queue, job, worker_id, run_function, lease_duration, heartbeat_interval):
+    '''Runs a job by calling run_function(working_dir, command), renewing its lease from
+    another thread while it runs.
+
+    Returns run_function's exit status, or None if the lease was lost.
+    '''
+    job_id, working_dir, command = job
+
+    heartbeat_thread = HeartbeatThread(queue, job_id, worker_id, lease_duration, heartbeat_interval)
+    heartbeat_thread.start()
+    try:
+        returncode = run_function(working_dir, command)
+    finally:
+        heartbeat_thread.stop()
+
+    if heartbeat_thread.lease_lost:
+        return None
+    return returncode
+
+class HeartbeatThread(threading.Thread):
+    '''Renews a job's lease every heartbeat_interval seconds until stopped or the lease is lost.
+
+    SQLite connections can't be shared between threads, so the thread opens its own.
+    '''
+    def __init__(self, queue, job_id, worker_id, lease_duration, heartbeat_interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue_filename = queue.filename
+        self.queue_timeout = queue.timeout
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_duration = lease_duration
+        self.heartbeat_interval = heartbeat_interval
+        self.stopped = threading.Event()
+        self.lease_lost = False
+
+    def run(self):
+        queue = JobQueue(self.queue_filename, self.queue_timeout)
+        while not self.stopped.wait(self.heartbeat_interval):
+            if not queue.heartbeat(self.job_id, self.worker_id, self.lease_duration):
+                self.lease_lost = True
+                break
+        queue.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def go(queue_filename, n_processes, prepare=None, get_event_count=None, run_function=None, **kwargs):
+    '''Runs n_processes worker processes until no jobs are waiting.'''
+    procs = [
+        multiprocessing.Process(
+            target=work, args=[queue_filename, prepare, get_event_count, run_function], kwargs=kwargs
+        )
+        for i in range(n_processes)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+def remove_files(working_dir, filenames):
+    for filename in filenames:
+        path = os.path.join(working_dir, filename)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Shared on-disk job queue with leases',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest='action')
+
+    add_parser = subparsers.add_parser('add', help='add jobs')
+    add_parser.add_argument('queue_filename', metavar='<queue-db>')
+    add_parser.add_argument('command', metavar='<command>', help='command to run in each working directory')
+    add_parser.add_argument('working_dirs', metavar='<working-dir>', nargs='+')
+
+    go_parser = subparsers.add_parser('go', help='run workers until no jobs are waiting')
+    go_parser.add_argument('queue_filename', metavar='<queue-db>')
+    go_parser.add_argument('n_processes', metavar='<n-processes>', type=int, nargs='?', default=1)
+    go_parser.add_argument('--clean', metavar='<filename>', action='append', default=[],
+        help='file or directory to remove from the working directory before each attempt')
+    go_parser.add_argument('--lease-duration', metavar='<seconds>', type=float, default=LEASE_DURATION)
+    go_parser.add_argument('--heartbeat-interval', metavar='<seconds>', type=float, default=HEARTBEAT_INTERVAL)
+    go_parser.add_argument('--max-attempts', metavar='<n>', type=int, default=MAX_ATTEMPTS)
+
+    status_parser = subparsers.add_parser('status', help='print the number of jobs with each status')
+    status_parser.add_argument('queue_filename', metavar='<queue-db>')
+
+    retry_parser = subparsers.add_parser('retry', help='return failed jobs to the queue')
+    retry_parser.add_argument('queue_filename', metavar='<queue-db>')
+
+    args = parser.parse_args()
+
+    if args.action == 'add':
+        command = shlex.split(args.command)
+        if os.path.exists(command[0]):
+            command[0] = os.path.abspath(command[0])
+        for working_dir in args.working_dirs:
+            if not os.path.isdir(working_dir):
+                sys.stderr.write('{0} is not a directory; aborting.\n'.format(working_dir))
+                sys.exit(1)
+        queue = JobQueue(args.queue_filename)
+        queue.db.execute('BEGIN')
+        n_added = sum(queue.add_job(working_dir, command) for working_dir in args.working_dirs)
+        queue.db.execute('COMMIT')
+        sys.stderr.write('{0} jobs added.\n'.format(n_added))
+    elif args.action == 'go':
+        go(
+            args.queue_filename, args.n_processes,
+            prepare=functools.partial(remove_files, filenames=args.clean) if len(args.clean) > 0 else None,
+            lease_duration=args.lease_duration,
+            heartbeat_interval=args.heartbeat_interval,
+            max_attempts=args.max_attempts
+        )
+    elif args.action == 'status':
+        json.dump(JobQueue(args.queue_filename).get_status_counts(), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    elif args.action == 'retry':
+        sys.stderr.write('{0} jobs returned to queue.\n'.format(JobQueue(args.queue_filename).retry_failed()))
+
+if __name__ == '__main__':
+    main()
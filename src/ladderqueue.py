@@ -0,0 +1,312 @@
+#!/usr/bin/env pypy
+
+import random
+import itertools
+import heapq
+from arrayqueue import ArrayBucket
+
+class LadderQueue(object):
+    '''Two-tier event queue for event horizons spanning many orders of magnitude.
+
+    Same interface as CalendarQueue. Time is divided into windows of width
+    n_near_buckets * bucket_width. Events in the current window go into a fixed-length
+    array of fine-grained buckets (the near tier); events in later windows go into
+    one unsorted bucket per window (the far tier), stored sparsely in a dictionary,
+    with a heap of window indices to find the next occupied window.
+    When the near tier is exhausted, the next occupied window's events are
+    distributed into a fresh near tier, so empty stretches of time cost nothing.
+
+    As in ArrayCalendarQueue, updates and removals are lazy: each pending object maps to
+    the sequence number of its live entry, and superseded entries are skipped.
+    '''
+    def __init__(self, t_min=0.0, bucket_width=1.0, min_bucket_width=1e-4, n_events_rescale=1000000, n_near_buckets=4096):
+        assert bucket_width > min_bucket_width
+
+        self.t = t_min
+        self.bucket_width = bucket_width
+        self.min_bucket_width = min_bucket_width
+        self.n_events_rescale = n_events_rescale
+        self.n_near_buckets = n_near_buckets
+        self.dt_sum = 0.0
+        self.n_events = 0
+        self.obj_seq = {}
+        self.obj_time = {}
+        self.counter = itertools.count()
+        self.size = 0
+
+        self.reset_tiers(t_min)
+
+    def reset_tiers(self, t_origin):
+        self.t_origin = t_origin
+        self.window_width = self.n_near_buckets * self.bucket_width
+        self.cur_window = 0
+        self.near_t_min = t_origin
+        self.near = [None] * self.n_near_buckets
+        self.cur_step = 0
+        self.far = {}
+        self.far_heap = []
+
+    def get_time(self, obj):
+        return self.obj_time[obj]
+
+    def add(self, obj, t):
+        if ((self.n_events + 1) % self.n_events_rescale) == 0:
+            self.rescale()
+
+        assert obj is not None
+        assert obj not in self.obj_seq
+
+        self.insert(obj, t)
+        self.size += 1
+
+    def get_window(self, t):
+        return int((t - self.t_origin) / self.window_width)
+
+    def get_near_step(self, t):
+        step = int((t - self.near_t_min) / self.bucket_width)
+        if step >= self.n_near_buckets:
+            return self.n_near_buckets - 1
+        return step
+
+    def insert(self, obj, t):
+        assert t >= self.t
+
+        seq = self.counter.next()
+        self.obj_seq[obj] = seq
+        self.obj_time[obj] = t
+
+        window = self.get_window(t)
+        if window <= self.cur_window:
+            step = self.get_near_step(t)
+            assert step >= self.cur_step
+            self.get_near_bucket(step).append(obj, t, seq)
+        else:
+            bucket = self.far.get(window)
+            if bucket is None:
+                bucket = ArrayBucket()
+                self.far[window] = bucket
+                heapq.heappush(self.far_heap, window)
+            bucket.append(obj, t, seq)
+
+    def get_near_bucket(self, step):
+        bucket = self.near[step]
+        if bucket is None:
+            bucket = ArrayBucket()
+            self.near[step] = bucket
+        return bucket
+
+    def load_next_window(self):
+        '''Moves the live entries of the next occupied far window into the near tier.'''
+        window = heapq.heappop(self.far_heap)
+        far_bucket = self.far.pop(window)
+
+        self.cur_window = window
+        self.near_t_min = self.t_origin + window * self.window_width
+        self.near = [None] * self.n_near_buckets
+        self.cur_step = 0
+
+        # Far entries were appended in sequence order, so near buckets also receive them in order
+        obj_seq = self.obj_seq
+        for k in xrange(far_bucket.pos, len(far_bucket.ts)):
+            obj = far_bucket.objs[k]
+            seq = far_bucket.seqs[k]
+            if obj_seq.get(obj) == seq:
+                t = far_bucket.ts[k]
+                self.get_near_bucket(self.get_near_step(t)).append(obj, t, seq)
+
+    def remove_if_present(self, obj):
+        if obj in self.obj_seq:
+            self.remove(obj)
+
+    def remove(self, obj):
+        del self.obj_seq[obj]
+        del self.obj_time[obj]
+        self.size -= 1
+
+    def contains(self, obj):
+        return obj in self.obj_seq
+
+    def __contains__(self, obj):
+        return obj in self.obj_seq
+
+    def update(self, obj, t):
+        assert obj in self.obj_seq
+        self.insert(obj, t)
+
+    def add_or_update(self, obj, t):
+        if obj in self.obj_seq:
+            self.insert(obj, t)
+        else:
+            self.add(obj, t)
+
+    def advance(self):
+        '''Moves to the first near bucket with a live entry, loading far windows as needed.'''
+        obj_seq = self.obj_seq
+        while True:
+            near = self.near
+            while self.cur_step < self.n_near_buckets:
+                bucket = near[self.cur_step]
+                if bucket is not None:
+                    if bucket.skip_stale(obj_seq):
+                        return bucket
+                    near[self.cur_step] = None
+                self.cur_step += 1
+            self.load_next_window()
+
+    def peek(self):
+        if self.size == 0:
+            return None, None
+
+        # Search without loading a far window, so that peek() never moves the near tier
+        # past times that may still receive events.
+        obj_seq = self.obj_seq
+        for step in xrange(self.cur_step, self.n_near_buckets):
+            bucket = self.near[step]
+            if bucket is not None and bucket.skip_stale(obj_seq):
+                return bucket.peek()
+
+        for window in sorted(self.far_heap):
+            best = None
+            bucket = self.far[window]
+            for k in xrange(bucket.pos, len(bucket.ts)):
+                obj = bucket.objs[k]
+                if obj_seq.get(obj) == bucket.seqs[k]:
+                    if best is None or (bucket.ts[k], bucket.seqs[k]) < best[:2]:
+                        best = (bucket.ts[k], bucket.seqs[k], obj)
+            if best is not None:
+                return best[2], best[0]
+
+    def pop(self):
+        if self.size == 0:
+            return None
+
+        obj, t = self.advance().pop()
+        assert t >= self.t
+        self.size -= 1
+        self.dt_sum += t - self.t
+        self.n_events += 1
+        self.t = t
+        del self.obj_seq[obj]
+        del self.obj_time[obj]
+
+        return obj, t
+
+    def get_bucket_stats(self):
+        '''Returns occupancy statistics for near-tier buckets from the current step onward:
+        (number of buckets, number of non-empty buckets, maximum bucket size, mean non-empty bucket size).
+        Bucket sizes include stale entries that have not yet been discarded.
+        '''
+        n_buckets = self.n_near_buckets - self.cur_step
+        n_occupied = 0
+        n_entries = 0
+        max_size = 0
+        for step in xrange(self.cur_step, self.n_near_buckets):
+            bucket = self.near[step]
+            if bucket is not None:
+                step_size = bucket.n_entries()
+                if step_size > 0:
+                    n_occupied += 1
+                    n_entries += step_size
+                    if step_size > max_size:
+                        max_size = step_size
+        mean_size = n_entries / float(n_occupied) if n_occupied > 0 else 0.0
+        return n_buckets, n_occupied, max_size, mean_size
+
+    def get_far_stats(self):
+        '''Returns (number of far windows, number of far entries including stale ones).'''
+        return len(self.far), sum(bucket.n_entries() for bucket in self.far.itervalues())
+
+    def get_dt_mean(self):
+        if self.n_events == 0:
+            return None
+        return self.dt_sum / self.n_events
+
+    def rescale(self):
+        target_bucket_width = max(self.get_dt_mean() * 2.0, self.min_bucket_width)
+
+        self.dt_sum = 0.0
+        self.n_events = 0
+
+        if target_bucket_width > 0.5 * self.bucket_width and target_bucket_width < 2.0 * self.bucket_width:
+            return False
+
+        # Re-insert live entries in sequence order, which preserves tie-breaking order
+        # and drops all stale entries.
+        entries = sorted(self.obj_seq.iteritems(), key=lambda x: x[1])
+        obj_time = self.obj_time
+
+        self.bucket_width = target_bucket_width
+        self.reset_tiers(self.t)
+        self.obj_seq = {}
+        self.obj_time = {}
+        self.counter = itertools.count()
+
+        for obj, seq in entries:
+            self.insert(obj, obj_time[obj])
+        del entries
+
+        return True
+
+    def verify(self):
+        obj_seq = self.obj_seq
+        size = 0
+        for step, bucket in enumerate(self.near):
+            if step < self.cur_step:
+                assert bucket is None
+            elif bucket is not None:
+                for k in xrange(bucket.pos, len(bucket.ts)):
+                    obj = bucket.objs[k]
+                    if obj_seq.get(obj) == bucket.seqs[k]:
+                        size += 1
+                        t = bucket.ts[k]
+                        assert self.obj_time[obj] == t
+                        assert self.get_window(t) <= self.cur_window
+                        assert self.get_near_step(t) == step
+                    if bucket.is_sorted and k > bucket.pos:
+                        assert bucket.ts[k] > bucket.ts[k-1] or bucket.ts[k] == bucket.ts[k-1] and bucket.seqs[k] > bucket.seqs[k-1]
+
+        assert len(self.far_heap) == len(self.far)
+        for window in self.far_heap:
+            assert window > self.cur_window
+            bucket = self.far[window]
+            for k in xrange(bucket.pos, len(bucket.ts)):
+                obj = bucket.objs[k]
+                if obj_seq.get(obj) == bucket.seqs[k]:
+                    size += 1
+                    assert self.obj_time[obj] == bucket.ts[k]
+                    assert self.get_window(bucket.ts[k]) == window
+
+        assert self.size == size
+        assert self.size == len(self.obj_seq)
+        assert self.size == len(self.obj_time)
+
+if __name__ == '__main__':
+    lq = LadderQueue(n_near_buckets=16)
+
+    t = 0.0
+    present = set()
+    for i in xrange(100000):
+        if lq.size == 0 or random.random() < 0.25:
+            if random.random() < 0.1:
+                lq.add(i, t + random.uniform(0.0, 4000.0))
+            else:
+                lq.add(i, t + random.uniform(0.0, 40.0))
+            present.add(i)
+        elif random.random() < 0.5:
+            for j in present:
+                tnew = t + random.uniform(0.0, 40.0)
+                print 'updating', j, tnew
+                lq.update(j, tnew)
+                break
+        elif random.random() < 0.5:
+            for j in present:
+                print 'removing', j
+                lq.remove(j)
+                present.remove(j)
+                break
+        else:
+            obj, t = lq.pop()
+            print 'popped', obj, t
+            present.remove(obj)
+    print lq.size
+    lq.verify()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+import sqlite3
+import itertools
+import pickle
+import traceback
+import multiprocessing
+import Queue
+import numpy
+import npybuffer
+from collections import OrderedDict
+
+def configure_connection(db, journal_mode='OFF', cache_size_kib=65536):
+    '''Applies SQLite settings for bulk output writing.
+
+    journal_mode may be any SQLite journal mode; 'OFF' (no rollback journal) and 'WAL'
+    are the fastest. With 'OFF', a crash during a write can leave the database unusable,
+    which is acceptable for output that can be regenerated by rerunning the simulation.
+    '''
+    db.execute('PRAGMA journal_mode = {0}'.format(journal_mode))
+    db.execute('PRAGMA synchronous = {0}'.format('NORMAL' if journal_mode.upper() == 'WAL' else 'OFF'))
+    # Negative cache_size is in KiB rather than pages
+    db.execute('PRAGMA cache_size = -{0}'.format(int(cache_size_kib)))
+
+class OutputWriterError(Exception):
+    pass
+
+class OutputWriter(object):
+    '''Buffers rows for database tables and writes them in bulk.
+
+    Rows are written by flush(), which inserts each table's rows with a single executemany
+    and commits everything in one transaction.
+    '''
+    def __init__(self, db):
+        self.db = db
+        self.rows = OrderedDict()
+
+    def add_row(self, table_name, row):
+        self.get_table_rows(table_name).append(row)
+
+    def add_rows(self, table_name, rows):
+        self.get_table_rows(table_name).extend(rows)
+
+    def add_deferred_rows(self, table_name, rows_function, *args):
+        '''Adds the rows returned by rows_function(*args).
+
+        Here rows are built immediately; BackgroundOutputWriter builds them in its worker process.
+        '''
+        self.add_rows(table_name, rows_function(*args))
+
+    def get_table_rows(self, table_name):
+        rows = self.rows.get(table_name)
+        if rows is None:
+            rows = []
+            self.rows[table_name] = rows
+        return rows
+
+    def n_buffered_rows(self):
+        return sum(len(rows) for rows in self.rows.itervalues())
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+
+        for table_name, rows in self.rows.iteritems():
+            if len(rows) > 0:
+                self.db.executemany(
+                    'INSERT INTO {0} VALUES ({1})'.format(table_name, ','.join(['?'] * len(rows[0]))),
+                    rows
+                )
+        self.db.commit()
+        self.rows = OrderedDict()
+
+    def close(self):
+        self.flush()
+
+    def abort(self):
+        '''Discards buffered rows, e.g., after an error in the simulation.'''
+        self.rows = OrderedDict()
+
+class BackgroundOutputWriter(object):
+    '''Same interface as OutputWriter, but rows are built and written by a worker process.
+
+    The worker owns its own connection to the database. flush() pickles the buffered rows
+    and deferred row-building calls (a snapshot of their arguments) onto a bounded queue,
+    blocking only if max_queued flushes are still waiting to be written.
+    An error in the worker is raised as OutputWriterError by the next flush() or close().
+    '''
+    def __init__(self, db_filename, journal_mode='OFF', max_queued=4):
+        self.batches = []
+        self.batch_queue = multiprocessing.Queue(max_queued)
+        self.error_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=run_background_writer,
+            args=(db_filename, journal_mode, self.batch_queue, self.error_queue)
+        )
+        self.process.daemon = True
+        self.process.start()
+
+    def add_row(self, table_name, row):
+        self.batches.append((table_name, None, [row]))
+
+    def add_rows(self, table_name, rows):
+        self.batches.append((table_name, None, rows))
+
+    def add_deferred_rows(self, table_name, rows_function, *args):
+        self.batches.append((table_name, rows_function, args))
+
+    def flush(self):
+        self.check_error()
+        if len(self.batches) == 0:
+            return
+        self.batch_queue.put(pickle.dumps(self.batches, pickle.HIGHEST_PROTOCOL))
+        self.batches = []
+
+    def close(self):
+        '''Writes everything still buffered or queued and waits for the worker to exit.'''
+        self.flush()
+        self.batch_queue.put(None)
+        self.process.join()
+        self.check_error()
+        if self.process.exitcode != 0:
+            raise OutputWriterError('Output writer process exited with code {0}'.format(self.process.exitcode))
+
+    def abort(self):
+        '''Discards buffered rows and stops the worker without waiting for queued writes.'''
+        self.batches = []
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+    def check_error(self):
+        try:
+            message = self.error_queue.get_nowait()
+        except Queue.Empty:
+            if self.process.exitcode is not None and self.process.exitcode != 0:
+                raise OutputWriterError('Output writer process exited with code {0}'.format(self.process.exitcode))
+            return
+        raise OutputWriterError('Error in output writer process:\n{0}'.format(message))
+
+def run_background_writer(db_filename, journal_mode, batch_queue, error_queue):
+    '''Worker process loop for BackgroundOutputWriter.
+
+    After an error, remaining batches are consumed and discarded, so the main process
+    never blocks on a full queue.
+    '''
+    db = sqlite3.connect(db_filename)
+    configure_connection(db, journal_mode)
+    writer = OutputWriter(db)
+    failed = False
+    while True:
+        item = batch_queue.get()
+        if item is None:
+            break
+        if failed:
+            continue
+        try:
+            for table_name, rows_function, args in pickle.loads(item):
+                if rows_function is None:
+                    writer.add_rows(table_name, args)
+                else:
+                    writer.add_deferred_rows(table_name, rows_function, *args)
+            writer.flush()
+        except Exception:
+            failed = True
+            error_queue.put(traceback.format_exc())
+    db.close()
+
+
+### ROW BUILDERS FOR COUNT TABLES ###
+# Arrays are indexed by [age (or age class), in_treatment, ...], as in pyresistance.OutputCounts.
+
+def counts_by_treatment_rows(t, n_hosts, n_colonized, n_colonizations, n_colonized_by_s_and_r):
+    keys = itertools.product(range(n_hosts.shape[0]), (False, True))
+    return [
+        (t, age, in_treatment, n_hosts_i, n_colonized_i, n_colonizations_i, n_colonized_by_s_and_r_i)
+        for (age, in_treatment), n_hosts_i, n_colonized_i, n_colonizations_i, n_colonized_by_s_and_r_i in itertools.izip(
+            keys,
+            n_hosts.ravel().tolist(),
+            n_colonized.ravel().tolist(),
+            n_colonizations.ravel().tolist(),
+            n_colonized_by_s_and_r.ravel().tolist()
+        )
+    ]
+
+def counts_by_treatment_strain_rows(t, n_colonized, n_colonizations):
+    n_ages, _, n_serotypes, _ = n_colonized.shape
+    keys = itertools.product(range(n_ages), (False, True), range(n_serotypes), (False, True))
+    return [
+        (t, age, in_treatment, serotype_id, resistant, n_colonized_i, n_colonizations_i)
+        for (age, in_treatment, serotype_id, resistant), n_colonized_i, n_colonizations_i in itertools.izip(
+            keys,
+            n_colonized.ravel().tolist(),
+            n_colonizations.ravel().tolist()
+        )
+    ]
+
+def counts_by_treatment_strain_wide_rows(t, n_colonized, n_colonizations):
+    '''Rows for the wide strain table schema: one row per (age, in_treatment), with counts
+    indexed by [serotype_id, resistant] packed into .npy BLOBs (see npybuffer).'''
+    n_ages = n_colonized.shape[0]
+    return [
+        (
+            t, age, bool(in_treatment),
+            npybuffer.ndarray_to_npy_buffer(numpy.array(n_colonized[age, in_treatment], dtype=numpy.int32)),
+            npybuffer.ndarray_to_npy_buffer(numpy.array(n_colonizations[age, in_treatment], dtype=numpy.int32))
+        )
+        for age in range(n_ages) for in_treatment in (0, 1)
+    ]
+
+def counts_by_treatment_n_colonizations_rows(t, n_hosts_by_n_colonizations):
+    n_ages, _, n_n_col = n_hosts_by_n_colonizations.shape
+    keys = itertools.product(range(n_ages), (False, True), range(n_n_col))
+    return [
+        (t, age, in_treatment, n_col, n_hosts)
+        for (age, in_treatment, n_col), n_hosts in itertools.izip(keys, n_hosts_by_n_colonizations.ravel().tolist())
+    ]
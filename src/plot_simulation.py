@@ -10,6 +10,8 @@ import matplotlib
 matplotlib.use('Agg')
 matplotlib.rc('font', size=10)
 import matplotlib.pyplot as pyplot
+from columnaroutput import ColumnarReader, get_columnar_output_path
+import npybuffer
 
 def main():
     parser = argparse.ArgumentParser(
@@ -28,6 +30,10 @@ def main():
         '--job-id', metavar='<job-id>', type=int, default=None,
         help='Job ID, needed if the database contains multiple runs.'
     )
+    parser.add_argument(
+        '--columnar-dir', metavar='<directory>', default=None,
+        help='Columnar output directory; by default, located from the database filename if the run wrote columnar output.'
+    )
     parser.add_argument(
         '--n-average-years', metavar='<n-years>', type=float, default=50.0,
         help='Number of years to average over (for averaging plots).'
@@ -43,12 +49,12 @@ def main():
     args = parser.parse_args()
     
     with sqlite3.connect(args.db_filename) as db:
-        plot_all(db, args.job_id, args.plot_filename, args.n_average_years, args.n_timeseries_years, args.end_year)
+        p = get_parameters(db, args.job_id)
+        data = OutputData(db, args.job_id, get_columnar_path(args.db_filename, p, args.columnar_dir))
+        plot_all(data, p, args.plot_filename, args.n_average_years, args.n_timeseries_years, args.end_year)
 
 
-def plot_all(db, job_id, plot_filename, n_average_years, n_timeseries_years, end_year):
-    p = get_parameters(db, job_id)
-    
+def plot_all(data, p, plot_filename, n_average_years, n_timeseries_years, end_year):
     # Get age classes & construct age-class labels
     n_ageclasses = get_n_ageclasses(p)
     ageclass_labels = make_ageclass_labels(p)
@@ -60,7 +66,7 @@ def plot_all(db, job_id, plot_filename, n_average_years, n_timeseries_years, end
     
     # Get times to use for plots
     if end_year is None:
-        ts, t_indices = get_times(db, job_id)
+        ts = data.get_times()
         end_time = ts[-1]
     else:
         end_time = end_year * p.t_year
@@ -69,127 +75,207 @@ def plot_all(db, job_id, plot_filename, n_average_years, n_timeseries_years, end
     
     # Age distribution over time
     pyplot.subplot(n_rows, n_cols, 1)
-    plot_age_distribution_over_time(db, p, job_id, t_start=start_time_ts, t_end=end_time)
+    plot_age_distribution_over_time(data, p, t_start=start_time_ts, t_end=end_time)
     
     # Fraction colonized over time
     pyplot.subplot(n_rows, n_cols, 2)
-    plot_fraction_colonized_over_time(db, p, job_id, t_start=start_time_ts, t_end=end_time)
+    plot_fraction_colonized_over_time(data, p, t_start=start_time_ts, t_end=end_time)
     
     # Fraction prevalence over time
     pyplot.subplot(n_rows, n_cols, 3)
-    plot_fraction_prevalence_over_time(db, p, job_id, t_start=start_time_ts, t_end=end_time)
+    plot_fraction_prevalence_over_time(data, p, t_start=start_time_ts, t_end=end_time)
     
     # Fraction of total prevalence, by age class, averaged over time
     pyplot.subplot(n_rows, n_cols, 4)
-    plot_mean_fraction_prevalence_by_age(db, p, job_id, t_start=start_time_avg, t_end=end_time)
+    plot_mean_fraction_prevalence_by_age(data, p, t_start=start_time_avg, t_end=end_time)
     
     # Fraction colonized, by # colonizations, averaged over time
     pyplot.subplot(n_rows, n_cols, 5)
-    plot_fraction_colonized_by_n_colonizations(db, p, job_id, t_start=start_time_avg, t_end=end_time)
+    plot_fraction_colonized_by_n_colonizations(data, p, t_start=start_time_avg, t_end=end_time)
     
     # Fraction resistant, by age class, averaged over time
     pyplot.subplot(n_rows, n_cols, 6)
-    plot_fraction_resistant_by_age(db, p, job_id, t_start=start_time_avg, t_end=end_time)
+    plot_fraction_resistant_by_age(data, p, t_start=start_time_avg, t_end=end_time)
     
     # Number resistant, by age class, averaged over time
     pyplot.subplot(n_rows, n_cols, 7)
-    plot_number_resistant_by_age(db, p, job_id, t_start=start_time_avg, t_end=end_time)
+    plot_number_resistant_by_age(data, p, t_start=start_time_avg, t_end=end_time)
     
     # Fraction resistant, by serotype, averaged over time, for first 5 age classes
     for ageclass in range(min(5, n_ageclasses)):
         pyplot.subplot(n_rows, n_cols, 8 + ageclass)
-        plot_fraction_resistant_by_serotype(db, p, job_id, ageclass, ageclass_labels[ageclass], t_start=start_time_avg, t_end=end_time)
+        plot_fraction_resistant_by_serotype(data, p, ageclass, ageclass_labels[ageclass], t_start=start_time_avg, t_end=end_time)
     
     # Plots for the top 5 serotypes
     for serotype_id in range(5):
         # Fraction colonized, by age class, over time
         pyplot.subplot(n_rows, n_cols, 3 * serotype_id + 13)
-        plot_fraction_colonized_by_age_over_time(db, p, job_id, serotype_id, t_start=start_time_ts, t_end=end_time)
+        plot_fraction_colonized_by_age_over_time(data, p, serotype_id, t_start=start_time_ts, t_end=end_time)
         
         # Number colonized, by age class, over time
         pyplot.subplot(n_rows, n_cols, 3 * serotype_id + 14)
-        plot_number_colonized_by_age_over_time(db, p, job_id, serotype_id, t_start=start_time_ts, t_end=end_time)
+        plot_number_colonized_by_age_over_time(data, p, serotype_id, t_start=start_time_ts, t_end=end_time)
         
         # Fraction resistant, by age class, over time
         pyplot.subplot(n_rows, n_cols, 3 * serotype_id + 15)
-        plot_fraction_resistant_by_age_over_time(db, p, job_id, serotype_id, t_start=start_time_ts, t_end=end_time)
+        plot_fraction_resistant_by_age_over_time(data, p, serotype_id, t_start=start_time_ts, t_end=end_time)
     
     pyplot.savefig(plot_filename)
 
 
+### OUTPUT DATA ###
+
+# Key columns of each count table, in the order they index arrays (after time)
+TABLE_KEYS = {
+    'counts_by_ageclass_treatment': ('ageclass', 'in_treatment'),
+    'counts_by_ageclass_treatment_strain': ('ageclass', 'in_treatment', 'serotype_id', 'resistant'),
+    'counts_by_ageclass_treatment_n_colonizations': ('ageclass', 'in_treatment', 'n_colonizations'),
+    'counts_by_age_treatment': ('age', 'in_treatment'),
+    'counts_by_age_treatment_strain': ('age', 'in_treatment', 'serotype_id', 'resistant'),
+    'counts_by_age_treatment_n_colonizations': ('age', 'in_treatment', 'n_colonizations'),
+    'summary': (),
+    'age_distribution': ('age',)
+}
+
+class OutputData(object):
+    '''Count tables from one run as dense arrays, indexed by [time index, <key columns>].
+
+    Arrays are read from columnar output if columnar_path is given, and otherwise assembled
+    from the SQLite tables (with either strain table schema). Each array is loaded once and cached.
+    '''
+    def __init__(self, db, job_id, columnar_path=None):
+        self.db = db
+        self.job_id = job_id
+        self.reader = None if columnar_path is None else ColumnarReader(columnar_path)
+        self.arrays = {}
+        
+        if self.reader is not None:
+            self.ts = numpy.array(self.reader.times)
+        else:
+            self.ts = numpy.array([
+                row[0] for row in db.execute(
+                    'SELECT DISTINCT t FROM counts_by_ageclass_treatment {} ORDER BY t'.format(
+                        'WHERE job_id = ?' if job_id is not None else ''
+                    ),
+                    [job_id] if job_id is not None else []
+                )
+            ], dtype=float)
+    
+    def get_times(self, t_start=None, t_end=None):
+        return self.ts[self.get_time_slice(t_start, t_end)]
+    
+    def get_time_slice(self, t_start, t_end):
+        return slice(
+            0 if t_start is None else numpy.searchsorted(self.ts, t_start, side='left'),
+            len(self.ts) if t_end is None else numpy.searchsorted(self.ts, t_end, side='right')
+        )
+    
+    def get(self, table_name, column_name, t_start=None, t_end=None):
+        '''Returns counts from a table column for output times in [t_start, t_end].'''
+        key = (table_name, column_name)
+        array = self.arrays.get(key)
+        if array is None:
+            if self.reader is not None:
+                array = self.reader.get('{0}.{1}'.format(table_name, column_name))
+            else:
+                array = self.load_table_column(table_name, column_name)
+            self.arrays[key] = array
+        return array[self.get_time_slice(t_start, t_end)]
+    
+    def load_table_column(self, table_name, column_name):
+        if is_wide_strain_table(self.db, table_name):
+            return self.load_wide_strain_column(table_name, column_name)
+        
+        key_names = TABLE_KEYS[table_name]
+        rows = numpy.array(self.db.execute(
+            'SELECT t, {0} FROM {1} {2}'.format(
+                ', '.join(key_names + (column_name,)), table_name,
+                'WHERE job_id = ?' if self.job_id is not None else ''
+            ),
+            [self.job_id] if self.job_id is not None else []
+        ).fetchall(), dtype=float).reshape((-1, len(key_names) + 2))
+        
+        indices = tuple(numpy.array(rows[:,i+1], dtype=int) for i in range(len(key_names)))
+        shape = (len(self.ts),) + tuple(index.max() + 1 if index.shape[0] > 0 else 0 for index in indices)
+        array = numpy.zeros(shape, dtype=numpy.int64)
+        array[(numpy.searchsorted(self.ts, rows[:,0]),) + indices] = rows[:,-1]
+        return array
+    
+    def load_wide_strain_column(self, table_name, column_name):
+        '''Assembles counts from a wide-schema strain table, whose rows hold .npy BLOBs indexed by [serotype_id, resistant].'''
+        age_name = TABLE_KEYS[table_name][0]
+        rows = self.db.execute(
+            'SELECT t, {0}, in_treatment, {1} FROM {2} {3}'.format(
+                age_name, column_name, table_name,
+                'WHERE job_id = ?' if self.job_id is not None else ''
+            ),
+            [self.job_id] if self.job_id is not None else []
+        ).fetchall()
+        if len(rows) == 0:
+            return numpy.zeros((len(self.ts), 0, 0, 0, 0), dtype=numpy.int64)
+        
+        n_ages = max(row[1] for row in rows) + 1
+        strain_shape = npybuffer.npy_buffer_to_ndarray(rows[0][3]).shape
+        array = numpy.zeros((len(self.ts), n_ages, 2) + strain_shape, dtype=numpy.int64)
+        for t, age, in_treatment, counts in rows:
+            array[numpy.searchsorted(self.ts, t), age, int(in_treatment)] = npybuffer.npy_buffer_to_ndarray(counts)
+        return array
+
+def is_wide_strain_table(db, table_name):
+    '''True for a strain table written with strain_table_schema = 'wide' (no serotype_id column).'''
+    if not table_name.endswith('_strain'):
+        return False
+    return 'serotype_id' not in [row[1] for row in db.execute('PRAGMA table_info({0})'.format(table_name))]
+
+def get_columnar_path(db_filename, p, columnar_dir=None):
+    '''Returns the run's columnar output directory, or None if it only wrote SQLite output.'''
+    if columnar_dir is not None:
+        return columnar_dir
+    if getattr(p, 'output_format', 'sqlite') == 'sqlite':
+        return None
+    return get_columnar_output_path(db_filename, p.columnar_output_dirname)
+
+
 ### INDIVIDUAL PLOTTING FUNCTIONS ###
 
-def plot_age_distribution_over_time(db, p, job_id, t_start=None, t_end=None):
+def plot_age_distribution_over_time(data, p, t_start=None, t_end=None):
     print('plot_age_distribution_over_time')
     
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
-    
-    n_ageclasses = get_n_ageclasses(p)
-    n_hosts_by_ageclass = numpy.zeros((n_ageclasses, len(ts)), dtype=float)
-    for row in db.execute(
-        'SELECT t, ageclass, n_hosts FROM counts_by_ageclass_treatment {}'.format(
-            'WHERE job_id = ?' if job_id is not None else ''
-        ), [job_id] if job_id is not None else []
-    ):
-        try:
-            n_hosts_by_ageclass[row[1], t_indices[row[0]]] += row[2]
-        except:
-            pass
+    ts = data.get_times(t_start, t_end)
+    n_hosts_by_ageclass = get_n_hosts_by_ageclass(data, t_start, t_end)
     
     plot_stacked_area(
-        numpy.array(ts) / p.t_year,
+        ts / p.t_year,
         n_hosts_by_ageclass,
-        colors=get_colors(n_ageclasses),
+        colors=get_colors(get_n_ageclasses(p)),
         labels=make_ageclass_labels(p)
     )
     
     pyplot.xlabel('Time (y)')
     pyplot.ylabel('Number of people')
 
-def plot_fraction_colonized_over_time(db, p, job_id, t_start=None, t_end=None):
+def plot_fraction_colonized_over_time(data, p, t_start=None, t_end=None):
     print('plot_fraction_colonized_over_time')
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
+    ts = data.get_times(t_start, t_end)
     colors = get_colors(p.n_serotypes)
     
+    # [t, ageclass, in_treatment, serotype_id, resistant] -> [t, serotype_id]
+    n_colonized = data.get('counts_by_ageclass_treatment_strain', 'n_colonized', t_start, t_end).sum(axis=4).sum(axis=2).sum(axis=1)
     for serotype_id in range(p.n_serotypes):
-        frac_colonized = numpy.zeros(len(ts), dtype=float)
-        for row in db.execute(
-            'SELECT t, n_colonized FROM counts_by_ageclass_treatment_strain WHERE {} serotype_id = ?'.format(
-                'job_id = ? AND' if job_id is not None else ''
-            ),
-            [job_id, serotype_id] if job_id is not None else [serotype_id]
-        ):
-            try:
-                frac_colonized[t_indices[row[0]]] += row[1]
-            except:
-                pass
-        frac_colonized /= p.n_hosts
+        frac_colonized = n_colonized[:,serotype_id] / float(p.n_hosts)
         pyplot.plot(ts / p.t_year, frac_colonized, color=colors[serotype_id,:])
     
     pyplot.xlabel('Time (y)')
     pyplot.ylabel('Fraction of people\ncolonized with serotype')
 
-def plot_fraction_prevalence_over_time(db, p, job_id, t_start=None, t_end=None):
+def plot_fraction_prevalence_over_time(data, p, t_start=None, t_end=None):
     print('plot_fraction_prevalence_over_time')
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
-    colors = get_colors(p.n_serotypes)
+    ts = data.get_times(t_start, t_end)
     
-    frac_colonizations_by_serotype = numpy.zeros((p.n_serotypes, len(ts)), dtype=float)
-    for row in db.execute(
-        'SELECT t, serotype_id, n_colonizations FROM counts_by_ageclass_treatment_strain {}'.format(
-            'WHERE job_id = ?' if job_id is not None else ''
-        ),
-        [job_id] if job_id is not None else []
-    ):
-        t, serotype_id, n_colonizations = row
-        try:
-            ti = t_indices[t]
-            frac_colonizations_by_serotype[serotype_id, ti] += n_colonizations
-        except:
-            pass
-    
-    for ti, t in enumerate(ts):
-        frac_colonizations_by_serotype[:,ti] /= max(1.0, frac_colonizations_by_serotype[:,ti].sum())
+    # [serotype_id, t]
+    n_colonizations = data.get('counts_by_ageclass_treatment_strain', 'n_colonizations', t_start, t_end)
+    frac_colonizations_by_serotype = numpy.array(n_colonizations.sum(axis=4).sum(axis=2).sum(axis=1).T, dtype=float)
+    frac_colonizations_by_serotype /= numpy.maximum(1.0, frac_colonizations_by_serotype.sum(axis=0))
     
     plot_stacked_area(
         ts / p.t_year,
@@ -201,35 +287,18 @@ def plot_fraction_prevalence_over_time(db, p, job_id, t_start=None, t_end=None):
     pyplot.xlabel('Time (y)')
     pyplot.ylabel('Fraction of total\npneumococcal prevalence')
 
-def get_frac_col_by_ageclass_serotype(db, p, job_id, t):
-    n_ageclasses = get_n_ageclasses(p)
-    
-    frac_col_by_ageclass_serotype = numpy.zeros((n_ageclasses, p.n_serotypes), dtype=float)
-    for ageclass, serotype_id, n_colonizations in db.execute(
-        '''
-            SELECT ageclass, serotype_id, n_colonizations FROM counts_by_ageclass_treatment_strain
-            WHERE {} t = ?;
-        '''.format(
-            'job_id = ? AND' if job_id is not None else ''
-        ),
-        [job_id, t] if job_id is not None else [t]
-    ):
-        frac_col_by_ageclass_serotype[ageclass, serotype_id] += n_colonizations
-    
-    for i in range(n_ageclasses):
-        frac_col_by_ageclass_serotype[i,:] /= max(1.0, frac_col_by_ageclass_serotype[i,:].sum())
+def get_frac_col_by_ageclass_serotype(data, t_start=None, t_end=None):
+    '''Fraction of each age class's colonizations by each serotype, indexed by [t, ageclass, serotype_id].'''
+    n_colonizations = data.get('counts_by_ageclass_treatment_strain', 'n_colonizations', t_start, t_end)
+    frac_col_by_ageclass_serotype = numpy.array(n_colonizations.sum(axis=4).sum(axis=2), dtype=float)
+    frac_col_by_ageclass_serotype /= numpy.maximum(1.0, frac_col_by_ageclass_serotype.sum(axis=2))[:,:,numpy.newaxis]
     
     return frac_col_by_ageclass_serotype
 
-def plot_mean_fraction_prevalence_by_age(db, p, job_id, t_start=None, t_end=None):
+def plot_mean_fraction_prevalence_by_age(data, p, t_start=None, t_end=None):
     print('plot_mean_fraction_prevalence_by_age')
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
     
-    n_ageclasses = get_n_ageclasses(p)
-    mean_frac_col_by_ageclass_serotype = numpy.zeros((n_ageclasses, p.n_serotypes), dtype=float)
-    for t in ts:
-        mean_frac_col_by_ageclass_serotype += get_frac_col_by_ageclass_serotype(db, p, job_id, t)
-    mean_frac_col_by_ageclass_serotype /= len(ts)
+    mean_frac_col_by_ageclass_serotype = get_frac_col_by_ageclass_serotype(data, t_start, t_end).mean(axis=0)
     
     plot_stacked_bar(
         make_ageclass_labels(p),
@@ -237,38 +306,18 @@ def plot_mean_fraction_prevalence_by_age(db, p, job_id, t_start=None, t_end=None
         colors=get_colors(p.n_serotypes)
     )
 
-def get_fraction_colonized_by_n_colonizations(db, p, job_id, max_n_col, t):
-    n_hosts_by_n_colonizations = numpy.zeros(max_n_col, dtype=float)
-    for n_col, n_hosts in db.execute(
-        'SELECT n_colonizations, n_hosts FROM counts_by_ageclass_treatment_n_colonizations WHERE {} t = ?'.format(
-            'job_id = ? AND' if job_id is not None else ''
-        ),
-        [job_id, t] if job_id is not None else [t]
-    ):
-        if n_col > 0:
-            n_hosts_by_n_colonizations[n_col - 1] += n_hosts
-    
-    return n_hosts_by_n_colonizations / n_hosts_by_n_colonizations.sum()
+def get_fraction_colonized_by_n_colonizations(data, t_start=None, t_end=None):
+    '''Fraction of colonized hosts by number of colonizations, indexed by [t, n_colonizations - 1].'''
+    n_hosts = data.get('counts_by_ageclass_treatment_n_colonizations', 'n_hosts', t_start, t_end)
+    n_hosts_by_n_colonizations = numpy.array(n_hosts.sum(axis=2).sum(axis=1)[:,1:], dtype=float)
     
+    return n_hosts_by_n_colonizations / n_hosts_by_n_colonizations.sum(axis=1)[:,numpy.newaxis]
 
-def plot_fraction_colonized_by_n_colonizations(db, p, job_id, t_start=None, t_end=None):
+def plot_fraction_colonized_by_n_colonizations(data, p, t_start=None, t_end=None):
     print('plot_fraction_colonized_by_n_colonizations')
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
-    
-    max_n_col = db.execute(
-        '''
-            SELECT MAX(n_colonizations) FROM counts_by_ageclass_treatment_n_colonizations
-            WHERE {} t >= ? and t <= ?
-        '''.format(
-            'job_id = ? AND' if job_id is not None else ''
-        ),
-        [job_id, ts[0], ts[-1]] if job_id is not None else [ts[0], ts[-1]]
-    ).next()[0]
-    
-    mean_frac_col = numpy.zeros(max_n_col, dtype=float)
-    for t in ts:
-        mean_frac_col += get_fraction_colonized_by_n_colonizations(db, p, job_id, max_n_col, t)
-    mean_frac_col /= len(ts)
+    
+    mean_frac_col = get_fraction_colonized_by_n_colonizations(data, t_start, t_end).mean(axis=0)
+    max_n_col = mean_frac_col.shape[0]
     
     pyplot.bar(range(1, max_n_col + 1), mean_frac_col, align='center')
     
@@ -277,77 +326,28 @@ def plot_fraction_colonized_by_n_colonizations(db, p, job_id, t_start=None, t_en
     pyplot.ylabel('Fraction of colonized people\nat end of simulation')
     pyplot.ylim([0, 1])
 
-def get_n_hosts_by_age(db, p, job_id, ts, t_indices):
-    n_hosts_by_age = numpy.zeros((p.n_ages, len(ts)), dtype=float)
-    for t, age, n_hosts in db.execute(
-        'SELECT t, age, n_hosts FROM counts_by_age_treatment '.format(
-            'WHERE job_id = ?' if job_id is not None else ''
-        ),
-        [job_id] if job_id is not None else []
-    ):
-        try:
-            n_hosts_by_age[age, t_indices[t]] += n_hosts
-        except:
-            pass
-    
-    return n_hosts_by_age
+def get_n_hosts_by_age(data, t_start=None, t_end=None):
+    return numpy.array(data.get('counts_by_age_treatment', 'n_hosts', t_start, t_end).sum(axis=2).T, dtype=float)
 
-def get_n_hosts_by_ageclass(db, p, job_id, ts, t_indices):
-    n_ageclasses = get_n_ageclasses(p)
-    
-    n_hosts_by_ageclass = numpy.zeros((n_ageclasses, len(ts)), dtype=float)
-    for t, ageclass, n_hosts in db.execute(
-        'SELECT t, ageclass, n_hosts FROM counts_by_ageclass_treatment {}'.format(
-            'WHERE job_id = ?' if job_id is not None else ''
-        ),
-        [job_id] if job_id is not None else []
-    ):
-        try:
-            n_hosts_by_ageclass[ageclass, t_indices[t]] += n_hosts
-        except:
-            pass
-    
-    return n_hosts_by_ageclass
-
-def get_n_colonized_by_age(db, p, job_id, ts, t_indices, serotype_id):
-    n_colonized_by_age = numpy.zeros((p.n_ages, len(ts)), dtype=float)
-    for t, age, n_colonized in db.execute(
-        'SELECT t, age, n_colonized FROM counts_by_age_treatment_strain WHERE {} serotype_id = ?'.format(
-            'job_id = ? AND' if job_id is not None else ''
-        ),
-        [job_id, serotype_id] if job_id is not None else [serotype_id]
-    ):
-        try:
-            n_colonized_by_age[age, t_indices[t]] += n_colonized
-        except:
-            pass
-    
-    return n_colonized_by_age
-
-def get_n_colonized_by_ageclass(db, p, job_id, ts, t_indices, serotype_id):
-    n_ageclasses = get_n_ageclasses(p)
-    n_colonized_by_ageclass = numpy.zeros((n_ageclasses, len(ts)), dtype=float)
-    for t, ageclass, n_colonized in db.execute(
-        'SELECT t, ageclass, n_colonized FROM counts_by_ageclass_treatment_strain WHERE {} serotype_id = ?'.format(
-            'job_id = ? AND' if job_id is not None else ''
-        ),
-        [job_id, serotype_id] if job_id is not None else [serotype_id]
-    ):
-        try:
-            n_colonized_by_ageclass[ageclass, t_indices[t]] += n_colonized
-        except:
-            pass
-    
-    return n_colonized_by_ageclass
-
-def plot_fraction_colonized_by_age_over_time(db, p, job_id, serotype_id, t_start=None, t_end=None):
+def get_n_hosts_by_ageclass(data, t_start=None, t_end=None):
+    return numpy.array(data.get('counts_by_ageclass_treatment', 'n_hosts', t_start, t_end).sum(axis=2).T, dtype=float)
+
+def get_n_colonized_by_age(data, serotype_id, t_start=None, t_end=None):
+    n_colonized = data.get('counts_by_age_treatment_strain', 'n_colonized', t_start, t_end)
+    return numpy.array(n_colonized[:,:,:,serotype_id,:].sum(axis=3).sum(axis=2).T, dtype=float)
+
+def get_n_colonized_by_ageclass(data, serotype_id, t_start=None, t_end=None):
+    n_colonized = data.get('counts_by_ageclass_treatment_strain', 'n_colonized', t_start, t_end)
+    return numpy.array(n_colonized[:,:,:,serotype_id,:].sum(axis=3).sum(axis=2).T, dtype=float)
+
+def plot_fraction_colonized_by_age_over_time(data, p, serotype_id, t_start=None, t_end=None):
     n_ageclasses = get_n_ageclasses(p)
     
     print('plot_fraction_colonized_by_n_colonizations({0})'.format(serotype_id))
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
+    ts = data.get_times(t_start, t_end)
     
-    n_hosts_by_ageclass = get_n_hosts_by_ageclass(db, p, job_id, ts, t_indices)
-    n_colonized_by_ageclass = get_n_colonized_by_ageclass(db, p, job_id, ts, t_indices, serotype_id)
+    n_hosts_by_ageclass = get_n_hosts_by_ageclass(data, t_start, t_end)
+    n_colonized_by_ageclass = get_n_colonized_by_ageclass(data, serotype_id, t_start, t_end)
     
     colors = get_colors(n_ageclasses)
     for i in range(n_ageclasses):
@@ -356,13 +356,13 @@ def plot_fraction_colonized_by_age_over_time(db, p, job_id, serotype_id, t_start
     pyplot.xlabel('Time (y)')
     pyplot.ylabel('Serotype {0}:\nFraction colonized'.format(serotype_id))
 
-def plot_number_colonized_by_age_over_time(db, p, job_id, serotype_id, t_start=None, t_end=None):
+def plot_number_colonized_by_age_over_time(data, p, serotype_id, t_start=None, t_end=None):
     print('plot_number_colonized_by_age_over_time({0})'.format(serotype_id))
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
+    ts = data.get_times(t_start, t_end)
     
     n_ageclasses = get_n_ageclasses(p)
     
-    n_colonized_by_ageclass = get_n_colonized_by_ageclass(db, p, job_id, ts, t_indices, serotype_id)
+    n_colonized_by_ageclass = get_n_colonized_by_ageclass(data, serotype_id, t_start, t_end)
     
     colors = get_colors(n_ageclasses)
     for i in range(n_ageclasses):
@@ -371,46 +371,22 @@ def plot_number_colonized_by_age_over_time(db, p, job_id, serotype_id, t_start=N
     pyplot.xlabel('Time (y)')
     pyplot.ylabel('Number of people colonized'.format(serotype_id))
 
-def get_n_colonizations_by_age(db, p, job_id, ts, t_indices, serotype_id, resistant):
-    n_cols_by_age = numpy.zeros((p.n_ages, len(ts)), dtype=float)
-    for t, age, n_colonizations in db.execute(
-        'SELECT t, age, n_colonized FROM counts_by_age_treatment_strain WHERE {} serotype_id = ? AND resistant = ?'.format(
-            'job_id = ? AND' if job_id is not None else ''
-        ),
-        [job_id, serotype_id, resistant] if job_id is not None else [serotype_id, resistant]
-    ):
-        try:
-            n_cols_by_age[age, t_indices[t]] += n_colonizations
-        except:
-            pass
-    
-    return n_cols_by_age
-
-def get_n_colonizations_by_ageclass(db, p, job_id, ts, t_indices, serotype_id, resistant):
-    n_ageclasses = get_n_ageclasses(p)
-    
-    n_cols_by_ageclass = numpy.zeros((n_ageclasses, len(ts)), dtype=float)
-    for t, ageclass, n_colonizations in db.execute(
-        'SELECT t, ageclass, n_colonized FROM counts_by_ageclass_treatment_strain WHERE {} serotype_id = ? AND resistant = ?'.format(
-            'job_id = ? AND' if job_id is not None else ''
-        ),
-        [job_id, serotype_id, resistant] if job_id is not None else [serotype_id, resistant]
-    ):
-        try:
-            n_cols_by_ageclass[ageclass, t_indices[t]] += n_colonizations
-        except:
-            pass
-    
-    return n_cols_by_ageclass
-
-def plot_fraction_resistant_by_age_over_time(db, p, job_id, serotype_id, t_start=None, t_end=None):
+def get_n_colonizations_by_age(data, serotype_id, resistant, t_start=None, t_end=None):
+    n_colonized = data.get('counts_by_age_treatment_strain', 'n_colonized', t_start, t_end)
+    return numpy.array(n_colonized[:,:,:,serotype_id,resistant].sum(axis=2).T, dtype=float)
+
+def get_n_colonizations_by_ageclass(data, serotype_id, resistant, t_start=None, t_end=None):
+    n_colonized = data.get('counts_by_ageclass_treatment_strain', 'n_colonized', t_start, t_end)
+    return numpy.array(n_colonized[:,:,:,serotype_id,resistant].sum(axis=2).T, dtype=float)
+
+def plot_fraction_resistant_by_age_over_time(data, p, serotype_id, t_start=None, t_end=None):
     n_ageclasses = get_n_ageclasses(p)
     
     print('plot_fraction_resistant_by_age_over_time({0})'.format(serotype_id))
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
+    ts = data.get_times(t_start, t_end)
     
-    n_cols_by_ageclass_sensitive = get_n_colonizations_by_ageclass(db, p, job_id, ts, t_indices, serotype_id, 0)
-    n_cols_by_ageclass_resistant = get_n_colonizations_by_ageclass(db, p, job_id, ts, t_indices, serotype_id, 1)
+    n_cols_by_ageclass_sensitive = get_n_colonizations_by_ageclass(data, serotype_id, 0, t_start, t_end)
+    n_cols_by_ageclass_resistant = get_n_colonizations_by_ageclass(data, serotype_id, 1, t_start, t_end)
     
     frac_resistant_by_ageclass = n_cols_by_ageclass_resistant / numpy.maximum(1.0,
         n_cols_by_ageclass_sensitive + n_cols_by_ageclass_resistant
@@ -424,66 +400,35 @@ def plot_fraction_resistant_by_age_over_time(db, p, job_id, serotype_id, t_start
     pyplot.ylabel('Serotype {0}:\nFraction of colonizations resistant'.format(serotype_id))
     pyplot.ylim([0, 1])
 
-def get_frac_resistant_by_ageclass(db, p, job_id, t):
-    n_ageclasses = get_n_ageclasses(p)
-    
-    n_col_by_ageclass_resistance = numpy.zeros((n_ageclasses, 2), dtype=float)
-    for ageclass, n_colonizations, resistant in db.execute(
-        'SELECT ageclass, n_colonizations, resistant FROM counts_by_ageclass_treatment_strain WHERE {} t = ?'.format(
-            'job_id = ? AND' if job_id is not None else ''
-        ),
-        [job_id, t] if job_id is not None else [t]
-    ):
-        n_col_by_ageclass_resistance[ageclass, resistant] += n_colonizations
-    
-    return n_col_by_ageclass_resistance[:,1] / (n_col_by_ageclass_resistance.sum(axis=1))
+def get_n_col_by_ageclass_resistance(data, t_start=None, t_end=None):
+    '''Number of colonizations indexed by [t, ageclass, resistant].'''
+    n_colonizations = data.get('counts_by_ageclass_treatment_strain', 'n_colonizations', t_start, t_end)
+    return numpy.array(n_colonizations.sum(axis=3).sum(axis=2), dtype=float)
+
+def get_frac_resistant_by_ageclass(data, t_start=None, t_end=None):
+    '''Fraction of colonizations resistant, indexed by [t, ageclass].'''
+    n_col_by_ageclass_resistance = get_n_col_by_ageclass_resistance(data, t_start, t_end)
+    return n_col_by_ageclass_resistance[:,:,1] / n_col_by_ageclass_resistance.sum(axis=2)
 
-def plot_fraction_resistant_by_age(db, p, job_id, t_start=None, t_end=None):
+def plot_fraction_resistant_by_age(data, p, t_start=None, t_end=None):
     print('plot_fraction_resistant_by_age')
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
     
     n_ageclasses = get_n_ageclasses(p)
     
-    mean_frac_resistant_by_ageclass = numpy.zeros(n_ageclasses, dtype=float)
-    valid_ts = numpy.zeros(n_ageclasses, dtype=float)
-    for t in ts:
-        frac_res_t = get_frac_resistant_by_ageclass(db, p, job_id, t)
-        valid = numpy.logical_not(numpy.logical_or(
-            numpy.isinf(frac_res_t), numpy.isnan(frac_res_t)
-        ))
-        valid_ts += valid
-        mean_frac_resistant_by_ageclass += frac_res_t * valid
-    mean_frac_resistant_by_ageclass /= valid_ts
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean_frac_resistant_by_ageclass = mean_valid(get_frac_resistant_by_ageclass(data, t_start, t_end))
     
     pyplot.bar(range(n_ageclasses), mean_frac_resistant_by_ageclass, align='center')
     pyplot.xticks(range(n_ageclasses), make_ageclass_labels(p))
     pyplot.ylabel('Mean fraction of colonizations\nresistant by age')
     pyplot.ylim([0, 1])
-
-def get_n_col_by_ageclass_resistance(db, p, job_id, t):
-    n_ageclasses = get_n_ageclasses(p)
-    
-    n_col_by_ageclass_resistance = numpy.zeros((n_ageclasses, 2), dtype=float)
-    for ageclass, n_colonizations, resistant in db.execute(
-        'SELECT ageclass, n_colonizations, resistant FROM counts_by_ageclass_treatment_strain WHERE {} t = ?'.format(
-            'job_id = ? AND' if job_id is not None else ''
-        ),
-        [job_id, t] if job_id is not None else [t]
-    ):
-        n_col_by_ageclass_resistance[ageclass, resistant] += n_colonizations
     
-    return n_col_by_ageclass_resistance
-    
-def plot_number_resistant_by_age(db, p, job_id, t_start=None, t_end=None):
+def plot_number_resistant_by_age(data, p, t_start=None, t_end=None):
     print('plot_number_resistant_by_age')
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
     
     n_ageclasses = get_n_ageclasses(p)
     
-    mean_n_col_by_ageclass_resistance = numpy.zeros((n_ageclasses,2), dtype=float)
-    for t in ts:
-        mean_n_col_by_ageclass_resistance += get_n_col_by_ageclass_resistance(db, p, job_id, t)
-    mean_n_col_by_ageclass_resistance /= len(ts)
+    mean_n_col_by_ageclass_resistance = get_n_col_by_ageclass_resistance(data, t_start, t_end).mean(axis=0)
     
     pyplot.bar(numpy.arange(n_ageclasses) - 0.2, mean_n_col_by_ageclass_resistance[:,0], width=0.4, color='red', align='center')
     pyplot.bar(numpy.arange(n_ageclasses) + 0.2, mean_n_col_by_ageclass_resistance[:,1], width=0.4, color='blue', align='center')
@@ -491,38 +436,15 @@ def plot_number_resistant_by_age(db, p, job_id, t_start=None, t_end=None):
     pyplot.legend(['sensitive', 'resistant'])
     pyplot.ylabel('Mean number of colonizations\nby age, resistance')
     
-def plot_fraction_resistant_by_serotype(db, p, job_id, ageclass, ageclass_label, t_start=None, t_end=None):
+def plot_fraction_resistant_by_serotype(data, p, ageclass, ageclass_label, t_start=None, t_end=None):
     print('plot_fraction_resistant_by_serotype({0})'.format(ageclass_label))
-    ts, t_indices = get_times(db, job_id, t_start=t_start, t_end=t_end)
-    
-    def get_frac_resistant(t):
-        n_by_serotype_resistant = numpy.zeros((p.n_serotypes, 2), dtype=float)
-        for n_colonizations, serotype_id, resistant in db.execute(
-            '''
-                SELECT n_colonizations, serotype_id, resistant
-                FROM counts_by_ageclass_treatment_strain
-                WHERE {} t = ? AND ageclass = ?
-            '''.format(
-                'job_id = ? AND' if job_id is not None else ''
-            ),
-            [job_id, t, ageclass] if job_id is not None else [t, ageclass]
-        ):
-            n_by_serotype_resistant[serotype_id, resistant] += n_colonizations
-        return n_by_serotype_resistant[:,1] / n_by_serotype_resistant.sum(axis=1)
-    
-    mean_frac_resistant = numpy.zeros(p.n_serotypes, dtype=float)
-    valid_ts = numpy.zeros(p.n_serotypes, dtype=float)
-    for t in ts:
-        mean_frac_resistant_t = get_frac_resistant(t)
-        valid = numpy.logical_not(numpy.logical_or(
-            numpy.isinf(mean_frac_resistant_t),
-            numpy.isnan(mean_frac_resistant_t)
-        ))
-        mean_frac_resistant_t[numpy.logical_not(valid)] = 0
-        valid_ts += valid
-        mean_frac_resistant += mean_frac_resistant_t * valid
-    
-    mean_frac_resistant /= valid_ts
+    
+    # [t, serotype_id, resistant]
+    n_colonizations = data.get('counts_by_ageclass_treatment_strain', 'n_colonizations', t_start, t_end)
+    n_by_serotype_resistant = numpy.array(n_colonizations[:,ageclass,:,:,:].sum(axis=1), dtype=float)
+    
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean_frac_resistant = mean_valid(n_by_serotype_resistant[:,:,1] / n_by_serotype_resistant.sum(axis=2))
     
     pyplot.bar(numpy.arange(p.n_serotypes), mean_frac_resistant, align='center')
     
@@ -587,19 +509,10 @@ def make_ageclass_labels(p):
     
     return labels
 
-def get_times(db, job_id, t_start = None, t_end = None):
-    ts = [
-        row[0] for row in db.execute(
-            'SELECT DISTINCT t FROM counts_by_ageclass_treatment {}'.format(
-                'WHERE job_id = ?' if job_id is not None else ''
-            ), 
-            [job_id] if job_id is not None else []
-        )
-        if (t_start is None or row[0] >= t_start) and (t_end is None or row[0] <= t_end)
-    ]
-    t_indices = dict([(t, i) for i, t in enumerate(ts)])
-    
-    return numpy.array(ts), t_indices
+def mean_valid(x):
+    '''Averages over the first axis, ignoring infinite and NaN values (e.g., from dividing by zero counts).'''
+    valid = numpy.isfinite(x)
+    return numpy.where(valid, x, 0.0).sum(axis=0) / valid.sum(axis=0)
 
 def get_colors(n_colors, cmap_name='Spectral'):
     cmap = matplotlib.cm.get_cmap(cmap_name)
@@ -4,20 +4,29 @@ import argparse
 import os
 import sys
 import sqlite3
-SCRIPT_DIR = os.path.dirname(__file__)
+import shutil
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 import json
+import copy
 import random
-from discretedist import DiscreteDistribution
+from discretedist import DiscreteDistribution, AliasTable
+from indexedbuckets import IndexedBuckets
 from calqueue import CalendarQueue
+from arrayqueue import ArrayCalendarQueue
+from ladderqueue import LadderQueue
 from heapqueue import HeapQueue
+from sumtree import SumTree
 import numpy
 import time
 import inspect
-import importlib
+import imp
 import resource
 from StringIO import StringIO
 import pickle
 import npybuffer
+import outputwriter
+from outputwriter import OutputWriter, BackgroundOutputWriter, configure_connection
+from columnaroutput import ColumnarWriter, get_columnar_output_path
 from collections import OrderedDict
 from collections import deque
 
@@ -58,25 +67,40 @@ def main():
     )
     args = parser.parse_args()
 
-    if args.params_filename is None:
-        # Read from stdin
-        params = Parameters(json.load(sys.stdin, object_pairs_hook=OrderedDict))
-    else:
-        # Read from file
-        # Load Python module to use as parameters object
-        if args.params_filename.endswith('.py'):
-            # Load Python module defining parameters
-            sys.path.append(os.path.dirname(args.params_filename))
-            params = importlib.import_module(os.path.splitext(os.path.basename(args.params_filename))[0])
-        elif args.params_filename.endswith('.json'):
-            with open(args.params_filename) as f:
-                params = Parameters(json.load(f, object_pairs_hook=OrderedDict))
-        else:
-            assert False
+    params = load_parameters(args.params_filename)
 
     model = Model(params, args.dry)
     model.run()
 
+def load_parameters(params_filename=None):
+    '''Loads parameters from a JSON file, a Python module file, or (if params_filename is None)
+    JSON on standard input.
+
+    A Python module file is executed in a new module object on each call (not registered
+    in sys.modules), so each caller gets its own parameters object even when running
+    several models in one process.
+    '''
+    if params_filename is None:
+        # Read from stdin
+        return Parameters(json.load(sys.stdin, object_pairs_hook=OrderedDict))
+
+    # Read from file
+    # Load Python module to use as parameters object
+    if params_filename.endswith('.py'):
+        # Load Python module defining parameters
+        params_dir = os.path.dirname(params_filename)
+        if params_dir not in sys.path:
+            sys.path.append(params_dir)
+        params = imp.new_module(os.path.splitext(os.path.basename(params_filename))[0])
+        params.__file__ = params_filename
+        execfile(params_filename, params.__dict__)
+        return params
+    elif params_filename.endswith('.json'):
+        with open(params_filename) as f:
+            return Parameters(json.load(f, object_pairs_hook=OrderedDict))
+    else:
+        assert False, 'Invalid parameters filename {0}'.format(params_filename)
+
 
 ### MODEL CLASS ###
 
@@ -103,23 +127,50 @@ class Model(object):
         if dry:
             return
         
+        self.init_output_writer()
+        
+        # If setup fails (e.g., an invalid parameter), stop the background writer before
+        # re-raising, since the caller has no model to abort (see run_replicates.py)
+        try:
+            self.init_simulation()
+        except (Exception, SystemExit):
+            exc_info = sys.exc_info()
+            self.output_writer.abort()
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def init_simulation(self):
+        '''Sets up the event queue, hosts, and initial events.'''
+        p = self.p
+
         # Event queue for all simulation events.
         # Original implementation based on indexed priority heap;
         # new implementation an adaptive "calendar queue".
         # Indexed priority heap is somewhat more predictable w.r.t. memory but slower.
-        if hasattr(p, 'use_calendar_queue'):
-            use_calendar_queue = p.use_calendar_queue
-        else:
-            use_calendar_queue = True
-        
-        if use_calendar_queue:
+        # The array calendar queue stores buckets as flat arrays rather than linked lists.
+        # The ladder queue only buckets events in a window near the current time,
+        # keeping far-future events (birthdays, deaths, later treatments) in coarse sparse buckets.
+        if p.event_queue_type == 'calendar':
             self.event_queue = CalendarQueue(
                 t_min=-(p.demographic_burnin_time + p.n_ages * p.t_year),
                 bucket_width=1.0,
                 min_bucket_width=p.queue_min_bucket_width
             )
-        else:
+        elif p.event_queue_type == 'array_calendar':
+            self.event_queue = ArrayCalendarQueue(
+                t_min=-(p.demographic_burnin_time + p.n_ages * p.t_year),
+                bucket_width=1.0,
+                min_bucket_width=p.queue_min_bucket_width
+            )
+        elif p.event_queue_type == 'ladder':
+            self.event_queue = LadderQueue(
+                t_min=-(p.demographic_burnin_time + p.n_ages * p.t_year),
+                bucket_width=1.0,
+                min_bucket_width=p.queue_min_bucket_width
+            )
+        elif p.event_queue_type == 'heap':
             self.event_queue = HeapQueue()
+        else:
+            assert False, 'Invalid event queue type {}'.format(p.event_queue_type)
         self.event_count = 0
         self.event_counts = [0]
 
@@ -142,11 +193,42 @@ class Model(object):
         self.n_hosts_by_age[0] = p.n_hosts
         self.colonizations_by_age = numpy.zeros((p.n_ages, p.n_serotypes, 2), dtype=int)
 
-        self.hosts_by_age = []
-        for i in range(p.n_ages):
-            self.hosts_by_age.append([])
+        # Competition factor omega, indexed by a host's minimum colonizing serotype rank
+        # (HostStore.min_serotype_rank); the last entry, for uncolonized hosts, is 0
+        self.omega_by_min_serotype_rank = numpy.zeros(p.n_serotypes + 1, dtype=float)
+        if p.n_serotypes == 1:
+            self.omega_by_min_serotype_rank[0] = p.mu_max
+        else:
+            for min_serotype_rank in range(p.n_serotypes):
+                self.omega_by_min_serotype_rank[min_serotype_rank] = \
+                    p.mu_max * (1.0 - min_serotype_rank / (p.n_serotypes - 1.0))
+
+        # Host indices by age, with constant-time insertion, removal, and random choice
+        self.hosts_by_age = IndexedBuckets(p.n_ages, p.n_hosts)
         for i in range(p.n_hosts):
-            self.hosts_by_age[0].append(i)
+            self.hosts_by_age.add(0, i)
+        
+        # Continuous-time transmission (see init_transmission_propensities); None until
+        # colonization dynamics start, and for discrete-time transmission
+        self.transmission_propensities = None
+        self.transmission_propensities_changed = False
+        
+        # Source age samplers for age-assortative cotransmission, built by get_source_age_tables;
+        # None when they need rebuilding because an age class has emptied or refilled
+        self.source_age_tables = None
+        
+        # Batched aging: instead of each host having its own birthday event, a single
+        # aging event every aging_timestep ages all hosts whose birthday has passed.
+        # Hosts are binned by the aging step (modulo one year) on which their birthday falls.
+        if p.aging_timestep is not None:
+            self.n_aging_bins = int(round(p.t_year / p.aging_timestep))
+            assert abs(self.n_aging_bins * p.aging_timestep - p.t_year) < EPS * p.t_year
+            self.aging_bins = [[] for i in range(self.n_aging_bins)]
+            self.aging_t0 = -(p.demographic_burnin_time + p.n_ages * p.t_year)
+            self.aging_step = 0
+            self.last_aging_time = self.aging_t0
+        else:
+            self.aging_bins = None
         
         # Set up colonization resistance history if history_by_serotype model being used
         if p.immigration_resistance_model == 'history_by_serotype':
@@ -163,12 +245,18 @@ class Model(object):
             self.initialize_hosts_from_checkpoint()
         else:
             self.initialize_hosts()
+        
+        # Running tallies of everything written by write_output, kept up to date by host events
+        self.output_counts = OutputCounts.from_host_store(self.host_store, p.n_ages)
 
         if p.load_hosts_from_checkpoint:
             self.event_queue.add(self.initialize_loaded_host_colonizations, 0.0)
         else:
             self.event_queue.add(self.initialize_colonizations_and_immunity, 0.0)
 
+        if self.aging_bins is not None:
+            self.event_queue.add(self.do_aging, self.aging_t0 + p.aging_timestep)
+
         # Verification events: do some sanity checks on counts, etc. in order to catch new bugs
         self.event_queue.add(self.verify, -p.demographic_burnin_time)
 
@@ -189,7 +277,8 @@ class Model(object):
 
         t_offset = checkpoint_db.execute('SELECT t FROM meta').next()[0]
 
-        self.hosts = []
+        self.init_host_store()
+        n_loaded = 0
         for i, row in enumerate(checkpoint_db.execute('SELECT * FROM hosts')):
             assert i < p.n_hosts
 
@@ -204,23 +293,28 @@ class Model(object):
 
             birth_time -= t_offset
 
-            host = Host(
-                i, birth_time, lifetime, self,
+            self.hosts[i].initialize(
+                birth_time, lifetime, self,
                 treatment_times=treatment_times, colonizations=colonizations, past_colonizations=past_colonizations
             )
-            self.hosts.append(host)
+            n_loaded += 1
         checkpoint_db.close()
-        assert len(self.hosts) == p.n_hosts
+        assert n_loaded == p.n_hosts
+
+    def init_host_store(self):
+        '''Creates the host state arrays and one Host view per host index.'''
+        p = self.p
+        self.host_store = HostStore(p.n_hosts, p.n_serotypes)
+        self.hosts = [Host(i, self.host_store) for i in xrange(p.n_hosts)]
 
     def initialize_hosts(self):
         p = self.p
-        self.hosts = []
-        for i in xrange(p.n_hosts):
+        self.init_host_store()
+        for host in self.hosts:
             lifetime = self.draw_host_lifetime()
             birth_time = -p.demographic_burnin_time - self.rng.uniform(0, lifetime)
 
-            host = Host(i, birth_time, lifetime, self)
-            self.hosts.append(host)
+            host.initialize(birth_time, lifetime, self)
 
     ### SIMULATION CODE ###
     # (also see HOST CLASS below)
@@ -253,7 +347,58 @@ class Model(object):
                 sys.stderr.write('t = {0}\n'.format(t))
                 print_call(event_function, t, self, event_queue, event_function)
             event_function(t, self, event_queue, event_function)
+            if self.transmission_propensities_changed:
+                self.schedule_next_transmission(t)
+        
+        # Record run statistics (used, e.g., to predict runtimes of sweep jobs)
+        self.output_writer.add_row('run_stats', (time.time() - self.walltimes[0], self.event_count))
+        
+        # Write any rows buffered since the last output step, and wait for the writer to finish
+        self.output_writer.close()
+        if self.columnar_writer is not None:
+            self.columnar_writer.close()
     
+    def do_aging(self, t, *args):
+        '''Age all hosts whose birthday has passed since the last aging event (batched aging).
+        :param t: The current simulation time.
+        :param args: Unused arguments passed in by the event queue loop.
+        '''
+        if TRACE_CALLS:
+            print_call('Model.do_aging', self, t, *args)
+
+        p = self.p
+        self.aging_step += 1
+        bin_index = self.aging_step % self.n_aging_bins
+
+        # Birthdays in this bin fall within (t - aging_timestep, t]; hosts born since the
+        # last visit to this bin have their first birthday a year from now and are skipped.
+        # Entries for hosts that have since been reset into a different bin are dropped.
+        t_due = t + 0.5 * p.aging_timestep
+        store = self.host_store
+        kept = []
+        for host_index in self.aging_bins[bin_index]:
+            if store.aging_bin[host_index] != bin_index:
+                continue
+            kept.append(host_index)
+            next_birthday = store.birth_time[host_index] + (store.age[host_index] + 1) * p.t_year
+            if next_birthday <= t_due and next_birthday < store.death_time[host_index]:
+                self.hosts[host_index].increment_age(self)
+        self.aging_bins[bin_index] = kept
+        self.last_aging_time = t
+
+        next_time = self.aging_t0 + (self.aging_step + 1) * p.aging_timestep
+        if next_time <= p.t_end:
+            self.event_queue.add(self.do_aging, next_time)
+
+    def get_aging_bin(self, birth_time):
+        '''Get the aging bin for a host: the index, modulo one year, of the first aging step at or after its first birthday.'''
+        p = self.p
+        first_birthday = birth_time + p.t_year
+        step = int(numpy.ceil((first_birthday - self.aging_t0) / p.aging_timestep))
+        while self.aging_t0 + step * p.aging_timestep < first_birthday:
+            step += 1
+        return step % self.n_aging_bins
+
     def get_fraction_resistant(self):
         n_colonizations = float(self.colonizations_by_age.sum())
         n_resistant = float(self.colonizations_by_age[:,:,1].sum())
@@ -298,10 +443,17 @@ class Model(object):
             self.event_queue.add(self.do_colonizations_cotransmission, next_time)
     
     def do_colonizations_cotransmission_random_mixing(self, t):
-        choice_time = 0.0
+        '''Perform cotransmission for all contacts in this timestep (random mixing).
 
+        Contacts are drawn together, and the number of colonizations transmitted for each
+        contact with a colonized source and each strain is drawn from the state at the start
+        of the timestep. Contacts are then applied in order; a contact whose source or
+        target has already received a colonization in this timestep is instead redrawn from
+        the current state, so the result is distributed as if contacts were drawn one at a time.
+        '''
         p = self.p
         rng = self.rng
+        store = self.host_store
 
         assert p.ratio_foi_resistant_to_sensitive <= 1.0
         
@@ -310,16 +462,63 @@ class Model(object):
         col_rate = p.beta
         
         n_contacts = rng.poisson(col_rate * p.colonization_event_timestep * p.n_hosts)
-        for i in range(n_contacts):
-            target_index = rng.randint(p.n_hosts)
-            source_index = rng.randint(p.n_hosts - 1)
-            if source_index >= target_index:
-                source_index += 1
-            
-            target_host = self.hosts[target_index]
-            source_host = self.hosts[source_index]
+        target_indexes = rng.randint(p.n_hosts, size=n_contacts)
+        source_indexes = rng.randint(p.n_hosts - 1, size=n_contacts)
+        source_indexes[source_indexes >= target_indexes] += 1
+        
+        # Transmission counts, by strain, for contacts with colonized sources
+        n_source_col = store.n_colonizations_by_resistance[source_indexes].sum(axis=1)
+        colonized_contacts = numpy.nonzero(n_source_col > 0)[0]
+        n_transmitted = self.draw_cotransmission_counts(
+            source_indexes[colonized_contacts], target_indexes[colonized_contacts],
+            n_source_col[colonized_contacts]
+        )
+        
+        # Index into n_transmitted of each contact with any transmission
+        transmitting_rows = {}
+        for row in numpy.nonzero(n_transmitted.any(axis=2).any(axis=1))[0]:
+            transmitting_rows[int(colonized_contacts[row])] = row
+        
+        hosts = self.hosts
+        changed_hosts = set()
+        source_indexes = source_indexes.tolist()
+        target_indexes = target_indexes.tolist()
+        for i in xrange(n_contacts):
+            source_index = source_indexes[i]
+            target_index = target_indexes[i]
+            if source_index in changed_hosts or target_index in changed_hosts:
+                if self.do_single_cotransmission(hosts[source_index], hosts[target_index], t) > 0:
+                    changed_hosts.add(target_index)
+            elif i in transmitting_rows:
+                target_host = hosts[target_index]
+                counts = n_transmitted[transmitting_rows[i]]
+                serotype_id_vec, resistant_vec = counts.nonzero()
+                for j in range(serotype_id_vec.shape[0]):
+                    for k in range(counts[serotype_id_vec[j], resistant_vec[j]]):
+                        target_host.receive_colonization(serotype_id_vec[j], resistant_vec[j], t, self)
+                changed_hosts.add(target_index)
+    
+    def draw_cotransmission_counts(self, source_indexes, target_indexes, n_source_col):
+        '''Draws the number of each source's colonizations transmitted to each target, from
+        the current state, for an array of contacts.
 
-            self.do_single_cotransmission(source_host, target_host, t)
+        Each colonization is transmitted independently, with the probabilities used by
+        do_single_cotransmission.
+
+        :return: An (n_contacts, n_serotypes, 2) array of counts.
+        '''
+        p = self.p
+        store = self.host_store
+
+        prob_colonization = 1 - self.omega_by_min_serotype_rank[store.min_serotype_rank[target_indexes]]
+        prob_colonization = prob_colonization[:,None] * numpy.where(
+            store.ever_colonized[target_indexes], 1 - p.sigma, 1.0
+        )
+        prob_colonization = prob_colonization[:,:,None] * numpy.array([1.0, p.ratio_foi_resistant_to_sensitive])
+        if p.transmission_scaling == 'by_host':
+            prob_colonization /= n_source_col[:,None,None]
+
+        return self.rng.binomial(store.colonizations[source_indexes], prob_colonization)
 
     def do_colonizations_cotransmission_age_assortative(self, t):
         p = self.p
@@ -329,39 +528,59 @@ class Model(object):
         p_ir_by_serotype = self.get_p_immigration_resistant_by_serotype(t)
 
         col_rate = p.beta
-
-        #print self.n_hosts_by_age
+        
+        # Ages don't change during the colonization event, so neither do the samplers
+        source_age_tables = self.get_source_age_tables()
 
         n_contacts = rng.poisson(col_rate * p.colonization_event_timestep * p.n_hosts)
         for i in range(n_contacts):
             target_index = rng.randint(p.n_hosts)
             target_host = self.hosts[target_index]
-            if self.no_transmission[target_host.age]:
+            source_age_table = source_age_tables[target_host.age]
+            if source_age_table is None:
                 continue
 
-            # Choose source so that P(source age = j) = alpha[i, j] for target age i
+            # Choose source so that P(source age = j) is proportional to alpha[i, j] for target age i,
+            # among ages j with hosts
             while True:
-                source_age = randint_weighted(rng, p.n_ages, p = p.alpha[target_host.age,:])
-                if self.n_hosts_by_age[source_age] == 0:
-                    continue
-                source_index = self.hosts_by_age[source_age][rng.randint(len(self.hosts_by_age[source_age]))]
-                if source_index == target_index:
-                    continue
-                source_host = self.hosts[source_index]
-                break
+                source_index = self.hosts_by_age.choice(source_age_table.draw(rng), rng)
+                if source_index != target_index:
+                    break
+            source_host = self.hosts[source_index]
 
             self.do_single_cotransmission(source_host, target_host, t)
 
+    def get_source_age_tables(self):
+        '''Returns, for each target age i, an AliasTable drawing source ages j with weights
+        alpha[i, j] restricted to ages with hosts, or None if there are no possible sources.
+        
+        Tables are rebuilt only after an age class empties or refills (see adjust_age_count).
+        '''
+        if self.source_age_tables is None:
+            p = self.p
+            has_hosts = self.n_hosts_by_age > 0
+            self.source_age_tables = []
+            for age in range(p.n_ages):
+                weights = p.alpha[age,:] * has_hosts
+                if self.no_transmission[age] or weights.sum() == 0.0:
+                    self.source_age_tables.append(None)
+                else:
+                    self.source_age_tables.append(AliasTable(weights))
+        return self.source_age_tables
+
 
     def do_single_cotransmission(self, source_host, target_host, t):
+        '''Transmits colonizations from source_host to target_host; returns the number transmitted.'''
         p = self.p
         rng = self.rng
 
-        n_source_col = source_host.colonizations.sum()
+        n_received = 0
+        source_colonizations = source_host.colonizations
+        n_source_col = source_colonizations.sum()
         if n_source_col == 0:
             pass
         else:
-            serotype_id_vec, resistant_vec = source_host.colonizations.nonzero()
+            serotype_id_vec, resistant_vec = source_colonizations.nonzero()
 
             # Pre-calculate colonization probabilities
             p_col_vec = numpy.zeros(serotype_id_vec.shape[0])
@@ -375,9 +594,12 @@ class Model(object):
             # Receive colonizations with pre-calculated colonization probabilities
             # (probabilities are constant across a cotransmission event)
             for i in range(serotype_id_vec.shape[0]):
-                for j in range(source_host.colonizations[serotype_id_vec[i], resistant_vec[i]]):
+                for j in range(source_colonizations[serotype_id_vec[i], resistant_vec[i]]):
                     if rng.rand() < p_col_vec[i]:
                         target_host.receive_colonization(serotype_id_vec[i], resistant_vec[i], t, self)
+                        n_received += 1
+        
+        return n_received
     
     def do_immigration_cotransmission(self, t):
         p = self.p
@@ -406,13 +628,19 @@ class Model(object):
         p = self.p
         p_ir_by_serotype = self.get_p_immigration_resistant_by_serotype(t)
         
+        if p.vectorize_colonizations:
+            n_col_by_strain = self.do_colonizations_vectorized(p_ir_by_serotype, t)
+        
         for serotype_id in range(p.n_serotypes):
-            n_col = [None, None]
-            for resistant in (0, 1):
-                if p.use_random_mixing:
-                    n_col[resistant] = self.do_colonizations_for_strain_random_mixing(serotype_id, resistant, p_ir_by_serotype[serotype_id], t)
-                else:
-                    n_col[resistant] = self.do_colonizations_for_strain(serotype_id, resistant, p_ir_by_serotype[serotype_id], t)
+            if p.vectorize_colonizations:
+                n_col = [int(n) for n in n_col_by_strain[serotype_id]]
+            else:
+                n_col = [None, None]
+                for resistant in (0, 1):
+                    if p.use_random_mixing:
+                        n_col[resistant] = self.do_colonizations_for_strain_random_mixing(serotype_id, resistant, p_ir_by_serotype[serotype_id], t)
+                    else:
+                        n_col[resistant] = self.do_colonizations_for_strain(serotype_id, resistant, p_ir_by_serotype[serotype_id], t)
             
             if self.resistance_history is not None:
                 new_colonizations_resistant = [0] * n_col[0] + [1] * n_col[1]
@@ -521,6 +749,202 @@ class Model(object):
         
         return n_colonizations_received
 
+    def do_colonizations_vectorized(self, p_immigration_resistant_by_serotype, t):
+        '''Perform colonizations for all strains at once (independent transmission model).
+
+        Equivalent to do_colonizations_for_strain (or do_colonizations_for_strain_random_mixing)
+        for each strain in turn, except that colonization rates and the competition (omega)
+        and immunity (sigma) factors for all attempts are computed together from the state at
+        the start of the timestep. Only accepted attempts are applied, in order of strain.
+
+        :param p_immigration_resistant_by_serotype: Probability of resistance for immigrating colonizations.
+        :param t: Simulation time.
+        :return: An (n_serotypes, 2) array of the number of colonizations received for each strain.
+        '''
+        if TRACE_CALLS:
+            print_call('Model.do_colonizations_vectorized', self, p_immigration_resistant_by_serotype, t)
+
+        p = self.p
+        rng = self.rng
+        store = self.host_store
+
+        # Transmission and immigration rate factors, by serotype and resistance class
+        beta_by_resistance = p.beta * numpy.array([1.0, p.ratio_foi_resistant_to_sensitive])
+        immigration_rates = numpy.array([
+            [self.get_immigration_rate(resistant, p_ir) for resistant in (0, 1)]
+            for p_ir in p_immigration_resistant_by_serotype
+        ])
+
+        # Upper bound on the colonization rate for each strain (by age, for age-based mixing)
+        colonizations_by_age = self.colonizations_by_age
+        if p.use_random_mixing:
+            rates = beta_by_resistance * colonizations_by_age.sum(axis=0) / float(p.n_hosts - 1) + immigration_rates
+            max_rates = rates
+        else:
+            n_hosts_by_age = numpy.array(self.n_hosts_by_age, dtype=float)
+            freq = colonizations_by_age / numpy.maximum(n_hosts_by_age, 1.0)[:,None,None]
+            rates = beta_by_resistance * numpy.dot(p.alpha, freq.reshape((p.n_ages, -1))).reshape(freq.shape) \
+                + immigration_rates
+            max_rates = rates.max(axis=0)
+
+        # Draw attempts for all strains; strain index = 2 * serotype_id + resistant
+        n_attempts = rng.poisson(p.colonization_event_timestep * max_rates * p.n_hosts)
+        strain_indexes = numpy.repeat(numpy.arange(2 * p.n_serotypes), n_attempts.ravel())
+        serotype_ids = strain_indexes // 2
+        resistant = strain_indexes % 2
+        host_indexes = rng.randint(p.n_hosts, size=strain_indexes.shape[0])
+        host_colonizations = store.colonizations[host_indexes, serotype_ids, resistant]
+
+        # Remove each host's own contribution to the rate
+        if p.use_random_mixing:
+            rates_adjusted = rates[serotype_ids, resistant] \
+                - beta_by_resistance[resistant] * host_colonizations / float(p.n_hosts - 1)
+        else:
+            ages = store.age[host_indexes]
+            n_same_age = n_hosts_by_age[ages]
+            col_same_age = colonizations_by_age[ages, serotype_ids, resistant]
+            beta_alpha = p.beta * p.alpha[ages, ages]
+            rates_adjusted = rates[ages, serotype_ids, resistant] \
+                - beta_alpha * col_same_age / numpy.maximum(n_same_age, 1.0) \
+                + numpy.where(
+                    (col_same_age > 0) & (n_same_age > 1),
+                    beta_alpha * (col_same_age - host_colonizations) / numpy.maximum(n_same_age - 1.0, 1.0),
+                    0.0
+                )
+        accepted = numpy.nonzero(
+            rng.rand(strain_indexes.shape[0]) < rates_adjusted / max_rates[serotype_ids, resistant]
+        )[0]
+
+        # Probability of colonization given contact, as in Host.get_prob_colonization
+        accepted_hosts = host_indexes[accepted]
+        prob_colonization = 1.0 - self.omega_by_min_serotype_rank[store.min_serotype_rank[accepted_hosts]]
+        prob_colonization[store.ever_colonized[accepted_hosts, serotype_ids[accepted]]] *= 1.0 - p.sigma
+        accepted = accepted[rng.rand(accepted.shape[0]) < prob_colonization]
+
+        hosts = self.hosts
+        for i in accepted:
+            hosts[host_indexes[i]].receive_colonization(int(serotype_ids[i]), int(resistant[i]), t, self)
+
+        return numpy.bincount(strain_indexes[accepted], minlength=2 * p.n_serotypes).reshape((p.n_serotypes, 2))
+
+    def init_transmission_propensities(self):
+        '''Sets up continuous-time transmission (independent transmission model).
+
+        Instead of colonization events every colonization_event_timestep, single colonization
+        attempts are scheduled on the event queue at exponentially distributed intervals,
+        drawn from the total of the propensities in a SumTree, and redrawn whenever the total
+        changes. Each source group (age class, or all hosts with random mixing) and strain
+        has a transmission propensity, an upper bound on the total rate of colonization of
+        all hosts by that strain from hosts in that group; a final item holds the immigration
+        propensity, which is constant. A colonization or clearance changes one propensity.
+        do_transmission_continuous thins attempts to each target host's rate, excluding the
+        host's own colonizations from its sources. This matches
+        do_colonizations_for_strain_random_mixing. With age-based mixing, it matches
+        do_colonizations_for_strain and do_colonizations_vectorized only if
+        ratio_foi_resistant_to_sensitive is 1: they do not apply the ratio to the own-age
+        exclusion for resistant strains, but here the whole rate is scaled by it.
+        '''
+        p = self.p
+
+        self.beta_by_resistance = p.beta * numpy.array([1.0, p.ratio_foi_resistant_to_sensitive])
+        if p.use_random_mixing:
+            self.n_source_groups = 1
+        else:
+            self.n_source_groups = p.n_ages
+            # Maximum contact weight from each source age, for thinning by target age
+            self.max_alpha_by_source_age = p.alpha.max(axis=0)
+
+        self.transmission_propensities = SumTree(self.n_source_groups * p.n_serotypes * 2 + 1)
+        self.immigration_propensity_item = self.n_source_groups * p.n_serotypes * 2
+        self.transmission_propensities.update(
+            self.immigration_propensity_item, p.n_hosts * p.n_serotypes * p.immigration_rate
+        )
+        for age in range(p.n_ages):
+            for serotype_id, resistant in zip(*numpy.nonzero(self.colonizations_by_age[age])):
+                self.update_transmission_propensity(age, serotype_id, resistant)
+
+    def update_transmission_propensity(self, age, serotype_id, resistant):
+        '''Recomputes the transmission propensity for the source group containing age
+        for a strain, after a change in its colonizations or (for age-based mixing) size.'''
+        p = self.p
+
+        if p.use_random_mixing:
+            n_col = self.colonizations_by_age[:, serotype_id, resistant].sum()
+            propensity = self.beta_by_resistance[resistant] * n_col * p.n_hosts / (p.n_hosts - 1.0)
+            group = 0
+        else:
+            n_col = self.colonizations_by_age[age, serotype_id, resistant]
+            propensity = self.beta_by_resistance[resistant] * n_col * p.n_hosts \
+                * self.max_alpha_by_source_age[age] / max(self.n_hosts_by_age[age] - 1, 1)
+            group = age
+
+        self.transmission_propensities.update(
+            (group * p.n_serotypes + serotype_id) * 2 + resistant, float(propensity)
+        )
+        self.transmission_propensities_changed = True
+
+    def schedule_next_transmission(self, t):
+        '''(Re)draws the time of the next continuous-time colonization attempt.'''
+        total = self.transmission_propensities.total()
+        self.transmission_propensities_changed = False
+        if total > 0.0:
+            self.event_queue.add_or_update(
+                self.do_transmission_continuous, t + self.rng.exponential(scale = 1.0 / total)
+            )
+        else:
+            self.event_queue.remove_if_present(self.do_transmission_continuous)
+
+    def do_transmission_continuous(self, t, *args):
+        '''Performs one continuous-time colonization attempt (see init_transmission_propensities).
+        :param t: The current simulation time.
+        :param args: Unused arguments passed in by the event queue loop.
+        '''
+        if TRACE_CALLS:
+            print_call('Model.do_transmission_continuous', self, t, *args)
+
+        p = self.p
+        rng = self.rng
+        store = self.host_store
+
+        item = self.transmission_propensities.choice(rng)
+        target_index = rng.randint(p.n_hosts)
+
+        if item == self.immigration_propensity_item:
+            serotype_id = rng.randint(p.n_serotypes)
+            p_immigration_resistant = self.get_p_immigration_resistant_by_serotype(t)[serotype_id]
+            resistant = 1 if rng.rand() < p_immigration_resistant else 0
+            p_accept = 1.0
+        else:
+            group, strain_index = divmod(item, 2 * p.n_serotypes)
+            serotype_id, resistant = divmod(strain_index, 2)
+            host_colonizations = store.colonizations[target_index, serotype_id, resistant]
+            if p.use_random_mixing:
+                # Exclude the target's own colonizations from the sources
+                n_col = self.colonizations_by_age[:, serotype_id, resistant].sum()
+                p_accept = (n_col - host_colonizations) / float(n_col)
+            else:
+                age = store.age[target_index]
+                n_col = self.colonizations_by_age[group, serotype_id, resistant]
+                n_hosts_group = self.n_hosts_by_age[group]
+                p_accept = p.alpha[age, group] / self.max_alpha_by_source_age[group]
+                if age == group:
+                    # Sources in the target's own age class exclude the target
+                    if n_hosts_group > 1:
+                        p_accept *= (n_col - host_colonizations) / float(n_col)
+                    else:
+                        p_accept = 0.0
+                else:
+                    p_accept *= max(n_hosts_group - 1, 1) / float(n_hosts_group)
+
+        if rng.rand() < p_accept:
+            target_host = self.hosts[target_index]
+            if rng.rand() < target_host.get_prob_colonization(serotype_id, resistant, self):
+                target_host.receive_colonization(serotype_id, resistant, t, self)
+                if self.resistance_history is not None:
+                    self.record_resistance_history(serotype_id, resistant)
+
+        self.schedule_next_transmission(t)
+
     def get_colonization_rates_by_age(self, serotype_id, resistant, p_immigration_resistant):
         '''Get an upper bound on colonization rates for each age class for a particular strain.
 
@@ -578,7 +1002,7 @@ class Model(object):
                     p_ir_by_serotype[serotype_id] = max(min(frac_resistant, p_ir_upper), p_ir_lower)
                 
                 if (t % p.output_timestep) == 0.0:
-                    self.db.execute('INSERT INTO immigration_resistance VALUES (?,?,?,?,?)', [
+                    self.output_writer.add_row('immigration_resistance', [
                         t, serotype_id, len(self.resistance_history[serotype_id]),
                         sum(self.resistance_history[serotype_id]), p_ir_by_serotype[serotype_id]
                     ])
@@ -657,6 +1081,15 @@ class Model(object):
         :param delta: The amount to change the count by.
         '''
         self.n_hosts_by_age[age] += delta
+        
+        # Transmission propensities from an age class depend on its size
+        if self.transmission_propensities is not None and not self.p.use_random_mixing:
+            for serotype_id, resistant in zip(*numpy.nonzero(self.colonizations_by_age[age])):
+                self.update_transmission_propensity(age, serotype_id, resistant)
+        
+        # Source age samplers only include ages with hosts
+        if self.n_hosts_by_age[age] == 0 or self.n_hosts_by_age[age] == delta:
+            self.source_age_tables = None
 
     def adjust_colonizations_by_age(self, age, delta_matrix):
         '''Adjust all colonization counts at a particular age.
@@ -665,6 +1098,9 @@ class Model(object):
         :param delta_matrix: A matrix of size (n_serotypes, 2) to change the counts by.
         '''
         self.colonizations_by_age[age] += delta_matrix
+        if self.transmission_propensities is not None:
+            for serotype_id, resistant in zip(*numpy.nonzero(delta_matrix)):
+                self.update_transmission_propensity(age, serotype_id, resistant)
 
     def adjust_colonizations_by_age_strain(self, age, serotype_id, resistant, delta):
         '''Adjust the colonization count for a particular age and strain.
@@ -675,6 +1111,30 @@ class Model(object):
         :param delta: The amount to change the count by.
         '''
         self.colonizations_by_age[age, serotype_id, resistant] += delta
+        if self.transmission_propensities is not None:
+            self.update_transmission_propensity(age, serotype_id, resistant)
+
+    def adjust_output_counts_host(self, host_index, sign):
+        '''Adds (sign = 1) or removes (sign = -1) a host's current state from the output tallies.
+
+        Called with sign = -1 before, and sign = 1 after, a change to a host's age or treatment status.
+        '''
+        store = self.host_store
+        n_by_resistance = store.n_colonizations_by_resistance[host_index]
+        self.output_counts.adjust_host(
+            store.age[host_index], int(store.in_treatment[host_index]), store.colonizations[host_index],
+            n_by_resistance[0], n_by_resistance[1], sign
+        )
+
+    def adjust_output_counts_colonization(self, host_index, serotype_id, resistant, delta):
+        '''Updates the output tallies after a host gains (delta = 1) or loses (delta = -1) a colonization.'''
+        store = self.host_store
+        n_by_resistance = store.n_colonizations_by_resistance[host_index]
+        self.output_counts.adjust_colonization(
+            store.age[host_index], int(store.in_treatment[host_index]), serotype_id, resistant,
+            store.colonizations[host_index, serotype_id, resistant],
+            n_by_resistance[0], n_by_resistance[1], delta
+        )
 
 
     ### INITIALIZATION HELPER FUNCTIONS ###
@@ -687,10 +1147,11 @@ class Model(object):
         p = self.p
         rng = self.rng
 
-        for host in self.hosts:
-            host.past_colonizations = numpy.array(
-                rng.binomial(1, p.p_init_immune, size=(p.n_serotypes, 2))
-            , dtype=int)
+        # Draws are made in host order, as if drawn separately for each host
+        self.host_store.past_colonizations[:] = rng.binomial(
+            1, p.p_init_immune, size=(p.n_hosts, p.n_serotypes, 2)
+        )
+        self.host_store.ever_colonized[:] = self.host_store.past_colonizations.sum(axis=2) > 0
 
         for serotype_id in range(p.n_serotypes):
             p_colonization = p.init_prob_host_colonized[serotype_id]
@@ -723,7 +1184,13 @@ class Model(object):
         
         if not hasattr(p, 'transmission_model') or p.transmission_model == 'independent':
             assert not hasattr(p, 'transmission_scaling') or p.transmission_scaling == 'by_colonization'
-            self.event_queue.add(self.do_colonizations_independent, 0.0)
+            assert not (p.vectorize_colonizations and hasattr(p, 'colonize_host_by_host') and p.colonize_host_by_host)
+            if p.continuous_time_transmission:
+                assert not p.vectorize_colonizations
+                self.init_transmission_propensities()
+                self.schedule_next_transmission(0.0)
+            else:
+                self.event_queue.add(self.do_colonizations_independent, 0.0)
         elif p.transmission_model == 'cotransmission':
             self.event_queue.add(self.do_colonizations_cotransmission, 0.0)
         else:
@@ -734,9 +1201,7 @@ class Model(object):
         '''If parameter is set to a string, load from a file; also convert it to a numpy array if requested.'''
         param_value = getattr(self.p, param_name)
         if isinstance(param_value, basestring):
-            preset_name = param_value
-            with open(os.path.join(SCRIPT_DIR, '..', 'parameters', '{0}_{1}.json'.format(param_name, preset_name))) as f:
-                param_value = json.load(f)
+            param_value = copy.deepcopy(load_preset(param_name, param_value))
 
         if make_array:
             setattr(self.p, param_name, numpy.array(param_value))
@@ -749,6 +1214,29 @@ class Model(object):
         if not hasattr(p, 'output_start'):
             p.output_start = 0.0
 
+        if not hasattr(p, 'aging_timestep'):
+            p.aging_timestep = None
+
+        if not hasattr(p, 'vectorize_colonizations'):
+            p.vectorize_colonizations = False
+        if not hasattr(p, 'continuous_time_transmission'):
+            p.continuous_time_transmission = False
+
+        if not hasattr(p, 'db_journal_mode'):
+            p.db_journal_mode = 'OFF'
+        if not hasattr(p, 'use_background_writer'):
+            p.use_background_writer = False
+        if not hasattr(p, 'output_format'):
+            p.output_format = 'sqlite'
+        if not hasattr(p, 'columnar_output_dirname'):
+            p.columnar_output_dirname = None
+        if p.output_format not in ('sqlite', 'columnar', 'both'):
+            assert False, 'Invalid output_format {0}'.format(p.output_format)
+        if not hasattr(p, 'strain_table_schema'):
+            p.strain_table_schema = 'long'
+        if p.strain_table_schema not in ('long', 'wide'):
+            assert False, 'Invalid strain_table_schema {0}'.format(p.strain_table_schema)
+
         if not hasattr(p, 'load_hosts_from_checkpoint'):
             p.load_hosts_from_checkpoint = False
         if not hasattr(p, 'checkpoint_save_prefix'):
@@ -760,6 +1248,14 @@ class Model(object):
         if not hasattr(p, 'checkpoint_timestep'):
             p.checkpoint_timestep = None
 
+        # Event queue implementation; use_calendar_queue is the older switch between
+        # 'calendar' and 'heap', used if event_queue_type is not present
+        if not hasattr(p, 'event_queue_type'):
+            if not hasattr(p, 'use_calendar_queue') or p.use_calendar_queue:
+                p.event_queue_type = 'calendar'
+            else:
+                p.event_queue_type = 'heap'
+
         if p.load_hosts_from_checkpoint:
             assert p.demographic_burnin_time == 0.0
 
@@ -845,15 +1341,22 @@ class Model(object):
         
         assert self.n_hosts_by_age.sum() == p.n_hosts
         
-        n_hosts_by_age = numpy.zeros(p.n_ages, dtype=int)
+        store = self.host_store
+        n_hosts_by_age = numpy.bincount(store.age, minlength=p.n_ages)
         colonizations_by_age = numpy.zeros((p.n_ages, p.n_serotypes, 2), dtype=int)
-        for host in self.hosts:
-            n_hosts_by_age[host.age] += 1
-            if host.colonizations is not None:
-                colonizations_by_age[host.age,:,:] += host.colonizations
+        for age in range(p.n_ages):
+            colonizations_by_age[age,:,:] = store.colonizations[store.age == age].sum(axis=0)
         
         assert numpy.array_equal(n_hosts_by_age, self.n_hosts_by_age)
         assert numpy.array_equal(colonizations_by_age, self.colonizations_by_age)
+        
+        self.hosts_by_age.verify()
+        assert numpy.array_equal(self.hosts_by_age.item_bucket, store.age)
+        
+        assert numpy.array_equal(store.n_colonizations_by_resistance, store.colonizations.sum(axis=1))
+        assert self.output_counts.equals(OutputCounts.from_host_store(store, p.n_ages))
+        for age in range(p.n_ages):
+            assert self.hosts_by_age.size(age) == self.n_hosts_by_age[age]
 
 
     ### DATABASE SETUP AND OUTPUT ###
@@ -868,6 +1371,20 @@ class Model(object):
                 sys.stderr.write('{} already exists; aborting.\n'.format(p.db_filename))
                 sys.exit(1)
         db = sqlite3.connect(p.db_filename)
+        configure_connection(db, journal_mode=p.db_journal_mode)
+        
+        # Count tables are written as dense arrays to a separate directory for
+        # output_format 'columnar' (instead of SQLite tables) or 'both'
+        self.columnar_writer = None
+        if p.output_format != 'sqlite':
+            columnar_path = get_columnar_output_path(p.db_filename, p.columnar_output_dirname)
+            if os.path.exists(columnar_path):
+                if p.overwrite_db:
+                    shutil.rmtree(columnar_path)
+                else:
+                    sys.stderr.write('{} already exists; aborting.\n'.format(columnar_path))
+                    sys.exit(1)
+            self.columnar_writer = ColumnarWriter(columnar_path)
         
         if hasattr(p, 'job_info'):
             jobs_colnames = p.job_info.keys()
@@ -880,6 +1397,9 @@ class Model(object):
         db.execute('CREATE TABLE parameters (parameters)')
         db.execute('INSERT INTO parameters VALUES (?)', [json.dumps(object_to_json_dict(p), indent=2)])
         
+        # Total wall time (seconds) and number of events, written at the end of the run
+        db.execute('CREATE TABLE run_stats (walltime, event_count)')
+        
         if p.immigration_resistance_model == 'history_by_serotype':
             db.execute('''CREATE TABLE immigration_resistance
                 (t, serotype_id, history_length, n_resistant, p_immigration_resistant)
@@ -890,14 +1410,27 @@ class Model(object):
             db.execute('CREATE TABLE ageclasses (age, ageclass)')
             for age in range(p.n_ages):
                 db.execute('INSERT INTO ageclasses VALUES (?,?)', [age, self.ageclass_index[age]])
-            
+        
+        if p.output_format != 'columnar':
+            self.create_count_tables(db)
+
+        db.commit()
+
+        self.db = db
+        
+        # Rows are buffered and written in one transaction per output step
+        # (by a separate process if use_background_writer is set; see init_output_writer)
+        self.output_writer = OutputWriter(db)
+    
+    def create_count_tables(self, db):
+        p = self.p
+        
+        if self.ageclass_index is not None:
             db.execute('''CREATE TABLE counts_by_ageclass_treatment
                 (t, ageclass, in_treatment, n_hosts, n_colonized, n_colonizations, n_colonized_by_sensitive_and_resistant)
             ''')
 
-            db.execute('''CREATE TABLE counts_by_ageclass_treatment_strain
-                (t, ageclass, in_treatment, serotype_id, resistant, n_colonized, n_colonizations)
-            ''')
+            self.create_strain_table(db, 'counts_by_ageclass_treatment_strain', 'ageclass')
             
             db.execute('''CREATE TABLE counts_by_ageclass_treatment_n_colonizations
                 (t, ageclass, in_treatment, n_colonizations, n_hosts)
@@ -910,9 +1443,7 @@ class Model(object):
                 (t, age, in_treatment, n_hosts, n_colonized, n_colonizations, n_colonized_by_sensitive_and_resistant)
             ''')
 
-            db.execute('''CREATE TABLE counts_by_age_treatment_strain
-                (t, age, in_treatment, serotype_id, resistant, n_colonized, n_colonizations)
-            ''')
+            self.create_strain_table(db, 'counts_by_age_treatment_strain', 'age')
 
             db.execute('''CREATE TABLE counts_by_age_treatment_n_colonizations
                 (t, age, in_treatment, n_colonizations, n_hosts)
@@ -922,9 +1453,28 @@ class Model(object):
             (t, n_colonized, n_colonizations)
         ''')
 
-        db.commit()
+        db.execute('CREATE TABLE age_distribution (t, age, n_hosts)')
+    
+    def create_strain_table(self, db, table_name, age_column_name):
+        # With the wide schema, n_colonized and n_colonizations are .npy BLOBs of counts
+        # indexed by [serotype_id, resistant]
+        if self.p.strain_table_schema == 'wide':
+            db.execute('CREATE TABLE {0} (t, {1}, in_treatment, n_colonized, n_colonizations)'.format(
+                table_name, age_column_name
+            ))
+        else:
+            db.execute('CREATE TABLE {0} (t, {1}, in_treatment, serotype_id, resistant, n_colonized, n_colonizations)'.format(
+                table_name, age_column_name
+            ))
+    
+    def init_output_writer(self):
+        '''Starts the background output writer process, if enabled.
 
-        self.db = db
+        Called before hosts are allocated, so the forked worker process stays small.
+        '''
+        p = self.p
+        if p.use_background_writer:
+            self.output_writer = BackgroundOutputWriter(p.db_filename, journal_mode=p.db_journal_mode)
     
     def write_output(self, t, *args):
         p = self.p
@@ -953,23 +1503,46 @@ class Model(object):
         ))
         sys.stderr.write('total colonizations: {0}\n'.format(self.colonizations_by_age.sum()))
 
-        if not hasattr(p, 'use_calendar_queue') or p.use_calendar_queue:
+        if hasattr(self.event_queue, 'bucket_width'):
             sys.stderr.write('event queue bucket width: {0}\n'.format(self.event_queue.bucket_width))
+        if hasattr(self.event_queue, 'get_bucket_stats'):
+            sys.stderr.write(
+                'event queue buckets: {0} ({1} occupied, max size {2}, mean occupied size {3})\n'.format(
+                    *self.event_queue.get_bucket_stats()
+                )
+            )
+        if hasattr(self.event_queue, 'get_far_stats'):
+            sys.stderr.write('event queue far tier: {0} windows, {1} entries\n'.format(
+                *self.event_queue.get_far_stats()
+            ))
         
         sys.stderr.write('  Writing output to database...\n')
         
+        # Counts are maintained incrementally; age class counts are sums over ages
+        counts = self.output_counts.trimmed()
+        for age in range(p.n_ages):
+            assert counts.n_colonizations[age,:].sum() == self.colonizations_by_age[age,:,:].sum()
+        
+        if self.columnar_writer is not None:
+            self.columnar_writer.append('t', t, dtype=numpy.float64)
+        
         if self.ageclass_index is not None:
-            self.write_counts_by_ageclass_treatment(t)
-            self.write_counts_by_ageclass_treatment_strain(t)
-            self.write_counts_by_ageclass_treatment_n_colonizations(t)
+            ageclass_counts = counts.aggregate(self.ageclass_index, self.n_ageclasses)
+            self.write_counts_by_ageclass_treatment(t, ageclass_counts)
+            self.write_counts_by_ageclass_treatment_strain(t, ageclass_counts)
+            self.write_counts_by_ageclass_treatment_n_colonizations(t, ageclass_counts)
         
         if not hasattr(p, 'enable_output_by_age') or p.enable_output_by_age:
-            self.write_counts_by_age_treatment(t)
-            self.write_counts_by_age_treatment_strain(t)
-            self.write_counts_by_age_treatment_n_colonizations(t)
+            self.write_counts_by_age_treatment(t, counts)
+            self.write_counts_by_age_treatment_strain(t, counts)
+            self.write_counts_by_age_treatment_n_colonizations(t, counts)
 
         self.write_age_distribution(t)
-        self.write_summary(t)
+        self.write_summary(t, counts)
+        
+        self.output_writer.flush()
+        if self.columnar_writer is not None:
+            self.columnar_writer.flush()
 
         sys.stderr.write('  ...done.\n')
         
@@ -977,178 +1550,85 @@ class Model(object):
         if next_time <= self.p.t_end:
             self.event_queue.add(self.write_output, next_time)
 
-    def write_counts_by_age_treatment(self, t):
-        p = self.p
-        
-        n_hosts = numpy.zeros((p.n_ages,2), dtype=int)
-        n_colonized = numpy.zeros((p.n_ages,2), dtype=int)
-        n_colonizations = numpy.zeros((p.n_ages,2), dtype=int)
-        n_colonized_by_s_and_r = numpy.zeros((p.n_ages,2), dtype=int)
-        for host in self.hosts:
-            n_hosts[host.age, host.in_treatment] += 1
-            host_n_col = host.colonizations.sum()
-            if host_n_col > 0:
-                n_colonized[host.age, host.in_treatment] += 1
-            n_colonizations[host.age, host.in_treatment] += host_n_col
-            
-            if host.colonizations[:,0].sum() > 0 and host.colonizations[:,1].sum() > 0:
-                n_colonized_by_s_and_r[host.age, host.in_treatment] += 1
-        
-        for age in range(p.n_ages):
-            assert n_colonizations[age,0] + n_colonizations[age,1] == self.colonizations_by_age[age,:,:].sum()
-            for in_treatment in (False, True):
-                self.db.execute('INSERT INTO counts_by_age_treatment VALUES (?,?,?,?,?,?,?)',
-                    [t, age, in_treatment, n_hosts[age,in_treatment], n_colonized[age,in_treatment], n_colonizations[age,in_treatment], n_colonized_by_s_and_r[age,in_treatment]]
-                )
-        self.db.commit()
+    def write_counts_by_age_treatment(self, t, counts):
+        self.write_counts_by_treatment('counts_by_age_treatment', t, counts)
     
-    def write_counts_by_ageclass_treatment(self, t):
-        p = self.p
-        
-        n_hosts = numpy.zeros((self.n_ageclasses,2), dtype=int)
-        n_colonized = numpy.zeros((self.n_ageclasses,2), dtype=int)
-        n_colonizations = numpy.zeros((self.n_ageclasses,2), dtype=int)
-        n_colonized_by_s_and_r = numpy.zeros((self.n_ageclasses,2), dtype=int)
-        for host in self.hosts:
-            ageclass = self.ageclass_index[host.age]
-            n_hosts[ageclass, host.in_treatment] += 1
-            host_n_col = host.colonizations.sum()
-            if host_n_col > 0:
-                n_colonized[ageclass, host.in_treatment] += 1
-            n_colonizations[ageclass, host.in_treatment] += host_n_col
-            
-            if host.colonizations[:,0].sum() > 0 and host.colonizations[:,1].sum() > 0:
-                n_colonized_by_s_and_r[ageclass, host.in_treatment] += 1
-        
-        for ageclass in range(self.n_ageclasses):
-            for in_treatment in (False, True):
-                self.db.execute('INSERT INTO counts_by_ageclass_treatment VALUES (?,?,?,?,?,?,?)',
-                    [t, ageclass, in_treatment, n_hosts[ageclass,in_treatment], n_colonized[ageclass,in_treatment], n_colonizations[ageclass,in_treatment], n_colonized_by_s_and_r[ageclass,in_treatment]]
-                )
-        self.db.commit()
+    def write_counts_by_ageclass_treatment(self, t, counts):
+        self.write_counts_by_treatment('counts_by_ageclass_treatment', t, counts)
     
-    def write_counts_by_age_treatment_strain(self, t):
-        p = self.p
-        
-        n_colonized = numpy.zeros((p.n_ages, 2, p.n_serotypes, 2), dtype=int)
-        n_colonizations = numpy.zeros((p.n_ages, 2, p.n_serotypes, 2), dtype=int)
-        
-        for host in self.hosts:
-            n_colonized[host.age, host.in_treatment,:,:] += numpy.array(host.colonizations, dtype=bool)
-            n_colonizations[host.age, host.in_treatment,:,:] += host.colonizations
-        for age in range(p.n_ages):
-            for in_treatment in (False, True):
-                for serotype_id in range(p.n_serotypes):
-                    for resistant in (False, True):
-                        self.db.execute(
-                            'INSERT INTO counts_by_age_treatment_strain VALUES (?,?,?,?,?,?,?)',
-                            [t, age, in_treatment, serotype_id, resistant, n_colonized[age,in_treatment,serotype_id,resistant], n_colonizations[age,in_treatment,serotype_id,resistant]]
-                        )
-        self.db.commit()
+    def write_counts_by_treatment(self, table_name, t, counts):
+        if self.columnar_writer is not None:
+            self.append_columns(table_name, [
+                ('n_hosts', counts.n_hosts),
+                ('n_colonized', counts.n_colonized),
+                ('n_colonizations', counts.n_colonizations),
+                ('n_colonized_by_sensitive_and_resistant', counts.n_colonized_by_s_and_r)
+            ])
+        if self.p.output_format != 'columnar':
+            self.output_writer.add_deferred_rows(
+                table_name, outputwriter.counts_by_treatment_rows,
+                t, counts.n_hosts, counts.n_colonized, counts.n_colonizations, counts.n_colonized_by_s_and_r
+            )
     
-    def write_counts_by_ageclass_treatment_strain(self, t):
-        p = self.p
-        
-        n_colonized = numpy.zeros((self.n_ageclasses, 2, p.n_serotypes, 2), dtype=int)
-        n_colonizations = numpy.zeros((self.n_ageclasses, 2, p.n_serotypes, 2), dtype=int)
-        
-        for host in self.hosts:
-            ageclass = self.ageclass_index[host.age]
-            n_colonized[ageclass, host.in_treatment,:,:] += numpy.array(host.colonizations, dtype=bool)
-            n_colonizations[ageclass, host.in_treatment,:,:] += host.colonizations
-        for ageclass in range(self.n_ageclasses):
-            for in_treatment in (False, True):
-                for serotype_id in range(p.n_serotypes):
-                    for resistant in (False, True):
-                        self.db.execute('INSERT INTO counts_by_ageclass_treatment_strain VALUES (?,?,?,?,?,?,?)', [
-                            t,
-                            ageclass,
-                            in_treatment,
-                            serotype_id,
-                            resistant,
-                            n_colonized[ageclass,in_treatment,serotype_id,resistant],
-                            n_colonizations[ageclass,in_treatment,serotype_id,resistant]
-                        ])
-        self.db.commit()
+    def write_counts_by_age_treatment_strain(self, t, counts):
+        self.write_counts_by_treatment_strain('counts_by_age_treatment_strain', t, counts)
     
-    def write_counts_by_age_treatment_n_colonizations(self, t):
-        p = self.p
-        
-        max_n_col = 0
-        for host in self.hosts:
-            host_n_col = int(host.colonizations.sum())
-            if host_n_col > max_n_col:
-                max_n_col = host_n_col
-        
-        n_hosts = numpy.zeros((p.n_ages, 2, max_n_col+1), dtype=int)
-        for host in self.hosts:
-            host_n_col = host.colonizations.sum()
-            n_hosts[host.age, host.in_treatment, host_n_col] += 1
-        
-        for age in range(p.n_ages):
-            for in_treatment in (False, True):
-                for n_col in range(max_n_col+1):
-                    self.db.execute('INSERT INTO counts_by_age_treatment_n_colonizations VALUES (?,?,?,?,?)', [
-                        t,
-                        age,
-                        in_treatment,
-                        n_col,
-                        n_hosts[age,in_treatment,n_col]
-                    ])
-        
-        self.db.commit()
+    def write_counts_by_ageclass_treatment_strain(self, t, counts):
+        self.write_counts_by_treatment_strain('counts_by_ageclass_treatment_strain', t, counts)
     
-    def write_counts_by_ageclass_treatment_n_colonizations(self, t):
-        p = self.p
-        
-        max_n_col = 0
-        for host in self.hosts:
-            host_n_col = int(host.colonizations.sum())
-            if host_n_col > max_n_col:
-                max_n_col = host_n_col
-        
-        n_hosts = numpy.zeros((self.n_ageclasses, 2, max_n_col+1), dtype=int)
-        for host in self.hosts:
-            ageclass = self.ageclass_index[host.age]
-            host_n_col = host.colonizations.sum()
-            n_hosts[ageclass, host.in_treatment, host_n_col] += 1
-        
-        for ageclass in range(self.n_ageclasses):
-            for in_treatment in (False, True):
-                for n_col in range(max_n_col+1):
-                    self.db.execute('INSERT INTO counts_by_ageclass_treatment_n_colonizations VALUES (?,?,?,?,?)', [
-                        t,
-                        ageclass,
-                        in_treatment,
-                        n_col,
-                        n_hosts[ageclass,in_treatment,n_col]
-                    ])
-        
-        self.db.commit()
+    def write_counts_by_treatment_strain(self, table_name, t, counts):
+        if self.columnar_writer is not None:
+            self.append_columns(table_name, [
+                ('n_colonized', counts.n_colonized_strain),
+                ('n_colonizations', counts.n_colonizations_strain)
+            ])
+        if self.p.output_format != 'columnar':
+            self.output_writer.add_deferred_rows(
+                table_name,
+                outputwriter.counts_by_treatment_strain_wide_rows if self.p.strain_table_schema == 'wide'
+                else outputwriter.counts_by_treatment_strain_rows,
+                t, counts.n_colonized_strain, counts.n_colonizations_strain
+            )
     
-    def write_summary(self, t):
-        p = self.p
-        
-        n_colonized = 0
-        n_colonizations = 0
-        for host in self.hosts:
-            host_n_col = host.colonizations.sum()
-            n_colonizations += host_n_col
-            if host_n_col > 0:
-                n_colonized += 1
-        
-        self.db.execute('INSERT INTO summary VALUES (?,?,?)',
-            [t, n_colonized, n_colonizations]
-        )
-        self.db.commit()
+    def write_counts_by_age_treatment_n_colonizations(self, t, counts):
+        self.write_counts_by_treatment_n_colonizations('counts_by_age_treatment_n_colonizations', t, counts)
+    
+    def write_counts_by_ageclass_treatment_n_colonizations(self, t, counts):
+        self.write_counts_by_treatment_n_colonizations('counts_by_ageclass_treatment_n_colonizations', t, counts)
+    
+    def write_counts_by_treatment_n_colonizations(self, table_name, t, counts):
+        if self.columnar_writer is not None:
+            # Histogram length varies with the largest number of colonizations present
+            self.append_columns(table_name, [('n_hosts', counts.n_hosts_by_n_colonizations)], ragged=True)
+        if self.p.output_format != 'columnar':
+            self.output_writer.add_deferred_rows(
+                table_name, outputwriter.counts_by_treatment_n_colonizations_rows,
+                t, counts.n_hosts_by_n_colonizations
+            )
+    
+    def write_summary(self, t, counts):
+        n_colonized = int(counts.n_colonized.sum())
+        n_colonizations = int(counts.n_colonizations.sum())
+        if self.columnar_writer is not None:
+            self.append_columns('summary', [('n_colonized', n_colonized), ('n_colonizations', n_colonizations)])
+        if self.p.output_format != 'columnar':
+            self.output_writer.add_row('summary', (t, n_colonized, n_colonizations))
 
     def write_age_distribution(self, t):
         p = self.p
-
-        self.db.execute('CREATE TABLE IF NOT EXISTS age_distribution (t, age, n_hosts)')
-        for age in range(p.n_ages):
-            self.db.execute('INSERT INTO age_distribution VALUES (?,?,?)', [t, age, self.n_hosts_by_age[age]])
-        self.db.commit()
+        if self.columnar_writer is not None:
+            self.append_columns('age_distribution', [('n_hosts', self.n_hosts_by_age)])
+        if p.output_format != 'columnar':
+            self.output_writer.add_rows('age_distribution', [
+                (t, age, n_hosts) for age, n_hosts in enumerate(self.n_hosts_by_age.tolist())
+            ])
+    
+    def append_columns(self, table_name, columns, ragged=False):
+        '''Appends count arrays to columnar output, named <table_name>.<column_name> after the equivalent SQLite columns.'''
+        for column_name, array in columns:
+            self.columnar_writer.append(
+                '{0}.{1}'.format(table_name, column_name), array, dtype=numpy.int32, ragged=ragged
+            )
 
     def write_checkpoint(self, t, *args):
         p = self.p
@@ -1171,8 +1651,8 @@ class Model(object):
 
         for host in self.hosts:
             state_db.execute('INSERT INTO hosts VALUES (?,?,?,?,?)', [
-                host.birth_time,
-                host.death_time - host.birth_time,
+                float(host.birth_time),
+                float(host.death_time - host.birth_time),
                 npybuffer.ndarray_to_npy_buffer(host.colonizations),
                 npybuffer.ndarray_to_npy_buffer(host.past_colonizations),
                 npybuffer.ndarray_to_npy_buffer(host.treatment_times)
@@ -1195,140 +1675,406 @@ class Model(object):
         return 'model'
 
 
+### OUTPUT COUNTS ###
+
+class OutputCounts(object):
+    '''Host and colonization counts by age (or age class) and treatment status, as written to output tables.
+
+    Arrays are indexed by [age, in_treatment, ...]:
+    * n_hosts, n_colonized, n_colonizations, n_colonized_by_s_and_r: (n_ages, 2)
+    * n_colonized_strain, n_colonizations_strain: (n_ages, 2, n_serotypes, 2)
+    * n_hosts_by_n_colonizations: (n_ages, 2, max_n_colonizations + 1)
+    
+    The model keeps one instance up to date as host state changes (see adjust_host and
+    adjust_colonization); n_hosts_by_n_colonizations then has spare capacity,
+    which trimmed() removes for output.
+    '''
+    def __init__(
+            self, n_hosts, n_colonized, n_colonizations, n_colonized_by_s_and_r,
+            n_colonized_strain, n_colonizations_strain, n_hosts_by_n_colonizations
+    ):
+        self.n_hosts = n_hosts
+        self.n_colonized = n_colonized
+        self.n_colonizations = n_colonizations
+        self.n_colonized_by_s_and_r = n_colonized_by_s_and_r
+        self.n_colonized_strain = n_colonized_strain
+        self.n_colonizations_strain = n_colonizations_strain
+        self.n_hosts_by_n_colonizations = n_hosts_by_n_colonizations
+    
+    @classmethod
+    def from_host_store(cls, store, n_ages):
+        '''Computes all counts in a single vectorized pass over the host population.'''
+        n_serotypes = store.colonizations.shape[1]
+        colonizations = store.colonizations
+        
+        # Each host's (age, in_treatment) cell, as a flat index
+        cell = store.age * 2 + store.in_treatment
+        n_cells = n_ages * 2
+        
+        host_n_col = colonizations.sum(axis=2).sum(axis=1)
+        colonized = host_n_col > 0
+        s_and_r = numpy.logical_and(
+            colonizations[:,:,0].sum(axis=1) > 0,
+            colonizations[:,:,1].sum(axis=1) > 0
+        )
+        
+        n_hosts = numpy.bincount(cell, minlength=n_cells).reshape((n_ages, 2))
+        n_colonized = numpy.bincount(cell[colonized], minlength=n_cells).reshape((n_ages, 2))
+        n_colonizations = numpy.array(
+            numpy.bincount(cell, weights=host_n_col, minlength=n_cells), dtype=int
+        ).reshape((n_ages, 2))
+        n_colonized_by_s_and_r = numpy.bincount(cell[s_and_r], minlength=n_cells).reshape((n_ages, 2))
+        
+        # Strain counts: one flat index per (host, serotype, resistant) entry
+        strain_shape = (n_ages, 2, n_serotypes, 2)
+        strain_cell = (cell[:,numpy.newaxis] * (n_serotypes * 2) + numpy.arange(n_serotypes * 2)).ravel()
+        col_flat = colonizations.ravel()
+        n_colonized_strain = numpy.bincount(
+            strain_cell[col_flat > 0], minlength=n_cells * n_serotypes * 2
+        ).reshape(strain_shape)
+        n_colonizations_strain = numpy.array(
+            numpy.bincount(strain_cell, weights=col_flat, minlength=n_cells * n_serotypes * 2), dtype=int
+        ).reshape(strain_shape)
+        
+        max_n_col = int(host_n_col.max()) if host_n_col.shape[0] > 0 else 0
+        n_hosts_by_n_colonizations = numpy.bincount(
+            cell * (max_n_col + 1) + host_n_col, minlength=n_cells * (max_n_col + 1)
+        ).reshape((n_ages, 2, max_n_col + 1))
+        
+        return cls(
+            n_hosts, n_colonized, n_colonizations, n_colonized_by_s_and_r,
+            n_colonized_strain, n_colonizations_strain, n_hosts_by_n_colonizations
+        )
+    
+    def adjust_host(self, age, in_treatment, colonizations, n_sensitive, n_resistant, sign):
+        '''Adds (sign = 1) or removes (sign = -1) the contribution of one host.'''
+        n_col = n_sensitive + n_resistant
+        self.n_hosts[age, in_treatment] += sign
+        if n_col > 0:
+            self.n_colonized[age, in_treatment] += sign
+            self.n_colonizations[age, in_treatment] += sign * n_col
+            if n_sensitive > 0 and n_resistant > 0:
+                self.n_colonized_by_s_and_r[age, in_treatment] += sign
+            self.n_colonized_strain[age, in_treatment] += sign * (colonizations > 0)
+            self.n_colonizations_strain[age, in_treatment] += sign * colonizations
+        self.adjust_n_hosts_by_n_colonizations(age, in_treatment, n_col, sign)
+    
+    def adjust_colonization(self, age, in_treatment, serotype_id, resistant, strain_count, n_sensitive, n_resistant, delta):
+        '''Updates counts after one host's colonizations by a strain change by delta (1 or -1).
+
+        strain_count, n_sensitive, and n_resistant are the host's counts after the change.
+        '''
+        n_col = n_sensitive + n_resistant
+        n_col_before = n_col - delta
+        if resistant:
+            n_sensitive_before = n_sensitive
+            n_resistant_before = n_resistant - delta
+        else:
+            n_sensitive_before = n_sensitive - delta
+            n_resistant_before = n_resistant
+        
+        self.n_colonizations[age, in_treatment] += delta
+        self.n_colonizations_strain[age, in_treatment, serotype_id, resistant] += delta
+        # (Booleans are converted to int explicitly, since subtracting numpy booleans is not arithmetic)
+        self.n_colonized_strain[age, in_treatment, serotype_id, resistant] += int(strain_count > 0) - int(strain_count - delta > 0)
+        self.n_colonized[age, in_treatment] += int(n_col > 0) - int(n_col_before > 0)
+        self.n_colonized_by_s_and_r[age, in_treatment] += int(n_sensitive > 0 and n_resistant > 0) - int(
+            n_sensitive_before > 0 and n_resistant_before > 0
+        )
+        self.adjust_n_hosts_by_n_colonizations(age, in_treatment, n_col_before, -1)
+        self.adjust_n_hosts_by_n_colonizations(age, in_treatment, n_col, 1)
+    
+    def adjust_n_hosts_by_n_colonizations(self, age, in_treatment, n_col, delta):
+        capacity = self.n_hosts_by_n_colonizations.shape[2]
+        if n_col >= capacity:
+            new_capacity = max(2 * capacity, n_col + 1)
+            grown = numpy.zeros(self.n_hosts_by_n_colonizations.shape[:2] + (new_capacity,), dtype=int)
+            grown[:,:,:capacity] = self.n_hosts_by_n_colonizations
+            self.n_hosts_by_n_colonizations = grown
+        self.n_hosts_by_n_colonizations[age, in_treatment, n_col] += delta
+    
+    def trimmed(self):
+        '''Returns counts with n_hosts_by_n_colonizations cut off after the largest number of colonizations present.'''
+        nonzero = numpy.nonzero(self.n_hosts_by_n_colonizations.sum(axis=0).sum(axis=0))[0]
+        max_n_col = nonzero.max() if nonzero.shape[0] > 0 else 0
+        return OutputCounts(
+            self.n_hosts, self.n_colonized, self.n_colonizations, self.n_colonized_by_s_and_r,
+            self.n_colonized_strain, self.n_colonizations_strain,
+            self.n_hosts_by_n_colonizations[:,:,:max_n_col+1]
+        )
+    
+    def equals(self, other):
+        a = self.trimmed()
+        b = other.trimmed()
+        return all(
+            numpy.array_equal(getattr(a, name), getattr(b, name))
+            for name in (
+                'n_hosts', 'n_colonized', 'n_colonizations', 'n_colonized_by_s_and_r',
+                'n_colonized_strain', 'n_colonizations_strain', 'n_hosts_by_n_colonizations'
+            )
+        )
+    
+    def aggregate(self, ageclass_index, n_ageclasses):
+        '''Sums counts over ages in each age class.'''
+        def agg(x):
+            y = numpy.zeros((n_ageclasses,) + x.shape[1:], dtype=x.dtype)
+            numpy.add.at(y, ageclass_index, x)
+            return y
+        
+        return OutputCounts(
+            agg(self.n_hosts), agg(self.n_colonized), agg(self.n_colonizations), agg(self.n_colonized_by_s_and_r),
+            agg(self.n_colonized_strain), agg(self.n_colonizations_strain), agg(self.n_hosts_by_n_colonizations)
+        )
+
+
+### HOST STATE ###
+
+class HostStore(object):
+    '''State of all hosts, stored as contiguous arrays indexed by host index.
+
+    A host index refers to a slot in the population rather than an individual:
+    when a host dies, a newborn host takes over the same index.
+    Per-host treatment times vary in length and are kept in a list of arrays.
+    '''
+    def __init__(self, n_hosts, n_serotypes):
+        self.birth_time = numpy.zeros(n_hosts, dtype=float)
+        self.death_time = numpy.zeros(n_hosts, dtype=float)
+        self.age = numpy.zeros(n_hosts, dtype=int)
+        
+        # Aging bin for batched aging (see Model.do_aging); -1 if unassigned
+        self.aging_bin = -numpy.ones(n_hosts, dtype=int)
+        
+        # Number of current and past colonizations for each serotype/resistance class
+        # (32-bit, since per-host counts are small; sums are still computed at full width)
+        self.colonizations = numpy.zeros((n_hosts, n_serotypes, 2), dtype=numpy.int32)
+        self.past_colonizations = numpy.zeros((n_hosts, n_serotypes, 2), dtype=numpy.int32)
+        
+        # Total current colonizations by resistance class (colonizations summed over serotypes)
+        self.n_colonizations_by_resistance = numpy.zeros((n_hosts, 2), dtype=int)
+        
+        # Lowest-ranked (i.e., lowest-numbered) serotype currently colonizing each host,
+        # n_serotypes if uncolonized; determines the competition factor omega
+        self.min_serotype_rank = numpy.zeros(n_hosts, dtype=int) + n_serotypes
+        
+        # Whether each host has ever cleared each serotype (past_colonizations summed over
+        # resistance classes is nonzero); determines the immunity factor sigma
+        self.ever_colonized = numpy.zeros((n_hosts, n_serotypes), dtype=bool)
+        
+        # Treatment times: for each host, None or an n x 2 array, where n is the total number
+        # of treatments; treatment_times[i][j,0] is the start time, and treatment_times[i][j,1] is the end time
+        self.treatment_times = [None] * n_hosts
+        
+        # Whether the host is currently in treatment
+        self.in_treatment = numpy.zeros(n_hosts, dtype=bool)
+        
+        # If in_treatment = False, the index of the treatment to be started next.
+        # If in_treatment = True, the treatment that is currently active.
+        # -1 if the host has no treatments.
+        self.treatment_index = -numpy.ones(n_hosts, dtype=int)
+        
+        # Next scheduled clearance event
+        self.next_clearance_time = numpy.zeros(n_hosts, dtype=float)
+        self.next_clearance_serotype_id = numpy.zeros(n_hosts, dtype=int)
+        self.next_clearance_resistant = numpy.zeros(n_hosts, dtype=int)
+
+
 ### HOST CLASS ###
 
 class Host(object):
-    def __init__(
-            self, index, birth_time, lifetime, model,
+    '''A view of the host at one index of the model's HostStore.
+
+    Host objects persist for the whole simulation; their bound methods are
+    used as event queue entries for the host at that index.
+    '''
+    # Fixed attributes, no per-instance __dict__: there is one Host per host index
+    __slots__ = ('index', 'store')
+    
+    def __init__(self, index, store):
+        self.index = index
+        self.store = store
+    
+    @property
+    def birth_time(self):
+        return self.store.birth_time[self.index]
+    
+    @property
+    def death_time(self):
+        return self.store.death_time[self.index]
+    
+    @property
+    def age(self):
+        return int(self.store.age[self.index])
+    
+    @property
+    def aging_bin(self):
+        return int(self.store.aging_bin[self.index])
+    
+    @property
+    def colonizations(self):
+        return self.store.colonizations[self.index]
+    
+    @property
+    def past_colonizations(self):
+        return self.store.past_colonizations[self.index]
+    
+    @property
+    def treatment_times(self):
+        return self.store.treatment_times[self.index]
+    
+    @property
+    def in_treatment(self):
+        return bool(self.store.in_treatment[self.index])
+    
+    @property
+    def treatment_index(self):
+        return int(self.store.treatment_index[self.index])
+    
+    def initialize(
+            self, birth_time, lifetime, model,
             treatment_times=None, colonizations=None, past_colonizations=None
     ):
+        '''Sets up state for a newborn (or checkpoint-loaded) host at this index and schedules its events.'''
         if TRACE_CALLS:
-            print_call('Host.__init__', index, birth_time, lifetime, model)
+            print_call('Host.initialize', self, birth_time, lifetime, model)
         
         p = model.p
         event_queue = model.event_queue
-        
-        self.index = index
-        self.age = 0
-        self.birth_time = birth_time
-        self.death_time = birth_time + lifetime
-        
-        if lifetime > p.t_year:
+        store = self.store
+        index = self.index
+        
+        death_time = birth_time + lifetime
+        store.age[index] = 0
+        store.birth_time[index] = birth_time
+        store.death_time[index] = death_time
+        
+        if model.aging_bins is not None:
+            # Batched aging: join the bin for this birthday, unless this host index is already in it
+            aging_bin = model.get_aging_bin(birth_time)
+            if store.aging_bin[index] != aging_bin:
+                model.aging_bins[aging_bin].append(index)
+                store.aging_bin[index] = aging_bin
+            event_queue.add(self.reset, death_time)
+        elif lifetime > p.t_year:
             event_queue.add(self.celebrate_birthday, birth_time + p.t_year)
         else:
-            event_queue.add(self.reset, self.death_time)
+            event_queue.add(self.reset, death_time)
         
-        # Colonization/treatment dynamics only happen for t >= 0 (after demographic burnin).
-        if self.death_time >= 0:
-            # Number of current colonizations for each serotype/resistance class
-            if colonizations is not None:
-                self.colonizations = colonizations
-            else:
-                self.colonizations = numpy.zeros((p.n_serotypes, 2), dtype=int)
-            
-            # Number of past colonizations for each serotype/resistance class
-            if past_colonizations is not None:
-                self.past_colonizations = past_colonizations
-            else:
-                self.past_colonizations = numpy.zeros((p.n_serotypes, 2), dtype=int)
-            
-            # Treatment times: n x 2 array, where n is the total number of treatments;
-            # treatment_times[i,0] is the start time, and treatment_times[i,1] is the end time
-            if treatment_times is not None:
-                self.treatment_times = treatment_times
-            else:
-                self.treatment_times = model.draw_treatment_times(self.birth_time, self.death_time)
-
-            if self.treatment_times.shape[0] == 0:
-                self.in_treatment = False
-                self.treatment_times = None
-                self.treatment_index = -1
-            else:
-                # Whether the host is currently in treatment
-                self.in_treatment = False
-                if self.treatment_times.shape[0] > 0:
-                    # If in_treatment = False, this is the index of the treatment to be started next.
-                    # If in_treatment = True, this is the treatment that is currently active.
-                    self.treatment_index = 0
-
-                    # One treatment event is on the event queue at any time; 
-                    # the first one corresponds to starting the first treatment.
-                    # When called, step_treatment will schedule its own next invocation.
-                    event_queue.add(self.step_treatment, self.treatment_times[0,0])
+        if colonizations is not None:
+            store.colonizations[index] = colonizations
+        else:
+            store.colonizations[index] = 0
+        store.n_colonizations_by_resistance[index] = store.colonizations[index].sum(axis=0)
+        store.min_serotype_rank[index] = get_min_serotype_rank(store.colonizations[index])
+        if past_colonizations is not None:
+            store.past_colonizations[index] = past_colonizations
         else:
-            self.colonizations = None
-            self.past_colonizations = None
-            self.treatment_times = None
-            self.in_treatment = False
-            self.treatment_index = -1
+            store.past_colonizations[index] = 0
+        store.ever_colonized[index] = store.past_colonizations[index].sum(axis=1) > 0
+        
+        store.in_treatment[index] = False
+        store.treatment_times[index] = None
+        store.treatment_index[index] = -1
+        
+        # Colonization/treatment dynamics only happen for t >= 0 (after demographic burnin).
+        if death_time >= 0:
+            if treatment_times is None:
+                treatment_times = model.draw_treatment_times(birth_time, death_time)
+
+            if treatment_times.shape[0] > 0:
+                store.treatment_times[index] = treatment_times
+                store.treatment_index[index] = 0
+
+                # One treatment event is on the event queue at any time; 
+                # the first one corresponds to starting the first treatment.
+                # When called, step_treatment will schedule its own next invocation.
+                event_queue.add(self.step_treatment, treatment_times[0,0])
     
     def reset(self, t, model, event_queue, event_function):
         if TRACE_CALLS:
             print_call('Host.reset', self, t, model, event_queue, event_function)
+        
+        store = self.store
+        index = self.index
+        age = store.age[index]
 
-        if self.colonizations is not None:
-            event_queue.remove_if_present(self.clear_colonization)
+        event_queue.remove_if_present(self.clear_colonization)
+        event_queue.remove_if_present(self.step_treatment)
 
-        model.adjust_age_count(self.age, -1)
-        model.hosts_by_age[self.age].remove(self.index)
+        model.adjust_age_count(age, -1)
+        model.hosts_by_age.remove(age, index)
+        model.adjust_colonizations_by_age(age, -store.colonizations[index])
+        model.adjust_output_counts_host(index, -1)
         
-        if self.colonizations is not None:
-            model.adjust_colonizations_by_age(self.age, -self.colonizations)
         lifetime = model.draw_host_lifetime()
-        model.hosts[self.index] = Host(self.index, t, lifetime, model)
+        self.initialize(t, lifetime, model)
         model.adjust_age_count(0, 1)
-        model.hosts_by_age[0].append(self.index)
+        model.hosts_by_age.add(0, index)
+        model.adjust_output_counts_host(index, 1)
     
     def celebrate_birthday(self, t, model, event_queue, event_function):
         if TRACE_CALLS:
             print_call('Host.celebrate_birthday', self, t, model, event_queue, event_function)
         
-        p = model.p
-
-        # sys.stderr.write('age: {}\n'.format(self.age))
-        model.hosts_by_age[self.age].remove(self.index)
-        model.adjust_age_count(self.age, -1)
-        if self.colonizations is not None:
-            model.adjust_colonizations_by_age(self.age, -self.colonizations)
-        self.age += 1
-        model.adjust_age_count(self.age, 1)
-        model.hosts_by_age[self.age].append(self.index)
-        if self.colonizations is not None:
-            model.adjust_colonizations_by_age(self.age, self.colonizations)
+        self.increment_age(model)
         
         next_birthday = t + model.p.t_year
-        if next_birthday < self.death_time:
+        death_time = self.store.death_time[self.index]
+        if next_birthday < death_time:
             event_queue.add(self.celebrate_birthday, next_birthday)
         else:
-            event_queue.add(self.reset, self.death_time)
+            event_queue.add(self.reset, death_time)
+    
+    def increment_age(self, model):
+        '''Increments age and moves this host's counts to the next age.'''
+        store = self.store
+        index = self.index
+        age = store.age[index]
+        colonizations = store.colonizations[index]
+        
+        model.hosts_by_age.move(age, age + 1, index)
+        model.adjust_age_count(age, -1)
+        model.adjust_colonizations_by_age(age, -colonizations)
+        model.adjust_output_counts_host(index, -1)
+        store.age[index] = age + 1
+        model.adjust_age_count(age + 1, 1)
+        model.adjust_colonizations_by_age(age + 1, colonizations)
+        model.adjust_output_counts_host(index, 1)
     
     def step_treatment(self, t, model, event_queue, event_function):
         if TRACE_CALLS:
             print_call('Host.step_treatment', self, t, model, event_queue, event_function)
         
+        store = self.store
+        index = self.index
+        treatment_times = store.treatment_times[index]
+        
+        model.adjust_output_counts_host(index, -1)
+        
         # If currently treating, stop treatment and schedule the next one.
-        if self.in_treatment:
-            self.in_treatment = False
-            self.treatment_index += 1
-            if self.treatment_index < self.treatment_times.shape[0]:
+        if store.in_treatment[index]:
+            store.in_treatment[index] = False
+            treatment_index = store.treatment_index[index] + 1
+            store.treatment_index[index] = treatment_index
+            if treatment_index < treatment_times.shape[0]:
                 event_queue.add(
                     self.step_treatment,
-                    self.treatment_times[self.treatment_index,0]
+                    treatment_times[treatment_index,0]
                 )
         # If currently not treating, start treatment and schedule the end of treatment
         else:
-            self.in_treatment = True
-            end_time = self.treatment_times[self.treatment_index,1]
-            if end_time < self.death_time:
+            store.in_treatment[index] = True
+            end_time = treatment_times[store.treatment_index[index],1]
+            if end_time < store.death_time[index]:
                 event_queue.add(self.step_treatment, end_time)
         
+        model.adjust_output_counts_host(index, 1)
+        
         self.update_next_clearance(t, model)
     
     def calculate_mean_clearance_duration(self, serotype_id, resistant, model):
         p = model.p
-        rng = model.rng
         
-        if self.in_treatment:
+        if self.store.in_treatment[self.index]:
             if p.treatment_multiplier == 0.0:
                 assert False
             
@@ -1337,47 +2083,56 @@ class Host(object):
             else:
                 mean_duration = p.gamma_treated_sensitive
         else:
-            mean_duration = p.kappa + (p.gamma[serotype_id] - p.kappa) * numpy.exp(-p.epsilon * self.past_colonizations.sum())
+            mean_duration = p.kappa + (p.gamma[serotype_id] - p.kappa) * numpy.exp(
+                -p.epsilon * self.store.past_colonizations[self.index].sum()
+            )
             if resistant:
                 mean_duration *= p.xi
         
         return mean_duration
     
     def clear_colonization(self, t, model, event_queue, event_function):
-        if not t == self.next_clearance_time:
-            sys.stderr.write('{}, {}\n'.format(t, self.next_clearance_time))
-            sys.stderr.write('{}\n'.format(self.colonizations))
-        assert t == self.next_clearance_time
-        serotype_id = self.next_clearance_serotype_id
-        resistant = self.next_clearance_resistant
-        
-        self.colonizations[serotype_id, resistant] -= 1
-        self.past_colonizations[serotype_id, resistant] += 1
-        model.adjust_colonizations_by_age_strain(self.age, serotype_id, resistant, -1)
+        store = self.store
+        index = self.index
+        
+        if not t == store.next_clearance_time[index]:
+            sys.stderr.write('{}, {}\n'.format(t, store.next_clearance_time[index]))
+            sys.stderr.write('{}\n'.format(store.colonizations[index]))
+        assert t == store.next_clearance_time[index]
+        serotype_id = store.next_clearance_serotype_id[index]
+        resistant = store.next_clearance_resistant[index]
+        
+        store.colonizations[index, serotype_id, resistant] -= 1
+        store.n_colonizations_by_resistance[index, resistant] -= 1
+        store.past_colonizations[index, serotype_id, resistant] += 1
+        store.ever_colonized[index, serotype_id] = True
+        if serotype_id == store.min_serotype_rank[index] and \
+                store.colonizations[index, serotype_id, 0] + store.colonizations[index, serotype_id, 1] == 0:
+            store.min_serotype_rank[index] = get_min_serotype_rank(store.colonizations[index])
+        model.adjust_colonizations_by_age_strain(store.age[index], serotype_id, resistant, -1)
+        model.adjust_output_counts_colonization(index, serotype_id, resistant, -1)
         
         self.update_next_clearance(t, model)
     
     def get_prob_colonization(self, serotype_id, resistant, model):
-        p = model.p
-        
-        if self.colonizations.sum() == 0:
-            omega = 0.0
-        else:
-            if p.n_serotypes == 1:
-                omega = p.mu_max
-            else:
-                min_serotype_rank = numpy.min(numpy.nonzero(self.colonizations.sum(axis=1))[0])
-                omega = p.mu_max * (1.0 - min_serotype_rank / (p.n_serotypes - 1.0))
+        store = self.store
+        index = self.index
         
-        prob_colonization = 1 - omega
-        if self.past_colonizations[serotype_id,:].sum() > 0:
-            prob_colonization *= 1 - p.sigma
+        prob_colonization = 1 - model.omega_by_min_serotype_rank[store.min_serotype_rank[index]]
+        if store.ever_colonized[index, serotype_id]:
+            prob_colonization *= 1 - model.p.sigma
         
         return prob_colonization
     
     def receive_colonization(self, serotype_id, resistant, t, model):
-        self.colonizations[serotype_id, resistant] += 1
-        model.adjust_colonizations_by_age_strain(self.age, serotype_id, resistant, 1)
+        store = self.store
+        index = self.index
+        store.colonizations[index, serotype_id, resistant] += 1
+        store.n_colonizations_by_resistance[index, resistant] += 1
+        if serotype_id < store.min_serotype_rank[index]:
+            store.min_serotype_rank[index] = serotype_id
+        model.adjust_colonizations_by_age_strain(store.age[index], serotype_id, resistant, 1)
+        model.adjust_output_counts_colonization(index, serotype_id, resistant, 1)
         
         self.update_next_clearance(t, model)
     
@@ -1395,10 +2150,14 @@ class Host(object):
         # Don't update before the start of time; that's demographic burnin for checkpoint loading.
         if t < 0.0:
             return
+        
+        store = self.store
+        index = self.index
+        colonizations = store.colonizations[index]
 
         # Get arrays for serotype_id, resistant corresponding to nonzero entries
         # in colonizations array
-        nz_sero, nz_res = numpy.nonzero(self.colonizations)
+        nz_sero, nz_res = numpy.nonzero(colonizations)
         
         if nz_sero.shape[0] == 0:
             assert not model.event_queue.contains(self.clear_colonization)
@@ -1411,7 +2170,7 @@ class Host(object):
             resistant = nz_res[strain_index]
             
             # rate for this strain = [# colonizations] / [mean duration of one colonization]
-            rates[strain_index] = self.colonizations[serotype_id, resistant] / self.calculate_mean_clearance_duration(
+            rates[strain_index] = colonizations[serotype_id, resistant] / self.calculate_mean_clearance_duration(
                 serotype_id, resistant, model
             )
             assert not numpy.isinf(rates[strain_index])
@@ -1420,15 +2179,16 @@ class Host(object):
         rates_sum = rates.sum()
         
         # Draw clearance time
-        self.next_clearance_time = t + model.rng.exponential(scale = 1.0 / rates_sum)
+        next_clearance_time = t + model.rng.exponential(scale = 1.0 / rates_sum)
+        store.next_clearance_time[index] = next_clearance_time
         
         # Choose strain to be cleared
-        strain_index = model.rng.choice(nz_sero.shape[0], size=1, p=(rates / rates_sum))
-        self.next_clearance_serotype_id = nz_sero[strain_index]
-        self.next_clearance_resistant = nz_res[strain_index]
+        strain_index = model.rng.choice(nz_sero.shape[0], size=1, p=(rates / rates_sum))[0]
+        store.next_clearance_serotype_id[index] = nz_sero[strain_index]
+        store.next_clearance_resistant[index] = nz_res[strain_index]
         
         # Update clearance event
-        model.event_queue.add_or_update(self.clear_colonization, self.next_clearance_time)
+        model.event_queue.add_or_update(self.clear_colonization, next_clearance_time)
 
     def verify(self, t, model):
         if TRACE_CALLS:
@@ -1436,34 +2196,48 @@ class Host(object):
         p = model.p
         event_queue = model.event_queue
         
-        assert t <= self.death_time
-        age_lower = int(numpy.floor((t - self.birth_time - EPS) / p.t_year))
-        age = int(numpy.floor((t - self.birth_time) / p.t_year))
-        age_upper = int(numpy.floor((t - self.birth_time + EPS) / p.t_year))
+        birth_time = self.birth_time
+        death_time = self.death_time
+        
+        assert t <= death_time
+        
+        # With batched aging, ages are current as of the last aging event
+        if model.aging_bins is not None:
+            t_age = max(model.last_aging_time, birth_time)
+            assert self.aging_bin == model.get_aging_bin(birth_time)
+        else:
+            t_age = t
+        age_lower = int(numpy.floor((t_age - birth_time - EPS) / p.t_year))
+        age = int(numpy.floor((t_age - birth_time) / p.t_year))
+        age_upper = int(numpy.floor((t_age - birth_time + EPS) / p.t_year))
         assert self.age == age or self.age == age_lower or self.age == age_upper
         
-        if self.colonizations is not None:
-            for serotype_id in range(p.n_serotypes):
-                for resistant in (0, 1):
-                    assert self.colonizations[serotype_id, resistant] >= 0
-                    assert self.past_colonizations[serotype_id, resistant] >= 0
+        assert numpy.all(self.colonizations >= 0)
+        assert numpy.all(self.past_colonizations >= 0)
+        assert self.store.min_serotype_rank[self.index] == get_min_serotype_rank(self.colonizations)
+        assert numpy.all(self.store.ever_colonized[self.index] == (self.past_colonizations.sum(axis=1) > 0))
         
-        if self.treatment_times is not None:
-            assert self.treatment_index >= 0
+        treatment_times = self.treatment_times
+        treatment_index = self.treatment_index
+        if treatment_times is not None:
+            assert treatment_index >= 0
             
-            for i in range(1, self.treatment_times.shape[0]):
-                assert self.treatment_times[i,0] >= self.treatment_times[i-1,1] + p.min_time_between_treatments
+            for i in range(1, treatment_times.shape[0]):
+                assert treatment_times[i,0] >= treatment_times[i-1,1] + p.min_time_between_treatments
             if self.in_treatment:
-                assert self.treatment_times[self.treatment_index,0] <= t
-                assert self.treatment_times[self.treatment_index,1] >= t
-                if self.treatment_times[self.treatment_index,1] < self.death_time:
-                    assert event_queue.get_time(self.step_treatment) == self.treatment_times[self.treatment_index,1]
+                assert treatment_times[treatment_index,0] <= t
+                assert treatment_times[treatment_index,1] >= t
+                if treatment_times[treatment_index,1] < death_time:
+                    assert event_queue.get_time(self.step_treatment) == treatment_times[treatment_index,1]
             else:
-                if self.treatment_index < self.treatment_times.shape[0]:
-                    if self.treatment_index > 0:
-                        assert self.treatment_times[self.treatment_index - 1,1] <= t
-                    assert self.treatment_times[self.treatment_index,0] >= t
-                    assert event_queue.get_time(self.step_treatment) == self.treatment_times[self.treatment_index,0]
+                if treatment_index < treatment_times.shape[0]:
+                    if treatment_index > 0:
+                        assert treatment_times[treatment_index - 1,1] <= t
+                    assert treatment_times[treatment_index,0] >= t
+                    assert event_queue.get_time(self.step_treatment) == treatment_times[treatment_index,0]
+        else:
+            assert treatment_index == -1
+            assert not self.in_treatment
     
     def __str__(self):
         return 'hosts[{0}]'.format(self.index)
@@ -1480,6 +2254,25 @@ def print_call(name, *args):
     '''
     sys.stderr.write('{0}({1})\n'.format(name, ', '.join(['{0}'.format(arg) for arg in args])))
 
+# Parameter presets already loaded, by (parameter name, preset name), so models run one
+# after another in the same process read each file once
+PRESETS = {}
+
+def load_preset(param_name, preset_name):
+    key = (param_name, preset_name)
+    if key not in PRESETS:
+        with open(os.path.join(SCRIPT_DIR, '..', 'parameters', '{0}_{1}.json'.format(param_name, preset_name))) as f:
+            PRESETS[key] = json.load(f)
+    return PRESETS[key]
+
+def get_min_serotype_rank(colonizations):
+    '''Returns the lowest serotype with nonzero colonizations in an (n_serotypes, 2) array,
+    or n_serotypes if there are none.'''
+    nz_sero = numpy.nonzero(colonizations.sum(axis=1))[0]
+    if nz_sero.shape[0] == 0:
+        return colonizations.shape[0]
+    return nz_sero[0]
+
 def get_memusage():
     return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
@@ -1496,13 +2289,6 @@ def object_to_json_dict(obj):
                 d[k] = v
     return d
 
-def randint_weighted(rng, n, p):
-    pmax = numpy.max(p)
-    while True:
-        index = rng.randint(n)
-        if rng.uniform() < p[index] / pmax:
-            return index
-
 class Parameters(object):
     def __init__(self, d):
         for k, v in d.iteritems():
@@ -1,66 +1,53 @@
 #!/usr/bin/env python
 
 import json
-import itertools
-import argparse
-import importlib
-import shutil
 import os
 import sys
-import multiprocessing
-import subprocess
+import shutil
+import sqlite3
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(SCRIPT_DIR)
-import sqlite3
-from time import gmtime, strftime
+import jobqueue
+from columnaroutput import get_columnar_output_path
 
 def main():
     with open('chunk_spec.json') as f:
         spec = json.load(f)
-    
-    pool = multiprocessing.Pool(spec['n_processes'])
-    results = pool.map(run, spec['job_ids'])
-#     for job_id in spec['job_ids']:
-#         pool.apply_async(run, [job_id])
-    pool.close()
-    pool.join()
-
-def get_time_str():
-    return strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
-
-def run(job_id):
-    with open('chunk_spec.json') as f:
-        spec = json.load(f)
-
-    exec_path = os.path.join(SCRIPT_DIR, 'pyresistance.py')
 
-    job_dir = os.path.join(spec['tmp_dir'], 'jobs', '{0}'.format(job_id))
-
-    sys.stderr.write('{0}\n'.format(get_time_str()))
-    sys.stderr.write('Job {0} starting\n'.format(job_id))
-
-    stdout = open(os.path.join(job_dir, 'stdout.txt'), 'w')
-    stderr = open(os.path.join(job_dir, 'stderr.txt'), 'w')
-    
-    if spec['dry']:
-        args = [exec_path, '--dry', 'params.json']
-    else:
-        args = [exec_path, 'params.json']
-    proc = subprocess.Popen(
-        args,
-        stdout=stdout,
-        stderr=stderr,
-        cwd=job_dir
+    # Each process pulls jobs from the sweep's shared queue until none are waiting
+    jobqueue.go(
+        spec['queue_filename'], spec['n_processes'],
+        prepare=remove_job_output, get_event_count=get_event_count,
+        run_function=run_job_in_process if spec.get('in_process', False) else None
     )
-    result = proc.wait()
-    sys.stderr.write('{0}\n'.format(get_time_str()))
-    if result != 0:
-        sys.stderr.write('Job {0} failed. Aborting.\n'.format(job_id))
-        raise Exception('Failed job')
-    else:
-        sys.stderr.write('Job {0} done\n'.format(job_id))
-    
-    return job_id
+
+def load_params(job_dir):
+    with open(os.path.join(job_dir, 'params.json')) as f:
+        return json.load(f)
+
+def remove_job_output(job_dir):
+    '''Removes output left by an earlier, interrupted attempt at a job.'''
+    params = load_params(job_dir)
+    db_path = os.path.join(job_dir, params['db_filename'])
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    columnar_path = get_columnar_output_path(db_path, params.get('columnar_output_dirname'))
+    if os.path.exists(columnar_path):
+        shutil.rmtree(columnar_path)
+
+def run_job_in_process(job_dir, command):
+    '''Runs a pyresistance.py job in this worker process rather than a new one.'''
+    # Imported here so that chunks running jobs in subprocesses needn't load the model
+    import run_replicates
+    return run_replicates.run_replicate(job_dir, command[-1], dry='--dry' in command)
+
+def get_event_count(job_dir):
+    '''Returns the number of events a finished job simulated (None for dry runs).'''
+    db = sqlite3.connect(os.path.join(job_dir, load_params(job_dir)['db_filename']))
+    row = db.execute('SELECT event_count FROM run_stats').fetchone()
+    db.close()
+    return None if row is None else row[0]
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env pypy
+
+'''Runs many model replicates one after another in a single process.
+
+Running each replicate with its own pyresistance.py process repeats interpreter startup,
+module imports, loading of parameter presets, and (with PyPy) JIT warmup for every
+replicate; here they are paid once, which matters when replicates are short.
+
+Each replicate runs in its own working directory from its own parameters file, so it has
+its own random seed and output database, and its standard output and standard error go to
+stdout.txt and stderr.txt there, as for a job run by jobqueue.py. A replicate that fails
+(raises an exception or calls sys.exit) is reported, and the remaining replicates still run.
+
+    run_replicates.py [--params-filename <filename>] [--dry] <working-dir> [<working-dir> ...]
+'''
+
+import os
+import sys
+import gc
+import argparse
+import traceback
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(SCRIPT_DIR)
+from pyresistance import Model, load_parameters
+from time import strftime, gmtime
+
+def get_time_str():
+    return strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
+
+def run_replicate(working_dir, params_filename, dry=False):
+    '''Runs one replicate in working_dir; returns 0 if it succeeded and 1 if it failed.
+
+    params_filename is relative to working_dir, as are output filenames in the parameters.
+    '''
+    orig_cwd = os.getcwd()
+    orig_stdout = sys.stdout
+    orig_stderr = sys.stderr
+    model = None
+
+    os.chdir(working_dir)
+    try:
+        with open('stdout.txt', 'w') as stdout, open('stderr.txt', 'w') as stderr:
+            sys.stdout = stdout
+            sys.stderr = stderr
+            try:
+                model = Model(load_parameters(params_filename), dry)
+                model.run()
+                return 0
+            except (Exception, SystemExit):
+                traceback.print_exc()
+                if model is not None and hasattr(model, 'output_writer'):
+                    model.output_writer.abort()
+                return 1
+            finally:
+                sys.stdout.flush()
+                sys.stdout = orig_stdout
+                sys.stderr = orig_stderr
+    finally:
+        os.chdir(orig_cwd)
+
+        # Model state is full of reference cycles (e.g., events are bound methods), so free
+        # it, and close the replicate's database, before starting the next replicate
+        del model
+        gc.collect()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run many model replicates in a single process.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--params-filename', metavar='<filename>', default='parameters.json',
+        help='parameters file (JSON or Python module) in each working directory'
+    )
+    parser.add_argument('--dry', action='store_true')
+    parser.add_argument('working_dirs', metavar='<working-dir>', nargs='+')
+    args = parser.parse_args()
+
+    for working_dir in args.working_dirs:
+        if not os.path.isdir(working_dir):
+            sys.stderr.write('{0} is not a directory; aborting.\n'.format(working_dir))
+            sys.exit(1)
+
+    failed_dirs = []
+    for working_dir in args.working_dirs:
+        sys.stderr.write('{0}\n'.format(get_time_str()))
+        sys.stderr.write('Replicate {0} starting\n'.format(working_dir))
+        if run_replicate(working_dir, args.params_filename, args.dry) == 0:
+            sys.stderr.write('Replicate {0} done\n'.format(working_dir))
+        else:
+            sys.stderr.write('Replicate {0} failed; see stderr.txt\n'.format(working_dir))
+            failed_dirs.append(working_dir)
+
+    sys.stderr.write('{0}\n'.format(get_time_str()))
+    sys.stderr.write('{0} of {1} replicates failed.\n'.format(len(failed_dirs), len(args.working_dirs)))
+    if len(failed_dirs) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -6,17 +6,35 @@ import argparse
 import subprocess
 import importlib
 import shutil
+import hashlib
 import os
 import sys
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(SCRIPT_DIR)
 import sqlite3
-from math import floor, ceil
+import jobqueue
+from math import ceil, log
 from time import strftime, gmtime
 
+# Parameters that the number of events scales with, roughly proportionally
+RUNTIME_SCALE_PARAMETERS = ['n_hosts', 't_end', 'demographic_burnin_time']
+
 def get_time_str():
     return strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
 
+def get_runtime_features(params, param_vals):
+    '''Features for predicting a job's runtime: the logs of RUNTIME_SCALE_PARAMETERS and
+    the numeric parameters varied by the sweep.'''
+    features = {}
+    for name in RUNTIME_SCALE_PARAMETERS:
+        value = params.get(name)
+        if isinstance(value, (int, float)) and value > 0:
+            features['log_' + name] = log(value)
+    for k, v in param_vals:
+        if isinstance(v, (int, float)) and k not in ('random_seed', 'job_id'):
+            features[k] = v
+    return features
+
 def run_sweep(sweep_module, complete=False, dry=False):
     if os.path.exists(sweep_module.db_filename):
         db = None
@@ -30,6 +48,7 @@ def run_sweep(sweep_module, complete=False, dry=False):
     
     # Generate database entries, working directories, and parameter files for each job
     job_ids = []
+    job_features = {}
     for db_col_vals, param_vals in sweep_module.generate_sweep():
         params = dict(const_params)
         for k, v in param_vals:
@@ -48,52 +67,72 @@ def run_sweep(sweep_module, complete=False, dry=False):
         ), [job_id, json.dumps(params, indent=2)] + [x[1] for x in db_col_vals])
         db.commit()
         
-        job_dir = os.path.join('tmp_dir', 'jobs', '{0}'.format(job_id))
+        job_dir = os.path.join(sweep_module.tmp_dir, 'jobs', '{0}'.format(job_id))
         if not os.path.exists(job_dir):
             os.makedirs(job_dir)
             with open(os.path.join(job_dir, 'params.json'), 'w') as f:
                 json.dump(params, f, indent=2)
                 f.write('\n')
             job_ids.append(job_id)
+            job_features[job_id] = get_runtime_features(params, param_vals)
         
         job_id += 1
     
     model_script_filename = os.path.join(SCRIPT_DIR, 'pyresistance.py')
     
-    # Submit jobs in chunks
     n_jobs = len(job_ids)
     if n_jobs == 0:
         sys.stderr.write('No jobs to run.\n')
         sys.exit(0)
     
+    # Put jobs in a shared queue, from which each chunk's processes pull jobs until none
+    # are left, so chunks that get short jobs don't sit idle.
+    # Jobs are prioritized longest-first using runtimes predicted from their features, fit to
+    # jobs that have finished and to finished jobs in the queues listed in
+    # sweep_module.runtime_history (if present), e.g., from an earlier sweep.
+    queue_filename = os.path.abspath(os.path.join(sweep_module.tmp_dir, 'job_queue.sqlite'))
+    queue = jobqueue.JobQueue(queue_filename)
+    queue.db.execute('BEGIN')
+    for job_id in job_ids:
+        if dry:
+            command = [model_script_filename, '--dry', 'params.json']
+        else:
+            command = [model_script_filename, 'params.json']
+        queue.add_job(
+            os.path.join(sweep_module.tmp_dir, 'jobs', '{0}'.format(job_id)), command, job_id,
+            job_features[job_id]
+        )
+    if hasattr(sweep_module, 'runtime_history'):
+        for history_filename in sweep_module.runtime_history:
+            n_imported = queue.add_history(history_filename)
+            sys.stderr.write('Imported {0} job runtimes from {1}.\n'.format(n_imported, history_filename))
+    queue.db.execute('COMMIT')
+    queue.update_priorities()
+    queue.close()
+    
+    # Submit chunks of worker processes
     n_chunks = min(
         int(ceil(n_jobs / float(sweep_module.n_chunk_processes))),
         sweep_module.max_n_chunks
     )
-    sys.stderr.write('Splitting {0} jobs into {1} chunks.\n'.format(n_jobs, n_chunks))
+    sys.stderr.write('Running {0} jobs with {1} chunks.\n'.format(n_jobs, n_chunks))
+    
+    # If sweep_module.run_in_process is set, each worker process runs its jobs itself,
+    # paying interpreter startup and JIT warmup once rather than once per job; the chunk
+    # script must then run under the model's interpreter (PyPy).
+    in_process = hasattr(sweep_module, 'run_in_process') and sweep_module.run_in_process
     
     chunk_script_filename = os.path.abspath(os.path.join(sweep_module.tmp_dir, 'run_chunk.sh'))
     with open(chunk_script_filename, 'w') as f:
         f.write(sweep_module.preamble)
         f.write('\n\n')
-        f.write('{0}\n'.format(os.path.join(SCRIPT_DIR, 'run_chunk.py')))
-    
-    small_chunk_size = int(floor(n_jobs / float(n_chunks)))
-    large_chunk_size = small_chunk_size + 1
-    
-    n_large_chunks = n_jobs % n_chunks
-    n_small_chunks = n_chunks - n_large_chunks
+        if in_process:
+            f.write('pypy {0}\n'.format(os.path.join(SCRIPT_DIR, 'run_chunk.py')))
+        else:
+            f.write('{0}\n'.format(os.path.join(SCRIPT_DIR, 'run_chunk.py')))
     
-    job_index = 0
-    chunk_id = 0
     for chunk_id in range(n_chunks):
         chunk_dir = os.path.join(sweep_module.tmp_dir, 'chunks', '{0}'.format(chunk_id))
-        if chunk_id < n_small_chunks:
-            chunk_job_ids = job_ids[job_index:job_index + small_chunk_size]
-            job_index += small_chunk_size
-        else:
-            chunk_job_ids = job_ids[job_index:job_index + large_chunk_size]
-            job_index += large_chunk_size
         
         if os.path.exists(chunk_dir):
             if complete:
@@ -108,8 +147,8 @@ def run_sweep(sweep_module, complete=False, dry=False):
                 'chunk_id' : chunk_id,
                 'n_processes' : sweep_module.n_chunk_processes,
                 'tmp_dir' : os.path.abspath(sweep_module.tmp_dir),
-                'job_ids' : chunk_job_ids,
-                'dry' : dry
+                'queue_filename' : queue_filename,
+                'in_process' : in_process
             }, f, indent=2)
             f.write('\n')
         
@@ -145,7 +184,14 @@ def gather_sweep(sweep_module):
     
     db = sqlite3.connect(sweep_module.db_filename)
     
+    # Manifest of job databases already gathered, so that gathering again skips them
+    db.execute('CREATE TABLE IF NOT EXISTS manifest (job_id INTEGER, filename TEXT, size INTEGER, mtime REAL, checksum TEXT)')
+    manifest = dict(
+        (row[0], row[1:]) for row in db.execute('SELECT job_id, size, mtime, checksum FROM manifest')
+    )
+    
     create_index_sql_set = set()
+    changed_job_ids = []
 
     jobs_info = [row for row in db.execute('SELECT job_id, params FROM jobs')]
 
@@ -155,10 +201,31 @@ def gather_sweep(sweep_module):
         job_db_path = os.path.join(job_dir, params['db_filename'])
         if not os.path.exists(job_db_path):
             sys.stderr.write('Database for job ID {0} not present; skipping!\n'.format(job_id))
+        elif job_id in manifest:
+            stat = os.stat(job_db_path)
+            if manifest[job_id][:2] != (stat.st_size, stat.st_mtime):
+                if manifest[job_id][2] == get_checksum(job_db_path):
+                    # Touched but unchanged: record the new size and time so it isn't checksummed again
+                    db.execute(
+                        'UPDATE manifest SET size = ?, mtime = ? WHERE job_id = ?',
+                        [stat.st_size, stat.st_mtime, job_id]
+                    )
+                    db.commit()
+                else:
+                    # Gathered rows have no job_id column, so they can't be replaced
+                    sys.stderr.write('Database for job ID {0} changed since it was gathered!\n'.format(job_id))
+                    changed_job_ids.append(job_id)
         else:
+            stat = os.stat(job_db_path)
+            checksum = get_checksum(job_db_path)
             job_db = sqlite3.connect(job_db_path)
             create_index_sql_set.update(gather_job(db, job_id, job_db))
             job_db.close()
+            db.execute(
+                'INSERT INTO manifest VALUES (?,?,?,?,?)',
+                [job_id, job_db_path, stat.st_size, stat.st_mtime, checksum]
+            )
+            db.commit()
 
     for create_index_sql in create_index_sql_set:
         try:
@@ -169,28 +236,49 @@ def gather_sweep(sweep_module):
     db.commit()
     db.close()
 
+    if len(changed_job_ids) > 0:
+        sys.stderr.write(
+            '{0} job databases changed since they were gathered, so the sweep DB contains stale rows for them; '
+            'remove it and gather again.\n'.format(len(changed_job_ids))
+        )
+        sys.exit(1)
+
+def get_checksum(filename):
+    '''Returns the SHA-1 hex digest of a file's contents.'''
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(1 << 20)
+            if len(data) == 0:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
 def gather_job(db, job_id, job_db):
     sys.stderr.write('Processing output from job_id {0}\n'.format(job_id))
     
-    for table_name, create_sql in job_db.execute(
+    tables = job_db.execute(
         "SELECT name, sql FROM sqlite_master WHERE type = 'table'"
-    ):
-        # Try creating table in case it doesn't yet exist
+    ).fetchall()
+    
+    # Try creating tables in case they don't yet exist
+    # (before inserting, since creating a table commits, and the caller commits the job's rows)
+    for table_name, create_sql in tables:
         try:
             db.execute(create_sql)
         except:
             pass
-        
-        # Insert all rows into master database
-        for row in job_db.execute('SELECT * FROM {0}'.format(table_name)):
-            db.execute(
-                'INSERT INTO {0} VALUES ({1})'.format(
-                    table_name,
-                    ','.join(['?'] * len(row))
-                ), row
-            )
-        
-        db.commit()
+    
+    for table_name, create_sql in tables:
+        # Insert all rows into master database, streaming them from the job database
+        n_cols = len(job_db.execute('SELECT * FROM {0} LIMIT 0'.format(table_name)).description)
+        db.executemany(
+            'INSERT INTO {0} VALUES ({1})'.format(
+                table_name,
+                ','.join(['?'] * n_cols)
+            ),
+            job_db.execute('SELECT * FROM {0}'.format(table_name))
+        )
     
     # Return indices identified by this job
     create_index_sql_list = []
@@ -0,0 +1,48 @@
+#!/usr/bin/env pypy
+
+class SumTree(object):
+    '''Nonnegative weights for the integers 0, ..., n_items - 1, with logarithmic-time
+    updates and weighted random choice.
+
+    Weights are stored in the leaves of a complete binary tree in which each internal
+    node holds the sum of its children. An update recomputes the sums on the path to the
+    root from the children, rather than adding a difference, so rounding error does not
+    accumulate.
+    '''
+    def __init__(self, n_items):
+        self.n_items = n_items
+        self.n_leaves = 1
+        while self.n_leaves < n_items:
+            self.n_leaves *= 2
+        self.nodes = [0.0] * (2 * self.n_leaves)
+
+    def get(self, item):
+        return self.nodes[self.n_leaves + item]
+
+    def update(self, item, weight):
+        assert weight >= 0.0
+        nodes = self.nodes
+        node = self.n_leaves + item
+        nodes[node] = weight
+        node //= 2
+        while node > 0:
+            nodes[node] = nodes[2 * node] + nodes[2 * node + 1]
+            node //= 2
+
+    def total(self):
+        return self.nodes[1]
+
+    def choice(self, rng):
+        '''Draws an item with probability proportional to its weight; total() must be positive.'''
+        nodes = self.nodes
+        u = rng.rand() * nodes[1]
+        node = 1
+        while node < self.n_leaves:
+            left = 2 * node
+            # Go right only into a nonzero subtree, in case of rounding error near the boundary
+            if u < nodes[left] or nodes[left + 1] == 0.0:
+                node = left
+            else:
+                u -= nodes[left]
+                node = left + 1
+        return node - self.n_leaves